@@ -0,0 +1,247 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Asyncio transfer engine. Tables are read with asyncpg over the binary
+# protocol, and load jobs are started without waiting for them. All
+# in-flight jobs are polled together by one task, so a single event loop
+# keeps many tables moving. Blocking client calls run in the executor of
+# create_executor().
+import asyncio
+import concurrent.futures
+import os
+import re
+from collections import deque
+from contextlib import asynccontextmanager
+from decimal import Decimal
+import pandas as pd
+import data_transfer as dt
+import transfer_metrics as tm
+from resource_manager import get_bigquery_client, get_psql_settings, get_psql_pool_size
+
+async_table_workers = int(os.getenv('ASYNC_TABLE_WORKERS', '32'))
+job_poll_interval = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+
+# Loads in flight per table while the next chunks are read
+table_pending_loads = 2
+
+# Seconds between attempts to take a postgresql connection permit
+pg_acquire_interval = 0.05
+
+# Executor for the blocking calls of the event loop. A table task holds a
+# postgresql permit while its loads run in the executor, and tables in a
+# threaded write path block executor threads waiting for permits. At most
+# one thread per table blocks on permits, so with more threads than table
+# workers the permit holders always find a thread for their loads.
+def create_executor():
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=async_table_workers + dt.bq_max_jobs + 1, thread_name_prefix='async-transfer')
+
+# Create an asyncpg pool of a source, sized like its psycopg2 pool. Idle
+# connections are closed, so only connections in use stay open.
+async def create_pool(source=None):
+    try:
+        import asyncpg
+    except ImportError:
+        raise RuntimeError("the async engine needs asyncpg, install it with: pip install asyncpg")
+    settings = get_psql_settings(source)
+    return await asyncpg.create_pool(
+        user=settings['user'],
+        password=settings['password'],
+        host=settings['host'],
+        port=settings['port'],
+        database=settings['dbname'],
+        min_size=0,
+        max_size=get_psql_pool_size(source))
+
+# Acquire a pooled connection within the global postgresql connection
+# limit shared with the threaded readers. The permit is polled for, so a
+# waiting task neither blocks the event loop nor holds an executor thread.
+@asynccontextmanager
+async def acquire_connection(pool):
+    while not dt.pg_connections.acquire(blocking=False):
+        await asyncio.sleep(pg_acquire_interval)
+    try:
+        async with pool.acquire() as conn:
+            yield conn
+    finally:
+        dt.release_pg_connections()
+
+# asyncpg pools by source, created on first use
+class SourcePools:
+    def __init__(self):
+        self.pools = {}
+        self.lock = asyncio.Lock()
+
+    async def get(self, source):
+        async with self.lock:
+            if source not in self.pools:
+                self.pools[source] = await create_pool(source)
+            return self.pools[source]
+
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+        self.pools.clear()
+
+# Polls every in-flight load job in one loop and resolves a future per
+# job when it is done
+class JobPoller:
+    def __init__(self, interval=job_poll_interval):
+        self.interval = interval
+        self.pending = {}
+        self.task = None
+
+    # Wait for a started job to finish
+    def wait(self, job):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[job.job_id] = (job, future)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return future
+
+    async def run(self):
+        while len(self.pending) > 0:
+            await asyncio.sleep(self.interval)
+            jobs = list(self.pending.values())
+            # A failed reload is retried on the next round
+            await asyncio.gather(*(asyncio.to_thread(job.reload) for job, future in jobs),
+                return_exceptions=True)
+            for job, future in jobs:
+                if job.state != 'DONE':
+                    continue
+                del self.pending[job.job_id]
+                if future.done():
+                    continue
+                if job.error_result:
+                    future.set_exception(RuntimeError(
+                        f"load job {job.job_id} failed: {job.error_result.get('message')}"))
+                else:
+                    future.set_result(job)
+
+# Replace psycopg2 %s placeholders with asyncpg $n placeholders and
+# escaped %% with %
+def convert_placeholders(sql):
+    count = 0
+    def placeholder(match):
+        nonlocal count
+        if match.group() == '%%':
+            return '%'
+        count += 1
+        return f"${count}"
+    return re.sub('%%|%s', placeholder, sql)
+
+# asyncpg needs parameters of the column type, watermarks are kept as text
+def convert_param(value, pg_type):
+    if not isinstance(value, str) or pg_type is None:
+        return value
+    if pg_type.startswith('timestamp') or pg_type == 'date':
+        return pd.Timestamp(value).to_pydatetime()
+    if pg_type in ('smallint', 'integer', 'bigint'):
+        return int(value)
+    if pg_type in ('numeric', 'decimal'):
+        return Decimal(value)
+    return value
+
+# Start the load of one chunk and wait for it on the poller
+async def load_chunk(poller, jobs, table_id, chunk, schema, write_disposition):
+    async with jobs:
+        if isinstance(chunk, pd.DataFrame):
+            job = await asyncio.to_thread(dt.start_df_load, table_id, chunk, schema, write_disposition)
+        else:
+            job = await asyncio.to_thread(dt.start_arrow_load, table_id, chunk, schema, write_disposition)
+        with tm.stage('job_wait'):
+            await poller.wait(job)
+
+# Read a prepared transfer with asyncpg and load it chunk by chunk. A table
+# replaced by more than one chunk is loaded to a staging table and swapped
+# in once the read is done, like write_chunks_to_bigquery. Returns the
+# number of rows loaded and the highest incremental value.
+async def write_transfer(pool, poller, jobs, transfer):
+    table_id = transfer['bq_table_name']
+    schema = transfer['bq_schema']
+    watermark_column = transfer['incremental_column']
+    write_disposition = transfer['write_disposition']
+
+    sql = f"SELECT {transfer['select']} FROM {transfer['source_table']}"
+    if transfer['where'] is not None:
+        sql = f"{sql} WHERE {transfer['where']}"
+    params = [convert_param(param, transfer['incremental_type']) for param in transfer['params']]
+    print(f"reading records from source table: {sql}")
+
+    rows = 0
+    high_watermark = None
+    pending = deque()
+    # First chunk of a truncate, held until the second one shows whether
+    # the table needs a staging table
+    first_chunk = None
+    staging_table_id = None
+    try:
+        async with acquire_connection(pool) as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                cursor = await conn.cursor(convert_placeholders(sql), *params)
+                while True:
+                    with tm.stage('extract'):
+                        records = await cursor.fetch(transfer['chunk_size'])
+                    if len(records) == 0:
+                        break
+                    chunk = dt.rows_to_chunk([tuple(record) for record in records],
+                        list(records[0].keys()), transfer['arrow_schema'])
+                    if transfer['arrow_schema'] is None:
+                        with tm.stage('cast'):
+                            chunk = dt.cast_dataframe_columns(chunk, schema)
+                        tm.add_bytes(int(chunk.memory_usage(index=False, deep=True).sum()))
+
+                    if rows == 0 and write_disposition == 'WRITE_TRUNCATE':
+                        first_chunk = chunk
+                    elif rows == 0:
+                        await load_chunk(poller, jobs, table_id, chunk, schema, write_disposition)
+                    else:
+                        if first_chunk is not None:
+                            staging_table_id = await asyncio.to_thread(dt.create_staging_table, table_id, schema)
+                            pending.append(asyncio.create_task(
+                                load_chunk(poller, jobs, staging_table_id, first_chunk, schema, 'WRITE_APPEND')))
+                            first_chunk = None
+                        pending.append(asyncio.create_task(
+                            load_chunk(poller, jobs, staging_table_id or table_id, chunk, schema, 'WRITE_APPEND')))
+                        if len(pending) >= table_pending_loads:
+                            await pending.popleft()
+                    rows += len(chunk)
+                    tm.add_rows(len(chunk))
+
+                    if watermark_column is not None:
+                        chunk_max = dt.get_chunk_max(chunk, watermark_column)
+                        if chunk_max is not None and (high_watermark is None or chunk_max > high_watermark):
+                            high_watermark = chunk_max
+        await asyncio.gather(*pending)
+
+        if first_chunk is not None:
+            await load_chunk(poller, jobs, table_id, first_chunk, schema, write_disposition)
+        elif staging_table_id is not None:
+            await asyncio.to_thread(dt.replace_rows_from_staging, table_id, staging_table_id, schema)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+    finally:
+        if staging_table_id is not None:
+            await asyncio.to_thread(get_bigquery_client().delete_table, staging_table_id, not_found_ok=True)
+
+    # Source table is empty, truncate destination table anyway
+    if rows == 0 and write_disposition == 'WRITE_TRUNCATE':
+        df = pd.DataFrame(columns=[field.name for field in schema])
+        df = dt.cast_dataframe_columns(df, schema)
+        await load_chunk(poller, jobs, table_id, df, schema, write_disposition)
+    print(f"loaded {rows} rows into {table_id}")
+    return rows, high_watermark
@@ -0,0 +1,431 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline benchmark of the transfer path. main.main() runs end to end against
+# in-process stand-ins for postgresql, bigquery and data catalog, so results
+# only depend on local cpu and memory.
+#
+#   python3 benchmark.py --rows 1000000 10000000 50000000 --schemas narrow wide
+#   python3 benchmark.py --save-baseline benchmark_baseline.json
+#   python3 benchmark.py --baseline benchmark_baseline.json
+import argparse
+import datetime
+import io
+import json
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+project_id = 'bench-project'
+location = 'us-east4'
+entry_group_id = 'postgresql'
+metadata_template_id = 'postgresql_table_metadata'
+tag_template_id = 'data_replication_tags'
+
+# Shape of reporting.fills
+narrow_columns = [
+    ('id', 'bigint'),
+    ('account_id', 'bigint'),
+    ('market', 'character_varying'),
+    ('side', 'character_varying'),
+    ('price', 'numeric'),
+    ('size', 'numeric'),
+    ('fee', 'numeric'),
+    ('liquidation', 'boolean'),
+    ('created_at', 'timestamp_without_time_zone'),
+]
+
+# Wide table, the fills columns repeated with a suffix
+wide_columns = narrow_columns + [
+    (f"{name}_{i}", type_) for i in range(1, 7) for name, type_ in narrow_columns if name != 'id']
+
+schemas = {'narrow': narrow_columns, 'wide': wide_columns}
+
+base_time = datetime.datetime(2022, 1, 1)
+markets = ['BTC-PERP', 'ETH-PERP', 'SOL-PERP', 'BTC/USD', 'ETH/USD']
+
+# Synthetic value for row i of a column, python types as returned by psycopg2
+def synthetic_value(type_, i, column_index):
+    if type_ in ('bigint', 'integer'):
+        return i if column_index == 0 else (i * 7919 + column_index) % 100000
+    if type_ == 'character_varying':
+        return markets[(i + column_index) % len(markets)] if i % 50 else None
+    if type_ == 'numeric':
+        return Decimal((i * 31 + column_index) % 1000000) / 1000
+    if type_ == 'boolean':
+        return i % 97 == 0
+    return base_time + datetime.timedelta(seconds=i)
+
+# Type oids reported for the synthetic columns
+type_oids = {
+    'bigint': 20,
+    'integer': 23,
+    'character_varying': 1043,
+    'numeric': 1700,
+    'boolean': 16,
+    'timestamp_without_time_zone': 1114,
+}
+
+# Encode a decimal as a binary copy numeric: base 10000 digits aligned on
+# the decimal point
+def encode_numeric(value):
+    sign, digits, exponent = value.as_tuple()
+    dscale = max(-exponent, 0)
+    number = int(''.join(map(str, digits)) or '0')
+    shift = exponent % 4
+    number *= 10 ** shift
+    exponent -= shift
+    groups = []
+    while number > 0:
+        number, group = divmod(number, 10000)
+        groups.insert(0, group)
+    weight = len(groups) - 1 + exponent // 4 if len(groups) > 0 else 0
+    while len(groups) > 0 and groups[-1] == 0:
+        groups.pop()
+    return struct.pack(f'>hhHh{len(groups)}H', len(groups), weight, 0x4000 if sign else 0, dscale, *groups)
+
+# Encode a synthetic value in the binary copy format, length included
+def encode_copy_value(type_, value):
+    if value is None:
+        return struct.pack('>i', -1)
+    if type_ == 'bigint':
+        data = struct.pack('>q', value)
+    elif type_ == 'integer':
+        data = struct.pack('>i', value)
+    elif type_ == 'character_varying':
+        data = value.encode()
+    elif type_ == 'numeric':
+        data = encode_numeric(value)
+    elif type_ == 'boolean':
+        data = b'\x01' if value else b'\x00'
+    else:
+        micros = (value - datetime.datetime(2000, 1, 1)) // datetime.timedelta(microseconds=1)
+        data = struct.pack('>q', micros)
+    return struct.pack('>i', len(data)) + data
+
+stage_times = {'read': 0.0, 'cast': 0.0, 'serialize': 0.0}
+stats = {'bytes': 0}
+
+# Accumulate wall time of calls to func under a stage name
+def timed(stage, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_times[stage] += time.perf_counter() - start
+    return wrapper
+
+# Postgresql stand-in: cursors produce synthetic rows
+class FakeCursor:
+    def __init__(self, name, columns, total_rows, source_table):
+        self.name = name
+        self.columns = columns
+        self.total_rows = total_rows
+        self.source_table = source_table
+        self.position = 0
+        self.result = []
+        self.description = [(name, type_oids[type_]) for name, type_ in columns]
+        self.itersize = 2000
+
+    def execute(self, sql, params=None):
+        # Planner statistics: table, reltuples, size, live rows, modified rows,
+        # integer primary key
+        if 'pg_total_relation_size' in sql:
+            self.result = [(self.source_table, self.total_rows, self.total_rows * 100, self.total_rows, 0, True)]
+
+    def fetchall(self):
+        return self.result
+
+    def mogrify(self, sql, params=None):
+        return sql.encode()
+
+    # Write all rows as a binary copy stream in blocks of itersize rows
+    def copy_expert(self, sql, file):
+        file.write(b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+        field_count = struct.pack('>h', len(self.columns))
+        for block_start in range(0, self.total_rows, self.itersize):
+            start = time.perf_counter()
+            block = bytearray()
+            for i in range(block_start, min(block_start + self.itersize, self.total_rows)):
+                block += field_count
+                for column_index, (name, type_) in enumerate(self.columns):
+                    block += encode_copy_value(type_, synthetic_value(type_, i, column_index))
+            stage_times['read'] += time.perf_counter() - start
+            file.write(block)
+        file.write(struct.pack('>h', -1))
+
+    def fetchmany(self, size):
+        start = time.perf_counter()
+        end = min(self.position + size, self.total_rows)
+        rows = []
+        for i in range(self.position, end):
+            rows.append(tuple(
+                synthetic_value(type_, i, column_index)
+                for column_index, (name, type_) in enumerate(self.columns)))
+        self.position = end
+        stage_times['read'] += time.perf_counter() - start
+        return rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, columns, total_rows, source_table):
+        self.columns = columns
+        self.total_rows = total_rows
+        self.source_table = source_table
+
+    def cursor(self, name=None):
+        return FakeCursor(name, self.columns, self.total_rows, self.source_table)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class FakeEngine:
+    def __init__(self, columns, total_rows, source_table):
+        self.columns = columns
+        self.total_rows = total_rows
+        self.source_table = source_table
+
+    def raw_connection(self):
+        return FakeConnection(self.columns, self.total_rows, self.source_table)
+
+    def dispose(self):
+        pass
+
+# Bigquery stand-in: load jobs serialize their input and drop it
+class FakeJob:
+    def result(self):
+        return self
+
+class FakeBigQueryClient:
+    def __init__(self):
+        self.tables = {}
+        self.datasets = set()
+
+    def get_table(self, table_id):
+        from google.cloud.exceptions import NotFound
+        if table_id not in self.tables:
+            raise NotFound(table_id)
+        return self.tables[table_id]
+
+    def create_table(self, table, exists_ok=False):
+        self.tables[f"{table.project}.{table.dataset_id}.{table.table_id}"] = table
+        return table
+
+    def update_table(self, table, fields):
+        return table
+
+    def delete_table(self, table_id, not_found_ok=False):
+        self.tables.pop(table_id, None)
+
+    def get_dataset(self, dataset_id):
+        from google.cloud.exceptions import NotFound
+        if dataset_id not in self.datasets:
+            raise NotFound(dataset_id)
+
+    def create_dataset(self, dataset, exists_ok=False):
+        self.datasets.add(f"{dataset.project}.{dataset.dataset_id}")
+
+    def query(self, sql):
+        return FakeJob()
+
+    def load_table_from_dataframe(self, df, table_id, job_config=None, job_id=None):
+        # Same conversion the client library does before uploading
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        start = time.perf_counter()
+        buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer)
+        stage_times['serialize'] += time.perf_counter() - start
+        stats['bytes'] += buffer.tell()
+        return FakeJob()
+
+    def load_table_from_file(self, file_obj, table_id, job_config=None, job_id=None):
+        stats['bytes'] += len(file_obj.read())
+        return FakeJob()
+
+    def close(self):
+        pass
+
+# Data catalog stand-in holding one postgresql table entry
+class FakeDataCatalogClient:
+    def __init__(self, columns, source_table):
+        from google.cloud import datacatalog_v1
+        self.datacatalog_v1 = datacatalog_v1
+        schema_name, table_name = source_table.split('.')
+        self.entry = datacatalog_v1.Entry(
+            name=f"projects/{project_id}/locations/{location}/entryGroups/{entry_group_id}/entries/{schema_name}_{table_name}",
+            display_name=table_name,
+            user_specified_type='table',
+            schema=datacatalog_v1.Schema(columns=[
+                datacatalog_v1.ColumnSchema(column=name, type_=type_) for name, type_ in columns]))
+        metadata_tag = datacatalog_v1.Tag(
+            template=f"projects/{project_id}/locations/{location}/tagTemplates/{metadata_template_id}")
+        for field, value in (('database_name', 'bench'), ('schema_name', schema_name)):
+            metadata_tag.fields[field] = datacatalog_v1.types.TagField(string_value=value)
+        self.tags = [metadata_tag]
+
+    def get_tag_template(self, request):
+        return self.datacatalog_v1.TagTemplate(name=request.name)
+
+    def list_entries(self, request):
+        return [self.entry]
+
+    def list_tags(self, request):
+        return list(self.tags)
+
+    def create_tag(self, request):
+        self.tags.append(request.tag)
+        return request.tag
+
+    def update_tag(self, request):
+        return request.tag
+
+    def close(self):
+        pass
+
+# Run one scenario in this process and return its measurements
+def run_scenario(schema_name, total_rows, extract_format, chunk_size, extract_reader='cursor'):
+    state_dir = tempfile.mkdtemp(prefix='pg2bq-bench-')
+    os.environ.update({
+        'PROJECT_ID': project_id,
+        'LOCATION': location,
+        'SYSTEM': entry_group_id,
+        'METADATA_TEMPLATE_ID': metadata_template_id,
+        'TAG_TEMPLATE_ID': tag_template_id,
+        'BQ_LOCATION': location,
+        'API_PREFIX': '//datacatalog.googleapis.com',
+        'BQ_TABLE_CONFIG': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'table_config.json'),
+        'SYNC_STATE_FILE': os.path.join(state_dir, 'sync_state.json'),
+        'DB_CHUNK_SIZE': str(chunk_size),
+        'EXTRACT_FORMAT': extract_format,
+        'EXTRACT_READER': extract_reader,
+        'TABLE_WORKERS': '1',
+    })
+    os.environ.pop('STAGING_DIR', None)
+    os.environ.pop('CATALOG_CACHE_FILE', None)
+
+    import resource_manager
+    import data_transfer
+    import copy_extract
+    import main
+
+    source_table = 'reporting.fills'
+    columns = schemas[schema_name]
+    resource_manager.set_resource('psql_engine', FakeEngine(columns, total_rows, source_table))
+    resource_manager.set_resource('bigquery', FakeBigQueryClient())
+    resource_manager.set_resource('datacatalog', FakeDataCatalogClient(columns, source_table))
+
+    data_transfer.rows_to_chunk = timed('read', data_transfer.rows_to_chunk)
+    data_transfer.cast_dataframe_columns = timed('cast', data_transfer.cast_dataframe_columns)
+    data_transfer.write_arrow_to_bigquery = timed('serialize', data_transfer.write_arrow_to_bigquery)
+    copy_extract.CopyDecoder.feed = timed('read', copy_extract.CopyDecoder.feed)
+
+    start = time.perf_counter()
+    failures = main.main()
+    elapsed = time.perf_counter() - start
+    if len(failures) > 0:
+        raise RuntimeError(f"benchmark run failed: {failures}")
+
+    return {
+        'scenario': f"{schema_name}-{total_rows}-{extract_format}"
+            + (f"-{extract_reader}" if extract_reader != 'cursor' else ''),
+        'rows': total_rows,
+        'columns': len(columns),
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(total_rows / elapsed, 1),
+        'mb_per_second': round(stats['bytes'] / 1024 / 1024 / elapsed, 2),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'stage_seconds': {stage: round(seconds, 3) for stage, seconds in stage_times.items()},
+    }
+
+# Compare results with a saved baseline, positive change is better
+def compare_with_baseline(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {result['scenario']: result for result in json.load(f)}
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if base is None:
+            print(f"{result['scenario']}: no baseline")
+            continue
+        throughput = (result['rows_per_second'] / base['rows_per_second'] - 1) * 100
+        memory = (base['peak_rss_mb'] / result['peak_rss_mb'] - 1) * 100
+        print(f"{result['scenario']}: rows/s {throughput:+.1f}%, peak rss {memory:+.1f}% vs baseline")
+
+def print_result(result):
+    stages = ', '.join(f"{stage} {seconds}s" for stage, seconds in result['stage_seconds'].items())
+    print(f"{result['scenario']}: {result['rows_per_second']} rows/s, "
+        f"{result['mb_per_second']} MB/s, peak rss {result['peak_rss_mb']} MB, {stages}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline transfer benchmark')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 10000000, 50000000])
+    parser.add_argument('--schemas', nargs='+', choices=sorted(schemas), default=['narrow', 'wide'])
+    parser.add_argument('--format', dest='extract_format', choices=['pandas', 'arrow'], default='pandas')
+    parser.add_argument('--reader', dest='extract_reader', choices=['cursor', 'copy'], default='cursor')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--baseline', help='compare results with this baseline file')
+    parser.add_argument('--save-baseline', help='save results as baseline to this file')
+    parser.add_argument('--scenario', nargs=2, metavar=('SCHEMA', 'ROWS'), help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # Child process: run one scenario so peak rss is not shared between scenarios
+    if args.scenario is not None:
+        result = run_scenario(args.scenario[0], int(args.scenario[1]), args.extract_format, args.chunk_size,
+            args.extract_reader)
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for schema_name in args.schemas:
+        for total_rows in args.rows:
+            with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+                subprocess.run([
+                    sys.executable, os.path.abspath(__file__),
+                    '--scenario', schema_name, str(total_rows),
+                    '--format', args.extract_format,
+                    '--reader', args.extract_reader,
+                    '--chunk-size', str(args.chunk_size),
+                    '--result-file', result_file.name],
+                    check=True, stdout=subprocess.DEVNULL)
+                result = json.load(open(result_file.name))
+            print_result(result)
+            results.append(result)
+
+    for file_name in (args.output, args.save_baseline):
+        if file_name is not None:
+            with open(file_name, 'w') as f:
+                json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        compare_with_baseline(results, args.baseline)
+
+if __name__ == '__main__':
+    main()
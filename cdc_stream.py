@@ -0,0 +1,194 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Change data capture from a logical replication slot (wal2json format
+# version 2) into bigquery changelog tables. Events are micro-batched and
+# loaded at transaction boundaries, and the slot is only confirmed up to
+# the last commit that was loaded, so a restart never loses events. Large
+# transactions are loaded in parts before their commit arrives.
+import json
+import os
+import select
+import time
+from decimal import Decimal
+import pandas as pd
+import psycopg2 as pg
+import psycopg2.extras
+from google.cloud import bigquery
+import data_transfer as dt
+from sync_state import get_table_state, update_table_state
+
+cdc_slot_name = os.getenv('CDC_SLOT_NAME', 'pg2bq')
+cdc_batch_size = int(os.getenv('CDC_BATCH_SIZE', '10000'))
+cdc_max_latency = float(os.getenv('CDC_MAX_LATENCY', '30'))
+# Changes buffered before a batch is loaded inside a transaction
+cdc_max_buffered = int(os.getenv('CDC_MAX_BUFFERED', '100000'))
+
+# Change columns added to every changelog table
+change_fields = [
+    bigquery.SchemaField('_change_type', 'STRING'),
+    bigquery.SchemaField('_change_lsn', 'INT64'),
+    bigquery.SchemaField('_commit_timestamp', 'TIMESTAMP'),
+]
+
+# State key for the confirmed position of the slot
+state_key = f"cdc:{cdc_slot_name}"
+
+# Change types of the wal2json actions that change table rows
+change_types = {'I': 'INSERT', 'U': 'UPDATE', 'D': 'DELETE', 'T': 'TRUNCATE'}
+
+def connect_replication():
+    return pg.connect(
+        user=dt.db_user,
+        password=dt.db_pass,
+        host=dt.db_host,
+        port=dt.db_port,
+        dbname=dt.db_name,
+        connection_factory=psycopg2.extras.LogicalReplicationConnection)
+
+# Create the replication slot if it does not exist yet
+def ensure_replication_slot(cursor):
+    cursor.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (cdc_slot_name,))
+    if cursor.fetchone() is None:
+        cursor.create_replication_slot(cdc_slot_name, output_plugin='wal2json')
+        print(f"created replication slot {cdc_slot_name}")
+
+# Decode one wal2json message into (action, table, row). For transaction
+# begin and commit messages, logical messages ('M') and other actions
+# without table rows, table is None and row is the whole message. A
+# truncate has no columns, its row is empty.
+def decode_change(payload):
+    change = json.loads(payload, parse_float=Decimal)
+    action = change['action']
+    if action not in change_types:
+        return action, None, change
+    table = f"{change['schema']}.{change['table']}"
+    if action == 'D':
+        columns = change.get('identity', [])
+    elif action == 'T':
+        columns = []
+    else:
+        columns = change.get('columns', [])
+    row = {column['name']: column['value'] for column in columns}
+    return action, table, row
+
+# Load buffered rows of every table to its changelog table
+def flush_changes(buffers, targets):
+    for source_table, rows in buffers.items():
+        if len(rows) == 0:
+            continue
+        target = targets[source_table]
+        columns = [field.name for field in target['schema']]
+        df = pd.DataFrame.from_records(rows, columns=columns)
+        df = dt.cast_dataframe_columns(df, target['schema'])
+        dt.write_df_to_bigquery(target['table_id'], df, target['schema'], 'WRITE_APPEND')
+        print(f"loaded {len(rows)} changes into {target['table_id']}")
+        rows.clear()
+
+# Stream changes of the target tables until interrupted. targets maps a
+# source table to {"table_id": changelog table, "schema": changelog schema}.
+# Only columns of the changelog schema are kept, so columns left out of
+# the projection are never buffered or loaded.
+def stream_changes(targets):
+    conn = connect_replication()
+    cursor = conn.cursor()
+    ensure_replication_slot(cursor)
+
+    start_lsn = get_table_state(state_key).get('confirmed_lsn', 0)
+    cursor.start_replication(
+        slot_name=cdc_slot_name,
+        decode=True,
+        start_lsn=start_lsn,
+        status_interval=10,
+        options={
+            'format-version': '2',
+            'include-timestamp': '1',
+            'include-lsn': '1',
+            'add-tables': ','.join(targets),
+        })
+    print(f"streaming changes of {len(targets)} tables from slot {cdc_slot_name}")
+
+    buffers = {source_table: [] for source_table in targets}
+    columns = {source_table: {field.name for field in target['schema']}
+        for source_table, target in targets.items()}
+    buffered = 0
+    oldest_change = None
+    commit_lsn = None
+    commit_timestamp = None
+    in_transaction = False
+    # Changes of the current transaction were loaded before its commit
+    partial_flush = False
+    try:
+        while True:
+            message = cursor.read_message()
+            if message is None:
+                # Flush an idle batch once it reaches the latency bound
+                if buffered > 0 and not in_transaction and time.time() - oldest_change >= cdc_max_latency:
+                    flush_changes(buffers, targets)
+                    buffered = 0
+                    oldest_change = None
+                    confirm(cursor, commit_lsn)
+                select.select([cursor], [], [], 1.0)
+                continue
+
+            action, source_table, row = decode_change(message.payload)
+            if action == 'B':
+                commit_timestamp = row.get('timestamp')
+                in_transaction = True
+                continue
+            if action == 'C':
+                commit_lsn = message.data_start
+                in_transaction = False
+                # Batches are only flushed at transaction boundaries
+                if buffered >= cdc_batch_size or (buffered > 0 and time.time() - oldest_change >= cdc_max_latency):
+                    flush_changes(buffers, targets)
+                    buffered = 0
+                    oldest_change = None
+                    confirm(cursor, commit_lsn)
+                    partial_flush = False
+                elif buffered == 0 and partial_flush:
+                    confirm(cursor, commit_lsn)
+                    partial_flush = False
+                elif buffered == 0:
+                    # Nothing pending, let the server recycle wal
+                    cursor.send_feedback(flush_lsn=commit_lsn)
+                continue
+            if source_table not in targets:
+                continue
+
+            row = {name: value for name, value in row.items() if name in columns[source_table]}
+            row['_change_type'] = change_types[action]
+            row['_change_lsn'] = message.data_start
+            row['_commit_timestamp'] = commit_timestamp
+            buffers[source_table].append(row)
+            buffered += 1
+            if oldest_change is None:
+                oldest_change = time.time()
+
+            # Bound memory within one large transaction. The slot is still
+            # only confirmed at the commit, after a restart the changes
+            # loaded so far are loaded again.
+            if buffered >= cdc_max_buffered:
+                flush_changes(buffers, targets)
+                buffered = 0
+                oldest_change = None
+                partial_flush = True
+    finally:
+        conn.close()
+
+# Confirm the slot position after the changes up to lsn were loaded
+def confirm(cursor, lsn):
+    cursor.send_feedback(flush_lsn=lsn)
+    update_table_state(state_key, confirmed_lsn=lsn)
@@ -0,0 +1,89 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Change detection for full reloads. A cheap fingerprint of the source
+# table is compared with the fingerprint saved after the last successful
+# load, and tables that did not change are not transferred again.
+import hashlib
+import json
+import os
+import data_transfer as dt
+from resource_manager import get_psql_engine
+
+change_detection = os.getenv('CHANGE_DETECTION', 'false').lower() == 'true'
+
+# Write activity counters of a table. TRUNCATE is not counted by the
+# statistics collector but assigns a new relfilenode.
+def get_table_counters(cursor, source_table):
+    cursor.execute("""
+        SELECT c.relfilenode, coalesce(s.n_tup_ins, 0), coalesce(s.n_tup_upd, 0), coalesce(s.n_tup_del, 0)
+        FROM pg_class c
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.oid = to_regclass(%s)""", (source_table,))
+    row = cursor.fetchone()
+    return None if row is None else list(row)
+
+def get_max_value(cursor, source_table, column, where=None, params=()):
+    sql = f'SELECT max("{column}") FROM {source_table}'
+    if where is not None:
+        sql = f"{sql} WHERE {where}"
+    cursor.execute(sql, params)
+    value = cursor.fetchone()[0]
+    return None if value is None else dt.format_watermark(value)
+
+# Row count and order independent checksum of the selected rows. This reads
+# the whole table, but nothing leaves postgresql.
+def get_row_checksum(cursor, source_table, select='*', where=None, params=()):
+    sql = f"SELECT {select} FROM {source_table}"
+    if where is not None:
+        sql = f"{sql} WHERE {where}"
+    cursor.execute(f"SELECT count(*), coalesce(sum(hashtext(t::text)::bigint), 0) FROM ({sql}) t", params)
+    return [int(value) for value in cursor.fetchone()]
+
+# A hot standby does not collect write statistics for replayed changes
+def is_in_recovery(cursor):
+    cursor.execute("SELECT pg_is_in_recovery()")
+    return bool(cursor.fetchone()[0])
+
+# Fingerprint of the data a full reload of a table would transfer. The
+# query and schema are part of it so configuration changes reload the table.
+# Returns None when changes cannot be detected: the counters never move on
+# a hot standby, so there only change_column or checksum can tell.
+def get_data_fingerprint(source_table, select, where, params, schema_fingerprint,
+        change_column=None, checksum=False):
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        if change_column is None and not checksum and is_in_recovery(cursor):
+            print(f"change detection of {source_table} needs change_column or change_checksum on a hot standby, loading it")
+            cursor.close()
+            conn.commit()
+            return None
+        fingerprint = {
+            "query": [select, where, [str(param) for param in params]],
+            "schema": schema_fingerprint,
+            "counters": get_table_counters(cursor, source_table),
+        }
+        if change_column is not None:
+            fingerprint["max"] = get_max_value(cursor, source_table, change_column, where, params)
+        if checksum:
+            fingerprint["checksum"] = get_row_checksum(cursor, source_table, select, where, params)
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
@@ -0,0 +1,211 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Resumable transfers. A table is read in pages of chunk_size rows in
+# primary key order, and the sync state records the last key loaded and
+# the load job of the page in flight. After a crash the next run resumes
+# after the last key that was loaded. Load job ids are derived from the
+# run, page and attempt so a load that was submitted before the crash is
+# found again and never applied twice.
+import re
+import uuid
+import pandas as pd
+import data_transfer as dt
+import transfer_metrics as tm
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud.exceptions import NotFound
+from resource_manager import get_bigquery_client, get_psql_engine
+from sync_state import get_table_state, update_table_state, clear_table_state
+
+# Start a new checkpointed run. Pages follow the primary key, so a table
+# without one cannot be checkpointed.
+def create_checkpoint(table_id, source_table, write_disposition, where, params, chunk_size, select='*'):
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        key = [name for name, type_ in dt.get_primary_key(cursor, source_table)]
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+    if len(key) == 0:
+        raise ValueError(f"checkpoint needs a primary key on {source_table}")
+
+    checkpoint = {
+        "run_id": uuid.uuid4().hex[:12],
+        "source_table": source_table,
+        "select": select,
+        "write_disposition": write_disposition,
+        "where": where,
+        "params": list(params),
+        "chunk_size": chunk_size,
+        "key": key,
+        "last_key": None,
+        "page": 0,
+        "pending": None,
+        "high_watermark": None,
+    }
+    update_table_state(table_id, checkpoint=checkpoint)
+    return checkpoint
+
+# Deterministic load job id of a page attempt
+def get_load_job_id(table_id, checkpoint, index, attempt):
+    table_name = re.sub('[^a-zA-Z0-9_]', '_', table_id)
+    return f"pg2bq_{table_name}_{checkpoint['run_id']}_{index:05d}_{attempt}"
+
+# Get the state of a submitted job: 'done', 'failed' or None when the job
+# was never submitted. A job that is still running is waited for.
+def get_job_state(job_id):
+    try:
+        job = get_bigquery_client().get_job(job_id, location=dt.bq_location)
+    except NotFound:
+        return None
+    if job.state != 'DONE':
+        try:
+            job.result()
+        except GoogleAPICallError:
+            return 'failed'
+    return 'failed' if job.error_result else 'done'
+
+# Compare two watermarks kept as text in the checkpoint
+def is_past_watermark(value, watermark):
+    if watermark is None:
+        return True
+    try:
+        return float(value) > float(watermark)
+    except ValueError:
+        return pd.Timestamp(value) > pd.Timestamp(watermark)
+
+# Keep key values as JSON values the next run can pass back to postgresql
+def format_key_value(value):
+    return value if isinstance(value, int) else dt.format_watermark(value)
+
+# Read the page after the last loaded key. Returns the chunk and the key of
+# its last row, None when the page is empty.
+def read_page(checkpoint, arrow_schema):
+    key_columns = ', '.join(f'"{column}"' for column in checkpoint["key"])
+    predicates = []
+    params = list(checkpoint["params"])
+    if checkpoint["where"] is not None:
+        predicates.append(f"({checkpoint['where']})")
+    if checkpoint["last_key"] is not None:
+        predicates.append(f"({key_columns}) > ({', '.join(['%s'] * len(checkpoint['key']))})")
+        params += checkpoint["last_key"]
+    sql = f"SELECT {key_columns}, {checkpoint['select']} FROM {checkpoint['source_table']}"
+    if len(predicates) > 0:
+        sql = f"{sql} WHERE {' AND '.join(predicates)}"
+    sql = f"{sql} ORDER BY {key_columns} LIMIT {checkpoint['chunk_size']}"
+
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        key_count = len(checkpoint["key"])
+        columns = [desc[0] for desc in cursor.description][key_count:]
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+
+    end_key = None
+    if len(rows) > 0:
+        end_key = [format_key_value(value) for value in rows[-1][:key_count]]
+    return dt.rows_to_chunk([row[key_count:] for row in rows], columns, arrow_schema), end_key
+
+# Raise the run high watermark to the watermark of a loaded page
+def advance_watermark(checkpoint, page_watermark):
+    if page_watermark is not None and is_past_watermark(page_watermark, checkpoint["high_watermark"]):
+        checkpoint["high_watermark"] = page_watermark
+
+# Record the page in flight as loaded and move on to the next one
+def finish_page(table_id, checkpoint):
+    pending = checkpoint["pending"]
+    checkpoint["last_key"] = pending["end_key"]
+    advance_watermark(checkpoint, pending["watermark"])
+    checkpoint["page"] += 1
+    checkpoint["pending"] = None
+    update_table_state(table_id, checkpoint=checkpoint)
+
+# Transfer a table page by page, resuming an unfinished run. Returns the
+# number of rows loaded by this run and the highest watermark_column value.
+def write_checkpointed_to_bigquery(table_id, source_table, schema, write_disposition,
+        where=None, params=(), chunk_size=dt.db_chunk_size, arrow_schema=None, watermark_column=None,
+        select='*'):
+    checkpoint = get_table_state(table_id).get("checkpoint")
+    if checkpoint is None or "key" not in checkpoint or checkpoint["source_table"] != source_table \
+            or checkpoint["select"] != select:
+        checkpoint = create_checkpoint(table_id, source_table, write_disposition, where, params, chunk_size, select)
+        print(f"checkpointed run {checkpoint['run_id']} of {table_id} by {', '.join(checkpoint['key'])}")
+    else:
+        print(f"resuming run {checkpoint['run_id']} of {table_id} after {checkpoint['page']} pages")
+
+    rows = 0
+    while True:
+        index = checkpoint["page"]
+        pending = checkpoint["pending"]
+
+        # A job submitted before a crash is finished or retried, not resubmitted
+        attempt = 0
+        if pending is not None:
+            job_state = get_job_state(get_load_job_id(table_id, checkpoint, index, pending["attempt"]))
+            if job_state == 'done':
+                finish_page(table_id, checkpoint)
+                if pending["rows"] < checkpoint["chunk_size"]:
+                    break
+                continue
+            attempt = pending["attempt"] + 1 if job_state == 'failed' else pending["attempt"]
+
+        # Only the first page replaces the table, later pages append to it
+        disposition = checkpoint["write_disposition"] if index == 0 else 'WRITE_APPEND'
+        with tm.stage('extract'):
+            chunk, end_key = read_page(checkpoint, arrow_schema)
+        if len(chunk) == 0 and disposition != 'WRITE_TRUNCATE':
+            break
+
+        if arrow_schema is None:
+            with tm.stage('cast'):
+                chunk = dt.cast_dataframe_columns(chunk, schema)
+
+        # Record the page before submitting, so a job that completes after
+        # a crash is accounted for on resume
+        page_watermark = None
+        if watermark_column is not None and len(chunk) > 0:
+            chunk_max = dt.get_chunk_max(chunk, watermark_column)
+            if chunk_max is not None:
+                page_watermark = dt.format_watermark(chunk_max)
+        checkpoint["pending"] = {"attempt": attempt, "end_key": end_key, "rows": len(chunk),
+            "watermark": page_watermark}
+        update_table_state(table_id, checkpoint=checkpoint)
+
+        job_id = get_load_job_id(table_id, checkpoint, index, attempt)
+        if arrow_schema is not None:
+            dt.write_arrow_to_bigquery(table_id, chunk, schema, disposition, job_id)
+        else:
+            dt.write_df_to_bigquery(table_id, chunk, schema, disposition, job_id)
+        rows += len(chunk)
+        tm.add_rows(len(chunk))
+
+        finish_page(table_id, checkpoint)
+        print(f"loaded page {index + 1} ({rows} rows) into {table_id}")
+        if len(chunk) < checkpoint["chunk_size"]:
+            break
+
+    clear_table_state(table_id, "checkpoint")
+    return rows, checkpoint["high_watermark"]
@@ -0,0 +1,106 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Command line entry point. Subcommands import the modules they need when
+# they run, so --help starts without loading google-cloud, pandas or the
+# postgresql drivers, and clients are only created on first use. main
+# itself defers bigquery, pandas, pyarrow and the transfer modules until a
+# table is transferred, so tagging and catalog lookups only load the data
+# catalog client.
+#
+#   python3 cli.py tag
+#   python3 cli.py plan
+#   python3 cli.py sync [table] [--async]
+#   python3 cli.py daemon
+#   python3 cli.py cdc
+#   python3 cli.py bench [benchmark options]
+import argparse
+import sys
+
+def run_tag(args):
+    import main
+    main.tag_sources()
+    return 0
+
+def run_plan(args):
+    import main
+    main.main(dry_run=True)
+    return 0
+
+def run_sync(args):
+    import main
+    if args.table is not None:
+        failures = main.main_table(args.table)
+    elif args.use_async:
+        import asyncio
+        failures = asyncio.run(main.main_async())
+    else:
+        failures = main.main()
+    return 1 if len(failures) > 0 else 0
+
+def run_daemon(args):
+    import main
+    main.main_daemon()
+    return 0
+
+def run_cdc(args):
+    import main
+    main.main_cdc()
+    return 0
+
+def run_bench(args):
+    import benchmark
+    benchmark.main(args.bench_args)
+    return 0
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='pg2bq', description='Sync postgresql tables to bigquery')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    tag_parser = subparsers.add_parser('tag', help='tag source tables of the entry group')
+    tag_parser.set_defaults(func=run_tag)
+
+    plan_parser = subparsers.add_parser('plan', help='print the transfer plan without writing anything')
+    plan_parser.set_defaults(func=run_plan)
+
+    sync_parser = subparsers.add_parser('sync', help='tag and sync all tables, or sync one table')
+    sync_parser.add_argument('table', nargs='?',
+        help='source table (schema.table) or entry name to sync on its own')
+    sync_parser.add_argument('--async', dest='use_async', action='store_true',
+        help='sync tables on one event loop, reading with asyncpg')
+    sync_parser.set_defaults(func=run_sync)
+
+    daemon_parser = subparsers.add_parser('daemon', help='keep syncing every table on its sync_interval')
+    daemon_parser.set_defaults(func=run_daemon)
+
+    cdc_parser = subparsers.add_parser('cdc', help='stream changes from a logical replication slot')
+    cdc_parser.set_defaults(func=run_cdc)
+
+    # Options of bench are passed on to benchmark.py as they are
+    bench_parser = subparsers.add_parser('bench', help='run the offline benchmark', add_help=False)
+    bench_parser.set_defaults(func=run_bench)
+    return parser
+
+def main(argv=None):
+    parser = get_parser()
+    args, extra = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        args.bench_args = extra
+    elif len(extra) > 0:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
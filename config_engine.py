@@ -0,0 +1,215 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Table configuration engine. The BQ_TABLE_CONFIG file is parsed and
+# validated once. A table_config entry names one table with "table", or
+# matches tables with a glob "pattern" or a "regex". Settings of matching
+# pattern entries are merged in file order, then those of matching regex
+# entries, then settings of entries naming the table are applied on top.
+# Resolved settings are kept per table. The file can also list the postgresql
+# sources of a multi-source run and how their tables are routed.
+import fnmatch
+import json
+import os
+import re
+import threading
+
+# Accepted settings and their types
+setting_types = {
+    'partition_type': (str,),
+    'partition_column': (str,),
+    'clustering_columns': (str, list),
+    'chunk_size': (int,),
+    'incremental_column': (str,),
+    'extract_format': (str,),
+    'extract_reader': (str,),
+    'checkpoint': (bool,),
+    'parallel_workers': (int,),
+    'write_disposition': (str,),
+    'include_columns': (str, list),
+    'exclude_columns': (str, list),
+    'drop_pii': (bool,),
+    'pii_columns': (str, list),
+    'where': (str,),
+    'partition_overwrite': (bool,),
+    'change_detection': (bool,),
+    'change_column': (str,),
+    'change_checksum': (bool,),
+    'sync_interval': (str, int, float),
+}
+
+setting_choices = {
+    'partition_type': ('HOUR', 'DAY', 'MONTH', 'YEAR'),
+    'extract_format': ('pandas', 'arrow'),
+    'extract_reader': ('cursor', 'copy'),
+    'write_disposition': ('WRITE_APPEND', 'WRITE_TRUNCATE', 'WRITE_MERGE'),
+}
+
+positive_settings = ('chunk_size', 'parallel_workers')
+
+selector_keys = ('table', 'pattern', 'regex')
+
+# Accepted settings of a postgresql source
+source_types = {
+    'name': (str,),
+    'entry_group': (str,),
+    'host': (str,),
+    'port': (str, int),
+    'database': (str,),
+    'user': (str,),
+    'password_env': (str,),
+    'pool_size': (int,),
+}
+
+shard_modes = ('per_shard', 'combined')
+
+# Check one config entry and return its settings without the selector
+def validate_entry(entry, position):
+    if not isinstance(entry, dict):
+        raise ValueError(f"table_config entry {position} is not an object")
+    selectors = [key for key in selector_keys if key in entry]
+    if len(selectors) != 1:
+        raise ValueError(f"table_config entry {position} needs exactly one of {', '.join(selector_keys)}")
+
+    settings = {}
+    for key, value in entry.items():
+        if key in selector_keys:
+            continue
+        if key not in setting_types:
+            raise ValueError(f"table_config entry {position}: unknown setting {key}")
+        # bool is an int, but not an accepted chunk size
+        if not isinstance(value, setting_types[key]) or (isinstance(value, bool) and bool not in setting_types[key]):
+            raise ValueError(f"table_config entry {position}: {key} has the wrong type")
+        if key in setting_choices and value not in setting_choices[key]:
+            raise ValueError(f"table_config entry {position}: {key} must be one of {', '.join(setting_choices[key])}")
+        if key in positive_settings and value <= 0:
+            raise ValueError(f"table_config entry {position}: {key} must be positive")
+        # Row filters are run with query parameters, where % starts a placeholder
+        if key == 'where' and '%' in value.replace('%%', ''):
+            raise ValueError(f"table_config entry {position}: write a literal % in where as %%")
+        settings[key] = value
+    return selectors[0], settings
+
+# Check one source entry. Source names end up in sql and table names, so
+# only letters, digits and underscores are accepted.
+def validate_source(source, position):
+    if not isinstance(source, dict):
+        raise ValueError(f"sources entry {position} is not an object")
+    for key in ('name', 'entry_group'):
+        if key not in source:
+            raise ValueError(f"sources entry {position} needs {key}")
+    for key, value in source.items():
+        if key not in source_types:
+            raise ValueError(f"sources entry {position}: unknown setting {key}")
+        if not isinstance(value, source_types[key]) or isinstance(value, bool):
+            raise ValueError(f"sources entry {position}: {key} has the wrong type")
+    if re.fullmatch('[A-Za-z0-9_]+', source['name']) is None:
+        raise ValueError(f"sources entry {position}: name may only hold letters, digits and underscores")
+    return source
+
+# Check how tables of several sources are routed. The shard column and
+# dataset end up in sql like source names.
+def validate_shards(shards):
+    if not isinstance(shards, dict):
+        raise ValueError("shards is not an object")
+    shards = dict({'mode': 'per_shard', 'column': 'shard_id'}, **shards)
+    if shards['mode'] not in shard_modes:
+        raise ValueError(f"shards mode must be one of {', '.join(shard_modes)}")
+    if shards['mode'] == 'combined' and not isinstance(shards.get('dataset'), str):
+        raise ValueError("combined shards need a dataset")
+    if not isinstance(shards['column'], str) or re.fullmatch('[A-Za-z_][A-Za-z0-9_]*', shards['column']) is None:
+        raise ValueError("shards column may only hold letters, digits and underscores")
+    if 'dataset' in shards and re.fullmatch('[A-Za-z0-9_]+', shards['dataset']) is None:
+        raise ValueError("shards dataset may only hold letters, digits and underscores")
+    return shards
+
+# Check settings that depend on each other, once the entries matching a
+# table are merged
+def validate_table_settings(table, settings):
+    if settings.get('partition_overwrite') and 'partition_column' not in settings:
+        raise ValueError(f"table_config of {table}: partition_overwrite needs partition_column")
+
+class TableConfig:
+    def __init__(self, entries, sources=(), shards=None):
+        self.sources = {}
+        for position, source in enumerate(sources):
+            source = validate_source(source, position)
+            if source['name'] in self.sources:
+                raise ValueError(f"sources entry {position}: duplicate name {source['name']}")
+            self.sources[source['name']] = source
+        self.shards = validate_shards(shards or {})
+
+        self.tables = {}
+        patterns = []
+        regexes = []
+        for position, entry in enumerate(entries):
+            selector, settings = validate_entry(entry, position)
+            if selector == 'table':
+                self.tables.setdefault(entry['table'], {}).update(settings)
+            elif selector == 'pattern':
+                patterns.append((re.compile(fnmatch.translate(entry['pattern'])), settings))
+            else:
+                try:
+                    regexes.append((re.compile(entry['regex']), settings))
+                except re.error as e:
+                    raise ValueError(f"table_config entry {position}: invalid regex: {e}")
+        # Regex rules are more specific than globs and apply after them
+        self.rules = patterns + regexes
+        self.resolved = {}
+
+    # Settings of a table, None when no entry matches it
+    def get(self, table):
+        if table in self.resolved:
+            return self.resolved[table]
+        matched = table in self.tables
+        settings = {}
+        for regex, rule in self.rules:
+            if regex.fullmatch(table):
+                settings.update(rule)
+                matched = True
+        settings.update(self.tables.get(table, {}))
+        validate_table_settings(table, settings)
+        resolved = dict(settings, table=table) if matched else None
+        self.resolved[table] = resolved
+        return resolved
+
+config = None
+config_lock = threading.Lock()
+
+# Parse and validate a config file, an empty config when there is none
+def load_config(filename):
+    if filename is None:
+        return TableConfig([])
+    with open(filename) as f:
+        data = json.load(f)
+    return TableConfig(data.get('table_config', []), data.get('sources', []), data.get('shards'))
+
+# Config of BQ_TABLE_CONFIG, loaded on first use
+def get_config():
+    global config
+    with config_lock:
+        if config is None:
+            config = load_config(os.getenv('BQ_TABLE_CONFIG'))
+    return config
+
+def get_table_config(table):
+    return get_config().get(table)
+
+# Configured sources by name, empty when the DB_* settings are used
+def get_sources():
+    return get_config().sources
+
+def get_shards():
+    return get_config().shards
@@ -0,0 +1,313 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Extraction through COPY ... TO STDOUT WITH (FORMAT binary). copy_expert
+# runs in a thread and hands the stream over through a bounded queue, and
+# the tuples are decoded straight into column buffers that are reused for
+# every chunk, without a python row object per record.
+import queue
+import struct
+import threading
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import data_transfer as dt
+from resource_manager import get_psql_engine
+
+copy_signature = b'PGCOPY\n\xff\r\n\x00'
+
+# Blocks of the copy stream buffered between the copy thread and the decoder
+copy_queue_size = 16
+
+# Microseconds and days between the unix and postgresql epochs
+pg_epoch_micros = 946684800000000
+pg_epoch_days = 10957
+
+int16 = struct.Struct('>h')
+int32 = struct.Struct('>i')
+int64 = struct.Struct('>q')
+float64 = struct.Struct('>d')
+float32 = struct.Struct('>f')
+
+# Sign words of the special numeric values
+numeric_specials = {
+    0xC000: Decimal('NaN'),
+    0xD000: Decimal('Infinity'),
+    0xF000: Decimal('-Infinity'),
+}
+
+# Infinite timestamps and dates are read as the largest and smallest
+# values bigquery accepts, like psycopg2 reads them as datetime.max and min
+timestamp_max_micros = 253402300799999999
+timestamp_min_micros = -62135596800000000
+date_max_micros = 253402214400000000
+
+# Decode a binary numeric: digit count, weight, sign and display scale,
+# then base 10000 digits
+def decode_numeric(buf, pos):
+    ndigits, weight, sign, dscale = struct.unpack_from('>hhHh', buf, pos)
+    if sign in numeric_specials:
+        return numeric_specials[sign]
+    digits = ''.join(f"{digit:04d}" for digit in struct.unpack_from(f'>{ndigits}H', buf, pos + 8))
+    exponent = (weight - ndigits + 1) * 4
+    # Scale to dscale, dropped digits are zero padding of the last group
+    if exponent > -dscale:
+        digits += '0' * (exponent + dscale)
+    elif exponent < -dscale:
+        digits = digits[:len(digits) - (-dscale - exponent)]
+    digits = digits.lstrip('0') or '0'
+    return Decimal((1 if sign == 0x4000 else 0, tuple(int(d) for d in digits), -dscale))
+
+def decode_timestamp(buf, pos):
+    micros = int64.unpack_from(buf, pos)[0]
+    if micros == 0x7FFFFFFFFFFFFFFF:
+        return timestamp_max_micros
+    if micros == -0x8000000000000000:
+        return timestamp_min_micros
+    return micros + pg_epoch_micros
+
+def decode_date(buf, pos):
+    days = int32.unpack_from(buf, pos)[0]
+    if days == 0x7FFFFFFF:
+        return date_max_micros
+    if days == -0x80000000:
+        return timestamp_min_micros
+    return (days + pg_epoch_days) * 86400000000
+
+# Column kind, numpy dtype of fixed width kinds and decoder per type oid
+type_decoders = {
+    16: ('bool', np.bool_, lambda buf, pos, length: buf[pos] != 0),
+    20: ('int', np.int64, lambda buf, pos, length: int64.unpack_from(buf, pos)[0]),
+    21: ('int', np.int64, lambda buf, pos, length: int16.unpack_from(buf, pos)[0]),
+    23: ('int', np.int64, lambda buf, pos, length: int32.unpack_from(buf, pos)[0]),
+    700: ('float', np.float64, lambda buf, pos, length: float32.unpack_from(buf, pos)[0]),
+    701: ('float', np.float64, lambda buf, pos, length: float64.unpack_from(buf, pos)[0]),
+    1114: ('timestamp', np.int64, lambda buf, pos, length: decode_timestamp(buf, pos)),
+    1184: ('timestamp', np.int64, lambda buf, pos, length: decode_timestamp(buf, pos)),
+    1082: ('timestamp', np.int64, lambda buf, pos, length: decode_date(buf, pos)),
+    25: ('text', None, lambda buf, pos, length: buf[pos:pos + length].decode()),
+    1042: ('text', None, lambda buf, pos, length: buf[pos:pos + length].decode()),
+    1043: ('text', None, lambda buf, pos, length: buf[pos:pos + length].decode()),
+    1700: ('numeric', None, lambda buf, pos, length: decode_numeric(buf, pos)),
+}
+
+# Buffer of one column. Fixed width values go to a numpy array and a null
+# mask allocated once, other values to a list.
+class ColumnBuffer:
+    def __init__(self, name, type_oid, size):
+        if type_oid not in type_decoders:
+            raise ValueError(f"binary copy does not support type oid {type_oid} of column {name}")
+        self.name = name
+        self.kind, dtype, self.decode = type_decoders[type_oid]
+        self.values = np.zeros(size, dtype=dtype) if dtype is not None else []
+        self.mask = np.zeros(size, dtype=np.bool_)
+
+    def set(self, row, buf, pos, length):
+        if length < 0:
+            self.mask[row] = True
+            if self.kind in ('text', 'numeric'):
+                self.values.append(None)
+            return
+        self.mask[row] = False
+        if self.kind in ('text', 'numeric'):
+            self.values.append(self.decode(buf, pos, length))
+        else:
+            self.values[row] = self.decode(buf, pos, length)
+
+    # Copy the first rows out as a pandas array
+    def to_pandas(self, rows):
+        mask = self.mask[:rows].copy()
+        if self.kind == 'int':
+            return pd.arrays.IntegerArray(self.values[:rows].copy(), mask)
+        if self.kind == 'bool':
+            return pd.arrays.BooleanArray(self.values[:rows].copy(), mask)
+        if self.kind == 'timestamp':
+            values = self.values[:rows].copy()
+            values[mask] = np.iinfo(np.int64).min
+            return values.view('datetime64[us]')
+        if self.kind == 'float':
+            values = self.values[:rows].copy()
+            values[mask] = np.nan
+            return values
+        return list(self.values)
+
+    # Copy the first rows out as an arrow array
+    def to_arrow(self, rows, arrow_type):
+        if self.kind in ('text', 'numeric'):
+            return pa.array(self.values, type=arrow_type)
+        values = self.values[:rows].copy()
+        if self.kind == 'timestamp':
+            values = values.view('datetime64[us]')
+        return pa.array(values, mask=self.mask[:rows].copy(), type=arrow_type)
+
+    def clear(self):
+        if isinstance(self.values, list):
+            self.values.clear()
+
+# Decoder of a binary copy stream into chunks of up to chunk_size rows
+class CopyDecoder:
+    def __init__(self, names, type_oids, chunk_size, arrow_schema=None):
+        self.columns = [ColumnBuffer(name, oid, chunk_size) for name, oid in zip(names, type_oids)]
+        self.chunk_size = chunk_size
+        self.arrow_schema = arrow_schema
+        self.buffer = bytearray()
+        self.header_read = False
+        self.done = False
+        self.rows = 0
+
+    def read_header(self):
+        if len(self.buffer) < 19:
+            return 0
+        if bytes(self.buffer[:11]) != copy_signature:
+            raise ValueError("not a binary copy stream")
+        extension = int32.unpack_from(self.buffer, 15)[0]
+        if len(self.buffer) < 19 + extension:
+            return 0
+        self.header_read = True
+        return 19 + extension
+
+    # Find the end of the tuple at offset, -1 when it is not complete yet
+    def get_tuple_end(self, buf, offset, count):
+        pos = offset + 2
+        end = len(buf)
+        for i in range(count):
+            if pos + 4 > end:
+                return -1
+            length = int32.unpack_from(buf, pos)[0]
+            pos += 4 + max(length, 0)
+        return pos if pos <= end else -1
+
+    # Decode all complete tuples of the stream so far, returning finished chunks
+    def feed(self, data):
+        self.buffer += data
+        buf = self.buffer
+        offset = 0
+        if not self.header_read:
+            offset = self.read_header()
+            if not self.header_read:
+                return []
+
+        chunks = []
+        while not self.done and len(buf) - offset >= 2:
+            count = int16.unpack_from(buf, offset)[0]
+            if count == -1:
+                self.done = True
+                offset += 2
+                break
+            if count != len(self.columns):
+                raise ValueError(f"copy tuple has {count} fields, expected {len(self.columns)}")
+            end = self.get_tuple_end(buf, offset, count)
+            if end < 0:
+                break
+
+            pos = offset + 2
+            row = self.rows
+            for column in self.columns:
+                length = int32.unpack_from(buf, pos)[0]
+                column.set(row, buf, pos + 4, length)
+                pos += 4 + max(length, 0)
+            self.rows += 1
+            offset = end
+            if self.rows == self.chunk_size:
+                chunks.append(self.flush())
+        del buf[:offset]
+        return chunks
+
+    # Build a chunk from the buffered rows and reset the buffers
+    def flush(self):
+        rows = self.rows
+        if self.arrow_schema is None:
+            chunk = pd.DataFrame({column.name: column.to_pandas(rows) for column in self.columns})
+        else:
+            arrays = {column.name: column.to_arrow(rows, self.arrow_schema.field(column.name).type)
+                for column in self.columns}
+            chunk = pa.RecordBatch.from_arrays(
+                [arrays[name] for name in self.arrow_schema.names], schema=self.arrow_schema)
+        for column in self.columns:
+            column.clear()
+        self.rows = 0
+        return chunk
+
+# File object handed to copy_expert, passing blocks on to a queue
+class CopyWriter:
+    def __init__(self):
+        self.blocks = queue.Queue(maxsize=copy_queue_size)
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise IOError("copy reader closed")
+        self.blocks.put(bytes(data))
+        return len(data)
+
+# Function which streams results of a query in DF or arrow chunks through
+# binary COPY. Same interface as read_psql_db_chunks.
+def read_psql_db_copy_chunks(sql, params=None, chunk_size=dt.db_chunk_size, arrow_schema=None):
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    writer = CopyWriter()
+    thread = None
+    try:
+        cursor = conn.cursor()
+        # Column types of the result, the binary format carries none
+        cursor.execute(f"SELECT * FROM ({sql}) AS q LIMIT 0", params)
+        names = [desc[0] for desc in cursor.description]
+        type_oids = [desc[1] for desc in cursor.description]
+        decoder = CopyDecoder(names, type_oids, chunk_size, arrow_schema)
+        copy_sql = f"COPY ({cursor.mogrify(sql, params).decode()}) TO STDOUT WITH (FORMAT binary)"
+
+        errors = []
+        def copy():
+            try:
+                cursor.copy_expert(copy_sql, writer)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                writer.blocks.put(None)
+        thread = threading.Thread(target=copy, daemon=True)
+        thread.start()
+
+        while True:
+            block = writer.blocks.get()
+            if block is None:
+                break
+            for chunk in decoder.feed(block):
+                yield chunk
+        if len(errors) > 0:
+            raise errors[0]
+        if decoder.rows > 0:
+            yield decoder.flush()
+        cursor.close()
+        conn.rollback()
+    finally:
+        # Stop a copy that is still running when the reader is closed early
+        writer.closed = True
+        if thread is not None:
+            while thread.is_alive():
+                try:
+                    writer.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        conn.close()
+        dt.release_pg_connections(reserved)
+
+# Read a whole query result into one DF through binary COPY, an
+# alternative to read_psql_db
+def read_psql_db_copy(sql, params=None):
+    chunks = list(read_psql_db_copy_chunks(sql, params))
+    if len(chunks) == 0:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,161 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# In memory and on disk cache of data catalog entries and tags. Changes
+# mark the cache dirty and are written to disk at most every
+# CATALOG_CACHE_FLUSH_INTERVAL seconds and when the process exits.
+import atexit
+import json
+import os
+import threading
+import time
+from google.cloud import datacatalog_v1
+
+# Cache file and time to live in seconds, disk cache is disabled when no file is set
+cache_file = os.getenv('CATALOG_CACHE_FILE')
+cache_ttl = int(os.getenv('CATALOG_CACHE_TTL', '3600'))
+cache_flush_interval = float(os.getenv('CATALOG_CACHE_FLUSH_INTERVAL', '60'))
+
+# Cached values by section and key: {"fetched_at": ..., "value": ...}
+cache = {"entries": {}, "tags": {}, "resources": {}}
+cache_lock = threading.Lock()
+cache_loaded = False
+cache_dirty = False
+last_flush = time.time()
+
+# Writes of the cache file, one at a time
+flush_lock = threading.Lock()
+
+# Message type of cached values per section
+message_types = {
+    "entries": datacatalog_v1.Entry,
+    "tags": datacatalog_v1.Tag,
+    "resources": datacatalog_v1.Entry,
+}
+
+def to_json(section, value):
+    message_type = message_types[section]
+    if isinstance(value, list):
+        return [message_type.to_json(item) for item in value]
+    return message_type.to_json(value)
+
+def from_json(section, value):
+    message_type = message_types[section]
+    if isinstance(value, list):
+        return [message_type.from_json(item) for item in value]
+    return message_type.from_json(value)
+
+# Load disk cache once, dropping expired values
+def load_cache():
+    global cache_loaded
+    if cache_loaded:
+        return
+    cache_loaded = True
+    if cache_file is None or not os.path.exists(cache_file):
+        return
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+        now = time.time()
+        for section in cache:
+            for key, item in data.get(section, {}).items():
+                if now - item["fetched_at"] < cache_ttl:
+                    cache[section][key] = {
+                        "fetched_at": item["fetched_at"],
+                        "value": from_json(section, item["value"]),
+                    }
+    except Exception as e:
+        print(f"Cannot read catalog cache {cache_file}: {e}")
+
+# Write cache to disk when it changed since the last write. Values are
+# copied under the cache lock and written outside of it, so lookups from
+# other threads are not held up by the disk.
+def flush_cache():
+    global cache_dirty, last_flush
+    if cache_file is None:
+        return
+    with flush_lock:
+        with cache_lock:
+            if not cache_dirty:
+                return
+            items = {section: dict(cache[section]) for section in cache}
+            cache_dirty = False
+            last_flush = time.time()
+        data = {}
+        for section, section_items in items.items():
+            data[section] = {}
+            for key, item in section_items.items():
+                data[section][key] = {
+                    "fetched_at": item["fetched_at"],
+                    "value": to_json(section, item["value"]),
+                }
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, cache_file)
+
+atexit.register(flush_cache)
+
+# Mark the cache changed, called with the cache lock held. Returns whether
+# the periodic flush is due.
+def mark_dirty():
+    global cache_dirty
+    cache_dirty = True
+    return time.time() - last_flush >= cache_flush_interval
+
+# Get the keys of a section that are cached and not expired
+def get_cached_keys(section, keys):
+    with cache_lock:
+        load_cache()
+        now = time.time()
+        return {key for key in keys
+            if key in cache[section] and now - cache[section][key]["fetched_at"] < cache_ttl}
+
+# Get cached value, None when missing or expired
+def get_cached(section, key):
+    with cache_lock:
+        load_cache()
+        item = cache[section].get(key)
+        if item is None or time.time() - item["fetched_at"] >= cache_ttl:
+            return None
+        return item["value"]
+
+# Store values in the cache, values is a dict of key to value
+def put_cached(section, values):
+    with cache_lock:
+        load_cache()
+        now = time.time()
+        for key, value in values.items():
+            cache[section][key] = {"fetched_at": now, "value": value}
+        flush = mark_dirty()
+    if flush:
+        flush_cache()
+
+# Drop a cached value, used when the catalog is written to
+def invalidate(section, key):
+    with cache_lock:
+        load_cache()
+        flush = cache[section].pop(key, None) is not None and mark_dirty()
+    if flush:
+        flush_cache()
+
+# Drop all cached values
+def clear_cache():
+    global cache_dirty
+    with cache_lock:
+        for section in cache:
+            cache[section].clear()
+        cache_dirty = False
+        if cache_file is not None and os.path.exists(cache_file):
+            os.remove(cache_file)
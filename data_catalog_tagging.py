@@ -13,25 +13,59 @@
 # limitations under the License.
 
 # Import required modules.
-import json
+import copy
 import os
+import random
+import threading
+import time
+import concurrent.futures
 from google.cloud import datacatalog_v1
-from google.api_core.exceptions import PermissionDenied
+from google.api_core.exceptions import PermissionDenied, ResourceExhausted, ServiceUnavailable, TooManyRequests
 from google.cloud.datacatalog_v1.types import Tag
-
-# Load json config from file
-def load_json_file(filename):
-    f = open(filename)
-    data = json.load(f)
-    f.close()
-    return data
-
-# Load table config
-file = os.getenv('BQ_TABLE_CONFIG')
-conf = load_json_file(file)
-
-# Create data catalog client with default credentials
-client = datacatalog_v1.DataCatalogClient()
+import data_catalog_cache as cache
+import config_engine
+from resource_manager import get_datacatalog_client
+
+# Concurrency, request rate and retries of tagging calls, kept below data catalog quotas
+tagging_workers = int(os.getenv('TAGGING_WORKERS', '8'))
+tagging_rate = float(os.getenv('TAGGING_RATE', '10'))
+tagging_max_retries = int(os.getenv('TAGGING_MAX_RETRIES', '5'))
+
+rate_lock = threading.Lock()
+next_request_time = 0.0
+
+# Wait for the next request slot so that calls stay under tagging_rate per second
+def wait_for_rate_limit():
+    global next_request_time
+    with rate_lock:
+        now = time.monotonic()
+        wait = next_request_time - now
+        next_request_time = max(now, next_request_time) + 1.0 / tagging_rate
+    if wait > 0:
+        time.sleep(wait)
+
+# Call a data catalog method under the rate limit, retrying quota errors
+# with exponential backoff and jitter
+def call_with_retry(method, **kwargs):
+    for attempt in range(tagging_max_retries + 1):
+        wait_for_rate_limit()
+        try:
+            return method(**kwargs)
+        except (ResourceExhausted, TooManyRequests, ServiceUnavailable) as e:
+            if attempt == tagging_max_retries:
+                raise
+            delay = min(2 ** attempt, 60) + random.uniform(0, 1)
+            print(f"Data catalog quota error, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+# Run func for every item in a bounded thread pool and return the results in order
+def run_concurrently(func, items):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=tagging_workers) as executor:
+        return list(executor.map(func, items))
+
+
+# Allowed write dispositions, WRITE_MERGE upserts on the postgresql primary key
+write_dispositions = ["WRITE_APPEND", "WRITE_TRUNCATE", "WRITE_MERGE"]
 
 # Creates a tag template for Data Replication
 def create_tag_template(values):
@@ -99,7 +133,7 @@ def create_tag_template(values):
 
     tag_template.fields["write_disposition"] = datacatalog_v1.types.TagTemplateField()
     tag_template.fields["write_disposition"].display_name = "Write disposition"
-    for display_name in ["WRITE_APPEND", "WRITE_TRUNCATE"]:
+    for display_name in write_dispositions:
         enum_value = datacatalog_v1.types.FieldType.EnumType.EnumValue(
             display_name=display_name
         )
@@ -116,7 +150,7 @@ def create_tag_template(values):
     )
 
     try:
-        tag_template = client.create_tag_template(
+        tag_template = get_datacatalog_client().create_tag_template(
             parent=f"projects/{project_id}/locations/{location}",
             tag_template_id=tag_template_id,
             tag_template=tag_template,
@@ -141,7 +175,7 @@ def get_tag_template(values):
     )
 
     try:
-        response = client.get_tag_template(request=request)
+        response = get_datacatalog_client().get_tag_template(request=request)
         return response
     except PermissionDenied as e:
         print(f"Cannot get template: {e.message}")
@@ -154,8 +188,33 @@ def get_or_create_tag_template(values):
     if response == None:
         return create_tag_template(values)
     else:
+        add_write_dispositions(response)
         return response
 
+# Add write dispositions missing from a template created by an older version
+def add_write_dispositions(tag_template):
+    if "write_disposition" not in tag_template.fields:
+        return
+    field = tag_template.fields["write_disposition"]
+    existing = [value.display_name for value in field.type_.enum_type.allowed_values]
+    missing = [name for name in write_dispositions if name not in existing]
+    if len(missing) == 0:
+        return
+    for display_name in missing:
+        field.type_.enum_type.allowed_values.append(
+            datacatalog_v1.types.FieldType.EnumType.EnumValue(display_name=display_name)
+        )
+    request = datacatalog_v1.UpdateTagTemplateFieldRequest(
+        name=f"{tag_template.name}/fields/write_disposition",
+        tag_template_field=field,
+        update_mask={"paths": ["type.enum_type"]},
+    )
+    try:
+        get_datacatalog_client().update_tag_template_field(request=request)
+        print(f"Added write dispositions {missing} to template: {tag_template.name}")
+    except Exception as e:
+        print(f"Cannot update template field write_disposition: {e}")
+
 # Get entries from entry group
 def get_entries(values):
     project_id = values.get("project_id")
@@ -167,35 +226,56 @@ def get_entries(values):
         parent=resource_name,
     )
 
+    cached = cache.get_cached("entries", resource_name)
+    if cached is not None:
+        return cached
+
     try:
-        response = client.list_entries(request=request)
-        return response
+        response = list(get_datacatalog_client().list_entries(request=request))
     except Exception as e:
         print(f"Cannot get entries: {e.message}")
         return None
 
+    # Prefetch tags of the tables in the same pass. Data catalog has no bulk
+    # tag listing, so this is one list_tags call per table, run
+    # concurrently, for tables whose tags are not cached yet.
+    table_names = [entry.name for entry in response if entry.user_specified_type == "table"]
+    cached_names = cache.get_cached_keys("tags", table_names)
+    table_names = [entry_name for entry_name in table_names if entry_name not in cached_names]
+    tags = {}
+    for entry_name, entry_tags in zip(table_names, run_concurrently(fetch_tags, table_names)):
+        if entry_tags is not None:
+            tags[entry_name] = entry_tags
+    cache.put_cached("tags", tags)
+    cache.put_cached("entries", {resource_name: response})
+    return response
+
 # Get entry from data catalog by entry name
 def get_entry(entry_name):
+    cached = cache.get_cached("resources", entry_name)
+    if cached is not None:
+        return cached
+
     request = datacatalog_v1.GetEntryRequest(
         name=entry_name,
     )
     try:
-        response = client.get_entry(request=request)
+        response = get_datacatalog_client().get_entry(request=request)
+        cache.put_cached("resources", {entry_name: response})
         return response
     except Exception as e:
         print(f"Cannot get entry: {e.message}")
         return None
 
-# List tags for entry
-def list_tags(entry_id):
-    client = datacatalog_v1.DataCatalogClient()
+# Fetch tags for entry from data catalog
+def fetch_tags(entry_id):
     # Initialize request argument(s)
     request = datacatalog_v1.ListTagsRequest(
         parent=entry_id,
     )
 
     try:
-        page_result = client.list_tags(request=request)
+        page_result = call_with_retry(get_datacatalog_client().list_tags, request=request)
         tags = []
         for response in page_result:
             tags.append(response)
@@ -204,12 +284,47 @@ def list_tags(entry_id):
         print(f"Cannot get tags: {e.message}")
         return None
 
+# List tags for entry, served from the catalog cache when possible
+def list_tags(entry_id):
+    cached = cache.get_cached("tags", entry_id)
+    if cached is not None:
+        return cached
+
+    tags = fetch_tags(entry_id)
+    if tags is not None:
+        cache.put_cached("tags", {entry_id: tags})
+    return tags
+
+
+# Set a string field on the tag of an entry created from tag_template_name.
+# The cached tag only changes once the catalog accepted the update, and a
+# failed update raises, so callers never go on with a value that was not
+# saved.
+def update_tag_string_field(entry_name, tag_template_name, field_name, value):
+    tags = list_tags(entry_name)
+    if tags is None:
+        raise RuntimeError(f"Cannot update tag field {field_name}: cannot list tags of [{entry_name}]")
+    for index, tag in enumerate(tags):
+        if tag.template == tag_template_name:
+            tag = copy.deepcopy(tag)
+            tag.fields[field_name] = datacatalog_v1.types.TagField()
+            tag.fields[field_name].string_value = value
+            request = datacatalog_v1.UpdateTagRequest(
+                tag=tag,
+                update_mask={"paths": ["fields"]},
+            )
+            try:
+                response = call_with_retry(get_datacatalog_client().update_tag, request=request)
+            except Exception as e:
+                raise RuntimeError(f"Cannot update tag field {field_name} of [{entry_name}]: {e}") from e
+            cache.put_cached("tags", {entry_name: tags[:index] + [response] + tags[index + 1:]})
+            return response
+    raise RuntimeError(f"Cannot update tag field {field_name}: [{entry_name}] is not tagged with [{tag_template_name}]")
 
-# Get table config from Json file
+
+# Get resolved table config of a source table
 def get_table_config(source_table):
-    for i in conf['table_config']:
-        if i['table'] == source_table:
-            return i
+    return config_engine.get_table_config(source_table)
 
 
 # Create table tags with default values
@@ -251,15 +366,19 @@ def create_table_tags(tag_values):
             tag_values.get('schema_name'), 
             tag_values.get('table_name')])
 
-    if (get_table_config(source_table) != None):
+    table_config = get_table_config(source_table)
+    if table_config is not None and 'partition_column' in table_config:
         tag.fields['destination_partition_column'] = datacatalog_v1.types.TagField()
-        tag.fields['destination_partition_column'].string_value = get_table_config(source_table)['partition_column']
+        tag.fields['destination_partition_column'].string_value = table_config['partition_column']
 
+        clustering_columns = table_config.get('clustering_columns', '')
+        if isinstance(clustering_columns, list):
+            clustering_columns = ','.join(clustering_columns)
         tag.fields['destination_clustering_columns'] = datacatalog_v1.types.TagField()
-        tag.fields['destination_clustering_columns'].string_value = get_table_config(source_table)['clustering_columns']
+        tag.fields['destination_clustering_columns'].string_value = clustering_columns
 
         tag.fields['destination_partition_type'] = datacatalog_v1.types.TagField()
-        tag.fields['destination_partition_type'].string_value = get_table_config(source_table)['partition_type']
+        tag.fields['destination_partition_type'].string_value = table_config.get('partition_type', 'DAY')
         
 
     request = datacatalog_v1.CreateTagRequest(
@@ -268,7 +387,8 @@ def create_table_tags(tag_values):
     )
 
     try:    
-        response = client.create_tag(request=request)
+        response = call_with_retry(get_datacatalog_client().create_tag, request=request)
+        cache.invalidate("tags", tag_values.get('entry_id'))
         print(f"Tagged table [{tag_values.get('table_name')}] with template [{tag_values.get('tag_template')}]")
         return response
     except Exception as e:
@@ -303,11 +423,20 @@ def get_psql_metadata(project_id, location, metadata_template_id, tag):
 def tag_entry_group_tables(values):
     tag_template = get_or_create_tag_template(values)  
     entries = get_entries(values)
+    tables = [entry for entry in entries if entry.user_specified_type == "table"]
 
-    for entry in entries:
-        if entry.user_specified_type == "table":
-            process_table_tags(entry, values, tag_template.name)
-    return None
+    # Tag tables concurrently and count results
+    def process(entry):
+        try:
+            return process_table_tags(entry, values, tag_template.name)
+        except Exception as e:
+            print(f"Cannot tag [{entry.display_name}]: {e}")
+            return 'failed'
+
+    results = run_concurrently(process, tables)
+    counts = {status: results.count(status) for status in ('tagged', 'skipped', 'failed')}
+    print(f"Tagging done: {counts['tagged']} tagged, {counts['skipped']} skipped, {counts['failed']} failed")
+    return counts
 
 
 # Get sync mode based on timestamp column availability
@@ -336,7 +465,9 @@ def process_table_tags(entry, values, tag_template_name):
         #print(f"Table[{entry.name}] is already tagged with template[{tag.template}]")
 
         # Get source database and schema name
-        metadata = get_table_metadata(values, tag)
+        tag_metadata = get_table_metadata(values, tag)
+        if tag_metadata is not None:
+            metadata = tag_metadata
         
         # Check if table is tagged
         if tag_template_name == tag.template:
@@ -345,7 +476,7 @@ def process_table_tags(entry, values, tag_template_name):
 
     if not len(metadata) > 0:
         print(f"Skipped tagging [{entry.display_name}] due to missing postgresql table metadata")
-        return
+        return 'skipped'
 
     # Tag table
     if is_tagged == False:
@@ -358,7 +489,10 @@ def process_table_tags(entry, values, tag_template_name):
             "tag_template" : tag_template_name,
             "write_disposition" : 'WRITE_TRUNCATE'
         }
-        create_table_tags(tag_values)
+        if create_table_tags(tag_values) is None:
+            return 'failed'
+        return 'tagged'
+    return 'skipped'
 
 def get_bq_schema(entry_name):
     return None
@@ -371,7 +505,8 @@ def delete_tag_template(values):
         name=tag_template.name,
         force=True,
     )
-    client.delete_tag_template(request=request)
+    get_datacatalog_client().delete_tag_template(request=request)
+    cache.clear_cache()
 
 
 # Tag entry group tables
@@ -389,7 +524,7 @@ def tag_entry_group(
         "entry_group_id": entry_group_id, #postgresql
         "metadata_template_id": metadata_template_id, #postgresql_table_metadata
     }
-    tag_entry_group_tables(values)
+    return tag_entry_group_tables(values)
 
 # Get table schema
 def get_table_schema(project_id, location, entry_group_id, entry_id):
@@ -454,10 +589,15 @@ def get_bigquery_table(project_id, dataset_id, table_id):
     resource_name = (
         f"//bigquery.googleapis.com/projects/{project_id}"
         f"/datasets/{dataset_id}/tables/{table_id}")
+    cached = cache.get_cached("resources", resource_name)
+    if cached is not None:
+        return cached
+
     try:
-        table_entry = client.lookup_entry(
+        table_entry = get_datacatalog_client().lookup_entry(
         request={"linked_resource": resource_name}
         )
+        cache.put_cached("resources", {resource_name: table_entry})
         return table_entry
     except Exception as e:
         print(f"Cannot get bigquery table: {e.message}")
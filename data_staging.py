@@ -0,0 +1,255 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+import pyarrow as pa
+import pyarrow.parquet as pq
+import data_transfer as dt
+from checkpoint_transfer import get_job_state
+from resource_manager import get_bigquery_client, get_storage_client
+from schema_diff import get_schema_fingerprint
+import transfer_metrics as tm
+
+# Local spill directory, staging is disabled when not set
+staging_dir = os.getenv('STAGING_DIR')
+staging_row_group_size = int(os.getenv('STAGING_ROW_GROUP_SIZE', '100000'))
+staging_file_size = int(os.getenv('STAGING_FILE_SIZE', str(256 * 1024 * 1024)))
+
+# Optional bucket, staged files are loaded with a single job from gcs when set
+staging_bucket = os.getenv('STAGING_BUCKET')
+
+# Seconds after which a staged extract left by a failed load is read again
+staging_max_age = int(os.getenv('STAGING_MAX_AGE', '86400'))
+
+manifest_file_name = 'manifest.json'
+
+def staging_enabled():
+    return staging_dir is not None
+
+def get_staging_path(table_id):
+    return os.path.join(staging_dir, table_id)
+
+# Description of what a staged extract holds. An extract is only loaded
+# again for the same schema, projection and row filter.
+def get_staging_extract(schema, select, where, params):
+    return {
+        "schema_fingerprint": get_schema_fingerprint(schema),
+        "select": select,
+        "where": where,
+        "params": [str(param) for param in params],
+    }
+
+# Convert a DF or arrow chunk to an arrow table matching arrow_schema
+def chunk_to_arrow(chunk, schema, arrow_schema):
+    if isinstance(chunk, pa.RecordBatch):
+        return pa.Table.from_batches([chunk])
+    with tm.stage('cast'):
+        chunk = dt.cast_dataframe_columns(chunk, schema)
+    table = pa.Table.from_pandas(chunk, preserve_index=False)
+    return table.select(arrow_schema.names).cast(arrow_schema, safe=False)
+
+# Write chunks as compressed parquet files to the staging directory of a
+# table, rolling over to a new file every staging_file_size bytes. The
+# manifest is written last, so a staging directory with a manifest holds
+# a complete extract that can be loaded again without reading postgresql.
+def stage_chunks_to_parquet(table_id, chunks, schema, write_disposition, watermark_column=None, extract=None):
+    path = get_staging_path(table_id)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    arrow_schema = dt.get_arrow_schema(schema)
+    files = []
+    rows = 0
+    high_watermark = None
+    writer = None
+    for chunk in tm.timed_iter(chunks, 'extract'):
+        if writer is None:
+            file_name = os.path.join(path, f"part-{len(files):05d}.parquet")
+            writer = pq.ParquetWriter(file_name, arrow_schema, compression='snappy')
+            files.append(file_name)
+        table = chunk_to_arrow(chunk, schema, arrow_schema)
+        with tm.stage('serialize'):
+            writer.write_table(table, row_group_size=staging_row_group_size)
+        rows += len(chunk)
+        tm.add_rows(len(chunk))
+
+        if watermark_column is not None:
+            chunk_max = dt.get_chunk_max(chunk, watermark_column)
+            if chunk_max is not None and (high_watermark is None or chunk_max > high_watermark):
+                high_watermark = chunk_max
+
+        if os.path.getsize(file_name) >= staging_file_size:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+    # Keep one empty file so that truncating an empty source still works
+    if len(files) == 0:
+        file_name = os.path.join(path, "part-00000.parquet")
+        pq.write_table(arrow_schema.empty_table(), file_name)
+        files.append(file_name)
+
+    tm.add_bytes(sum(os.path.getsize(file_name) for file_name in files))
+    manifest = {
+        "table_id": table_id,
+        "run_id": uuid.uuid4().hex[:12],
+        "created_at": time.time(),
+        "extract": extract,
+        "files": files,
+        "rows": rows,
+        "write_disposition": write_disposition,
+        "high_watermark": None if high_watermark is None else dt.format_watermark(high_watermark),
+        "attempts": {},
+        "loaded": {},
+    }
+    save_staging_manifest(table_id, manifest)
+    print(f"staged {rows} rows of {table_id} in {len(files)} files")
+    return manifest
+
+# Write the manifest of a staged extract, replacing it in one step
+def save_staging_manifest(table_id, manifest):
+    manifest_path = os.path.join(get_staging_path(table_id), manifest_file_name)
+    with open(f"{manifest_path}.tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+# Get manifest of a complete staged extract, None if there is none. An
+# extract of another schema, projection or row filter, or one older than
+# staging_max_age, is removed instead.
+def read_staging_manifest(table_id, extract=None):
+    manifest_path = os.path.join(get_staging_path(table_id), manifest_file_name)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('extract') != extract or 'run_id' not in manifest \
+            or time.time() - manifest.get('created_at', 0) > staging_max_age:
+        print(f"discarding outdated staged extract of {table_id}")
+        remove_staged_files(table_id)
+        return None
+    return manifest
+
+# Upload staged files to the staging bucket and return their uris
+def upload_staged_files(table_id, files):
+    bucket = get_storage_client().bucket(staging_bucket)
+    uris = []
+    for file_name in files:
+        blob_name = f"{table_id}/{os.path.basename(file_name)}"
+        bucket.blob(blob_name).upload_from_filename(file_name)
+        uris.append(f"gs://{staging_bucket}/{blob_name}")
+    return uris
+
+# Deterministic load job id of a part of a staged extract
+def get_staged_job_id(table_id, manifest, key, attempt):
+    table_name = re.sub('[^a-zA-Z0-9_]', '_', table_id)
+    return f"pg2bq_staged_{table_name}_{manifest['run_id']}_{key}_{attempt}"
+
+# Load one part of a staged extract at most once. A job submitted by an
+# earlier run is waited for instead of being submitted again, and a failed
+# one is retried under a new job id. Progress is kept in the manifest.
+# destination_id is the table loaded, table_id by default.
+def load_staged_part(table_id, manifest, key, load, source, job_config, destination_id=None):
+    attempt = manifest['attempts'].get(key, 0)
+    job_state = get_job_state(get_staged_job_id(table_id, manifest, key, attempt))
+    if job_state == 'failed':
+        attempt += 1
+    if job_state != 'done':
+        manifest['attempts'][key] = attempt
+        save_staging_manifest(table_id, manifest)
+        with dt.bq_jobs:
+            with tm.stage('upload'):
+                job = dt.submit_load_job(load, source, destination_id or table_id, job_config,
+                    get_staged_job_id(table_id, manifest, key, attempt))
+            with tm.stage('job_wait'):
+                job.result()
+    manifest['loaded'][key] = get_staged_job_id(table_id, manifest, key, attempt)
+    save_staging_manifest(table_id, manifest)
+
+def get_staged_job_config(schema, write_disposition):
+    job_config = bigquery.LoadJobConfig()
+    job_config.write_disposition = write_disposition
+    job_config.schema = schema
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+    job_config.decimal_target_types = ['NUMERIC', 'BIGNUMERIC']
+    return job_config
+
+# Staging table a staged extract is loaded to before it replaces the
+# destination. It is kept in the manifest so a retry appends the remaining
+# files to it. When it expired, every file is loaded again under new job
+# ids.
+def get_staging_table(table_id, manifest, schema):
+    staging_table_id = manifest.get('staging_table')
+    if staging_table_id is not None:
+        try:
+            get_bigquery_client().get_table(staging_table_id)
+            return staging_table_id
+        except NotFound:
+            manifest['loaded'] = {}
+            manifest['attempts'] = {key: attempt + 1 for key, attempt in manifest['attempts'].items()}
+    manifest['staging_table'] = dt.create_staging_table(table_id, schema)
+    save_staging_manifest(table_id, manifest)
+    return manifest['staging_table']
+
+# Load a staged extract. With a staging bucket all files are loaded by one
+# job, otherwise files are loaded one by one from the local disk. A table
+# replaced by more than one local file is loaded to a staging table and
+# swapped in with one transaction, so a failed load leaves the table as it
+# was. Parts loaded by an earlier attempt are skipped, so a retry never
+# appends them twice.
+def load_staged_files(table_id, manifest, schema):
+    client = get_bigquery_client()
+    if staging_bucket is not None:
+        if 'all' not in manifest['loaded']:
+            with tm.stage('upload'):
+                uris = upload_staged_files(table_id, manifest['files'])
+            load_staged_part(table_id, manifest, 'all', client.load_table_from_uri, uris,
+                get_staged_job_config(schema, manifest['write_disposition']))
+    else:
+        destination_id = table_id
+        write_disposition = manifest['write_disposition']
+        if write_disposition == 'WRITE_TRUNCATE' and len(manifest['files']) > 1:
+            destination_id = get_staging_table(table_id, manifest, schema)
+            write_disposition = 'WRITE_APPEND'
+        for index, file_name in enumerate(manifest['files']):
+            key = f"{index:05d}"
+            if key in manifest['loaded']:
+                continue
+            # Only the first file replaces the table, later files append to it
+            with open(file_name, 'rb') as f:
+                load_staged_part(table_id, manifest, key, client.load_table_from_file, f,
+                    get_staged_job_config(schema, write_disposition if index == 0 else 'WRITE_APPEND'),
+                    destination_id)
+        if destination_id != table_id:
+            dt.replace_rows_from_staging(table_id, destination_id, schema)
+            client.delete_table(destination_id, not_found_ok=True)
+    print(f"loaded {manifest['rows']} staged rows into {table_id}")
+    return manifest['rows'], manifest['high_watermark']
+
+# Remove staged files after a successful load
+def remove_staged_files(table_id):
+    if staging_bucket is not None:
+        bucket = get_storage_client().bucket(staging_bucket)
+        for blob in bucket.list_blobs(prefix=f"{table_id}/"):
+            blob.delete()
+    shutil.rmtree(get_staging_path(table_id), ignore_errors=True)
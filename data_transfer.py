@@ -14,15 +14,26 @@
 # limitations under the License.
 
 from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
+from google.api_core.exceptions import Conflict
 
+import datetime
+import io
+import itertools
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import psycopg2 as pg
 import pandas as pd
-import sqlalchemy
-import pg8000
 import os
+import math
+import uuid
+import multiprocessing
+import threading
+from collections import deque
 import data_catalog_tagging as dc
+from resource_manager import get_bigquery_client, get_psql_engine, get_psql_settings, get_source, get_table_lock
+import transfer_metrics as tm
 
 db_user = os.getenv('DB_USER')
 db_pass = os.getenv('DB_PASS')
@@ -30,30 +41,404 @@ db_host = os.getenv('DB_HOST')
 db_port = os.getenv('DB_PORT')
 db_name = os.getenv('DB_NAME')
 
-client = bigquery.Client()
+# Location of the bigquery datasets, jobs are looked up there
+bq_location = os.getenv('BQ_LOCATION')
+
+# Number of rows fetched from the server-side cursor per chunk
+db_chunk_size = int(os.getenv('DB_CHUNK_SIZE', '100000'))
+
+# Default extraction format, 'pandas' or 'arrow'
+extract_format = os.getenv('EXTRACT_FORMAT', 'pandas')
+
+# Default extraction reader, 'cursor' for a server-side cursor or 'copy'
+# for binary COPY
+extract_reader = os.getenv('EXTRACT_READER', 'cursor')
+
+# Arrow types used for bigquery field types on the arrow path
+arrow_type_lookup = {}
+arrow_type_lookup['STRING'] = pa.string()
+arrow_type_lookup['INT64'] = pa.int64()
+arrow_type_lookup['INTEGER'] = pa.int64()
+arrow_type_lookup['NUMERIC'] = pa.decimal128(38, 9)
+arrow_type_lookup['BIGDECIMAL'] = pa.decimal256(76, 38)
+arrow_type_lookup['BIGNUMERIC'] = pa.decimal256(76, 38)
+arrow_type_lookup['TIMESTAMP'] = pa.timestamp('us')
+arrow_type_lookup['BOOLEAN'] = pa.bool_()
+arrow_type_lookup['BOOL'] = pa.bool_()
+
+# Limits shared by all tables processed concurrently
+pg_max_connections = int(os.getenv('PG_MAX_CONNECTIONS', '8'))
+bq_max_jobs = int(os.getenv('BQ_MAX_JOBS', '4'))
+
+pg_connections = threading.BoundedSemaphore(pg_max_connections)
+pg_acquire_lock = threading.Lock()
+bq_jobs = threading.BoundedSemaphore(bq_max_jobs)
+
+# Staging tables expire on their own if a run dies before dropping them
+staging_table_expiration = datetime.timedelta(days=1)
+
+# Reserve postgresql connections. Permits for one caller are taken under a
+# lock so that two tables can never deadlock holding part of what they need.
+def acquire_pg_connections(count=1):
+    count = min(count, pg_max_connections)
+    with pg_acquire_lock:
+        for i in range(count):
+            pg_connections.acquire()
+    return count
+
+def release_pg_connections(count=1):
+    for i in range(count):
+        pg_connections.release()
 
 # Function which reads from our DB and returns results in DF
 def read_psql_db(sql):
-    url = sqlalchemy.engine.url.URL.create(
-            drivername="postgresql",
-            username=db_user,
-            password=db_pass,
-            host=db_host,
-            port=db_port,
-            database=db_name)
-    engine = sqlalchemy.create_engine(url)
-    df = pd.read_sql(sql, con=engine)
+    df = pd.read_sql(sql, con=get_psql_engine())
     return df
 
-def write_df_to_bigquery(table_id, df, schema, write_disposition):
+# Build arrow schema from bigquery schema
+def get_arrow_schema(schema):
+    return pa.schema([
+        pa.field(field.name, arrow_type_lookup[field.field_type])
+        for field in schema])
+
+# Turn fetched rows into a chunk: a DF, or an arrow record batch decoded
+# column by column straight into the arrow types when arrow_schema is set
+def rows_to_chunk(rows, columns, arrow_schema=None):
+    if arrow_schema is None:
+        return pd.DataFrame.from_records(rows, columns=columns)
+    values = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+    arrays = {}
+    for name, column_values in zip(columns, values):
+        arrays[name] = pa.array(column_values, type=arrow_schema.field(name).type)
+    return pa.RecordBatch.from_arrays(
+        [arrays[name] for name in arrow_schema.names], schema=arrow_schema)
+
+# Function which streams results from our DB in DF chunks of bounded size.
+# Rows are fetched through a server-side (named) cursor so that only one
+# chunk is held in memory at a time.
+def read_psql_db_chunks(sql, params=None, chunk_size=db_chunk_size, arrow_schema=None):
+    reserved = acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor(name=f"bq_transfer_{uuid.uuid4().hex}")
+        cursor.itersize = chunk_size
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            columns = [desc[0] for desc in cursor.description]
+            yield rows_to_chunk(rows, columns, arrow_schema)
+        cursor.close()
+    finally:
+        conn.close()
+        release_pg_connections(reserved)
+
+# Open a psycopg2 connection to the current source
+def connect_psql(settings=None):
+    if settings is None:
+        settings = get_psql_settings(get_source())
+    return pg.connect(**settings)
+
+# Get primary key columns of a source table as (name, type) pairs in key order
+def get_primary_key(cursor, source_table):
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_index i
+        JOIN pg_attribute a
+            ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+        ORDER BY array_position(i.indkey::int2[], a.attnum)""", (source_table,))
+    return cursor.fetchall()
+
+# Get integer primary key column of a source table, None if the table has
+# no single column integer primary key
+def get_integer_primary_key(cursor, source_table):
+    rows = get_primary_key(cursor, source_table)
+    if len(rows) == 1 and rows[0][1] in ('smallint', 'integer', 'bigint'):
+        return rows[0][0]
+    return None
+
+# Split a source table into key ranges. Uses the integer primary key when
+# there is one, ctid page ranges otherwise. Each range holds roughly
+# chunk_size rows and there are at least as many ranges as workers.
+def get_table_ranges(cursor, source_table, workers, chunk_size):
+    cursor.execute(
+        "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+        (source_table,))
+    estimated_rows = max(cursor.fetchone()[0], 0)
+    range_count = max(workers, math.ceil(estimated_rows / chunk_size))
+
+    key = get_integer_primary_key(cursor, source_table)
+    if key is not None:
+        cursor.execute(f'SELECT min("{key}"), max("{key}") FROM {source_table}')
+        low, high = cursor.fetchone()
+        if low is None:
+            return []
+        step = max(math.ceil((high - low + 1) / range_count), 1)
+        ranges = []
+        for start in range(low, high + 1, step):
+            ranges.append((f'"{key}" >= %s AND "{key}" < %s', (start, start + step)))
+        return ranges
+
+    cursor.execute("""
+        SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::int""",
+        (source_table,))
+    pages = cursor.fetchone()[0]
+    step = max(math.ceil(pages / range_count), 1)
+    ranges = []
+    for start in range(0, pages, step):
+        ranges.append((
+            "ctid >= %s::tid AND ctid < %s::tid",
+            (f"({start},0)", f"({start + step},0)")))
+    # Last range is open ended to pick up pages added after the size lookup
+    if len(ranges) > 0:
+        ranges[-1] = ("ctid >= %s::tid", ranges[-1][1][:1])
+    else:
+        ranges.append(("TRUE", ()))
+    return ranges
+
+# Chunks streamed by the range worker processes, set by init_range_worker
+range_chunks = None
+
+def init_range_worker(queue):
+    global range_chunks
+    range_chunks = queue
+
+# Worker process: stream one key range inside the exported snapshot. Rows
+# are fetched chunk_size at a time through a named cursor and put on the
+# queue, followed by ('done', None) or ('done', error) for the range.
+def read_psql_range(args):
+    snapshot_id, sql, params, arrow_schema, settings, chunk_size = args
+    error = None
+    try:
+        conn = connect_psql(settings)
+        try:
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            cursor = conn.cursor()
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+            cursor.close()
+            cursor = conn.cursor(name='range_cursor')
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                columns = [desc[0] for desc in cursor.description]
+                range_chunks.put(('chunk', rows_to_chunk(rows, columns, arrow_schema)))
+            cursor.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        # Postgresql errors do not always pickle, pass the message on
+        error = f"{type(e).__name__}: {e}"
+    range_chunks.put(('done', error))
+
+# Function which reads a table in parallel key ranges and yields DF chunks.
+# All workers import the coordinator snapshot (pg_export_snapshot) so the
+# chunks together are a consistent copy of the table. Workers stream their
+# range in chunk_size pieces through a queue of `workers` chunks, so memory
+# stays bounded however large a range turns out to be. Worker processes
+# are spawned, forking a process with threads and live clients can hang.
+def read_psql_db_parallel(source_table, workers, select='*', where=None, params=(), chunk_size=db_chunk_size, arrow_schema=None):
+    # Coordinator plus one connection per worker
+    reserved = acquire_pg_connections(workers + 1)
+    workers = max(reserved - 1, 1)
+    # Worker processes connect with the settings of the coordinator source
+    settings = get_psql_settings(get_source())
+    conn = connect_psql(settings)
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_export_snapshot()")
+        snapshot_id = cursor.fetchone()[0]
+        ranges = get_table_ranges(cursor, source_table, workers, chunk_size)
+        print(f"reading {source_table} in {len(ranges)} ranges with {workers} workers")
+
+        tasks = deque()
+        for range_predicate, range_params in ranges:
+            predicate = range_predicate
+            if where is not None:
+                predicate = f"({where}) AND {range_predicate}"
+            sql = f"SELECT {select} FROM {source_table} WHERE {predicate}"
+            tasks.append((snapshot_id, sql, tuple(params) + tuple(range_params), arrow_schema, settings, chunk_size))
+
+        context = multiprocessing.get_context('spawn')
+        queue = context.Queue(maxsize=workers)
+        with context.Pool(processes=workers, initializer=init_range_worker, initargs=(queue,)) as pool:
+            running = 0
+            while len(tasks) > 0 or running > 0:
+                while len(tasks) > 0 and running < workers:
+                    # A task that cannot start still ends its range
+                    pool.apply_async(read_psql_range, (tasks.popleft(),),
+                        error_callback=lambda e: queue.put(('done', f"{type(e).__name__}: {e}")))
+                    running += 1
+                kind, value = queue.get()
+                if kind == 'done':
+                    running -= 1
+                    if value is not None:
+                        raise RuntimeError(f"reading a range of {source_table} failed: {value}")
+                elif len(value) > 0:
+                    yield value
+    finally:
+        # Snapshot stays valid until the coordinator transaction ends
+        conn.close()
+        release_pg_connections(reserved)
+
+# Submit a load job. A job_id that was already submitted is not loaded
+# again, the existing job is returned instead.
+def submit_load_job(load, source, table_id, job_config, job_id=None):
+    try:
+        return load(source, table_id, job_config=job_config, job_id=job_id)
+    except Conflict:
+        if job_id is None:
+            raise
+        print(f"load job {job_id} already exists, waiting for it")
+        return get_bigquery_client().get_job(job_id, location=bq_location)
+
+# Upload a DF and start its load job without waiting for it
+def start_df_load(table_id, df, schema, write_disposition, job_id=None):
     job_config = bigquery.LoadJobConfig()
     job_config.write_disposition = write_disposition
     job_config.schema = schema
 
-    job = client.load_table_from_dataframe(
-        df, table_id, job_config=job_config
-    )
-    job.result()
+    # The client serializes the DF during the upload call
+    with tm.stage('upload'):
+        return submit_load_job(get_bigquery_client().load_table_from_dataframe,
+            df, table_id, job_config, job_id)
+
+def write_df_to_bigquery(table_id, df, schema, write_disposition, job_id=None):
+    with bq_jobs:
+        job = start_df_load(table_id, df, schema, write_disposition, job_id)
+        with tm.stage('job_wait'):
+            job.result()
+
+# Upload an arrow record batch as parquet and start its load job without
+# waiting for it
+def start_arrow_load(table_id, batch, schema, write_disposition, job_id=None):
+    job_config = bigquery.LoadJobConfig()
+    job_config.write_disposition = write_disposition
+    job_config.schema = schema
+    job_config.source_format = bigquery.SourceFormat.PARQUET
+    job_config.decimal_target_types = ['NUMERIC', 'BIGNUMERIC']
+
+    with tm.stage('serialize'):
+        buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_batches([batch]), buffer, compression='snappy')
+        tm.add_bytes(buffer.tell())
+        buffer.seek(0)
+
+    with tm.stage('upload'):
+        return submit_load_job(get_bigquery_client().load_table_from_file,
+            buffer, table_id, job_config, job_id)
+
+# Write an arrow record batch to bigquery as parquet
+def write_arrow_to_bigquery(table_id, batch, schema, write_disposition, job_id=None):
+    with bq_jobs:
+        job = start_arrow_load(table_id, batch, schema, write_disposition, job_id)
+        with tm.stage('job_wait'):
+            job.result()
+
+# Get highest value of a column in a DF or arrow chunk
+def get_chunk_max(chunk, column):
+    if isinstance(chunk, pa.RecordBatch):
+        return pc.max(chunk.column(column)).as_py()
+    value = chunk[column].max()
+    return None if pd.isna(value) else value
+
+# Cast and write DF or arrow chunks one at a time. The first chunk uses the
+# requested write disposition, following chunks are appended to it. Returns
+# the number of rows loaded and the highest value seen in watermark_column.
+def load_chunks_to_bigquery(table_id, chunks, schema, write_disposition, watermark_column=None):
+    rows = 0
+    high_watermark = None
+    for chunk in chunks:
+        if isinstance(chunk, pa.RecordBatch):
+            write_arrow_to_bigquery(table_id, chunk, schema, write_disposition)
+        else:
+            with tm.stage('cast'):
+                chunk = cast_dataframe_columns(chunk, schema)
+            tm.add_bytes(int(chunk.memory_usage(index=False, deep=True).sum()))
+            write_df_to_bigquery(table_id, chunk, schema, write_disposition)
+        rows += len(chunk)
+        tm.add_rows(len(chunk))
+        write_disposition = 'WRITE_APPEND'
+        print(f"loaded {rows} rows into {table_id}")
+
+        if watermark_column is not None:
+            chunk_max = get_chunk_max(chunk, watermark_column)
+            if chunk_max is not None and (high_watermark is None or chunk_max > high_watermark):
+                high_watermark = chunk_max
+
+    # Source table is empty, truncate destination table anyway
+    if rows == 0 and write_disposition == 'WRITE_TRUNCATE':
+        df = pd.DataFrame(columns=[field.name for field in schema])
+        df = cast_dataframe_columns(df, schema)
+        write_df_to_bigquery(table_id, df, schema, write_disposition)
+    return rows, high_watermark
+
+# Write DF or arrow chunks to bigquery. A table replaced by more than one
+# chunk is loaded to a staging table first and swapped in with a single
+# transaction, so a failed load leaves the previous rows in place.
+# Partition decorators are written directly, a failed partition is
+# truncated again by the next run. Returns the number of rows loaded and
+# the highest value seen in watermark_column.
+def write_chunks_to_bigquery(table_id, chunks, schema, write_disposition, watermark_column=None):
+    chunks = tm.timed_iter(chunks, 'extract')
+    if write_disposition != 'WRITE_TRUNCATE' or '$' in table_id:
+        return load_chunks_to_bigquery(table_id, chunks, schema, write_disposition, watermark_column)
+
+    # Read ahead one chunk to find out whether the table fits a single load
+    head = list(itertools.islice(chunks, 2))
+    if len(head) < 2:
+        return load_chunks_to_bigquery(table_id, head, schema, write_disposition, watermark_column)
+
+    client = get_bigquery_client()
+    staging_table_id = create_staging_table(table_id, schema)
+    try:
+        rows, high_watermark = load_chunks_to_bigquery(
+            staging_table_id, itertools.chain(head, chunks), schema, 'WRITE_APPEND', watermark_column)
+        replace_rows_from_staging(table_id, staging_table_id, schema)
+        print(f"replaced {table_id} with {rows} rows")
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+    return rows, high_watermark
+
+# Create an empty staging table next to the destination table
+def create_staging_table(table_id, schema):
+    project, dataset, table_name = table_id.split('.')
+    staging_table_id = f"{project}.{dataset}._staging_{table_name}_{uuid.uuid4().hex[:8]}"
+    table = bigquery.Table(staging_table_id, schema)
+    table.expires = datetime.datetime.now(datetime.timezone.utc) + staging_table_expiration
+    get_bigquery_client().create_table(table)
+    return staging_table_id
+
+# Run a mutating statement on a destination table. Statements on the same
+# table run one at a time, so shards of a combined table do not conflict.
+def run_table_dml(table_id, sql):
+    with get_table_lock(table_id), bq_jobs:
+        with tm.stage('upload'):
+            job = get_bigquery_client().query(sql)
+        with tm.stage('job_wait'):
+            job.result()
+    return job
+
+# Replace the destination rows matching condition with the rows of a
+# staging table in one transaction
+def replace_rows_from_staging(table_id, staging_table_id, schema, condition='TRUE'):
+    columns = ', '.join(f"`{field.name}`" for field in schema)
+    sql = (
+        "BEGIN TRANSACTION;\n"
+        f"DELETE FROM `{table_id}` WHERE {condition};\n"
+        f"INSERT INTO `{table_id}` ({columns}) SELECT {columns} FROM `{staging_table_id}`;\n"
+        "COMMIT TRANSACTION;\n")
+    return run_table_dml(table_id, sql)
+
+# Format a watermark value so that postgresql can compare the column with it
+def format_watermark(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
 
 # Cast dataframe columns types
 def cast_dataframe_columns(df, schema):
@@ -14,12 +14,25 @@
 # limitations under the License.
 
 import sys
-import json
+import argparse
+import asyncio
 import os
-from google.cloud import datacatalog_v1, bigquery
+import concurrent.futures
+import signal
+from google.cloud import datacatalog_v1
 from google.cloud.exceptions import NotFound
 from data_catalog_tagging import *
-from data_transfer import *
+from resource_manager import *
+from schema_diff import *
+from sync_state import *
+import transfer_metrics as tm
+from transfer_planner import plan_tables, print_plan
+from sync_scheduler import SyncScheduler, parse_interval, daemon_interval
+from config_engine import get_sources, get_shards
+
+# The bigquery client and transfer modules load pandas, pyarrow and the
+# postgresql drivers. They are imported by the functions that move data,
+# so tagging, planning and catalog lookups start without them.
 
 project_id = os.getenv('PROJECT_ID')
 location = os.getenv('LOCATION')
@@ -35,6 +48,7 @@ db_port = os.getenv('DB_PORT')
 db_name = os.getenv('DB_NAME')
 
 api_prefix = os.getenv('API_PREFIX')
+table_workers = int(os.getenv('TABLE_WORKERS', '4'))
 field_lookup = {}
 field_lookup['integer'] = 'INT64'
 field_lookup['bigint'] = 'INT64'
@@ -44,13 +58,12 @@ field_lookup['character_varying'] = 'STRING'
 field_lookup['timestamp_without_time_zone'] = 'TIMESTAMP'
 field_lookup['boolean'] = 'BOOLEAN'
 
-datacatalog = datacatalog_v1.DataCatalogClient()
 
 def get_by_resource(linked_resource_name):
     request = datacatalog_v1.LookupEntryRequest(
         linked_resource=linked_resource_name,
     )
-    response = datacatalog.lookup_entry(request=request)
+    response = get_datacatalog_client().lookup_entry(request=request)
     return response
 
 def get_by_name(name):
@@ -58,7 +71,7 @@ def get_by_name(name):
     request = datacatalog_v1.LookupEntryRequest(
         linked_resource=resource,
     )
-    response = datacatalog.lookup_entry(request=request)
+    response = get_datacatalog_client().lookup_entry(request=request)
     return response
     
 def get_fields(table):
@@ -73,27 +86,22 @@ def get_field_names(table):
         fields.append(col.column)
     return fields
     
-def get_additive_fields(source_fields, dest_fields):
-    new_fields = []
-    for field in source_fields:
-        if field not in dest_fields:
-            new_fields.append(field)
-    return new_fields
-
 def postgres_field_to_bq(postgres_type):
     return field_lookup[postgres_type]
 
 def generate_bq_schema(pg_columns):
+    from google.cloud import bigquery
     bq_columns = []
     for col in pg_columns:
         bq_columns.append(bigquery.SchemaField(col.column, postgres_field_to_bq(col.type)))
     return bq_columns    
 
 def create_bq_table(full_table_name, columns):
-    client = bigquery.Client()
+    from google.cloud import bigquery
+    client = get_bigquery_client()
     name = full_table_name
     table = bigquery.Table(name, columns)
-    result = client.create_table(table)
+    result = client.create_table(table, exists_ok=True)
     return result
 
 def create_partitioned_bq_table(
@@ -103,7 +111,8 @@ def create_partitioned_bq_table(
         part_field, 
         clust_fields):
 
-    client = bigquery.Client()
+    from google.cloud import bigquery
+    client = get_bigquery_client()
     name = full_table_name
     table = bigquery.Table(name, columns)
 
@@ -115,7 +124,7 @@ def create_partitioned_bq_table(
     elif part_type == 'MONTH':
         type = bigquery.TimePartitioningType.MONTH
     elif part_type == 'YEAR':
-        type = bigquery.TimePartitioningType.MONTH
+        type = bigquery.TimePartitioningType.YEAR
 
     table.time_partitioning = bigquery.TimePartitioning(
         type_=type,
@@ -123,30 +132,45 @@ def create_partitioned_bq_table(
     )
 
     table.clustering_fields = clust_fields
-    result = client.create_table(table)
+    result = client.create_table(table, exists_ok=True)
     return result
 
-def update_bq_schema(full_table_name, target_schema):
-    client = bigquery.Client()
-    table = client.get_table(full_table_name)
-    table.schema = target_schema
-    result = client.update_table(table, ["schema"])
-    return result
+def update_bq_schema(table, diff):
+    client = get_bigquery_client()
+    if len(diff['conflicts']) > 0:
+        raise ValueError(f"incompatible type changes for {table.table_id}: {diff['conflicts']}")
+
+    # Add new columns first, the alter statements below change the table etag
+    if len(diff['added']) > 0:
+        table.schema = list(table.schema) + diff['added']
+        table = client.update_table(table, ["schema"])
+
+    for column, old_type, new_type in diff['widened']:
+        client.query(
+            f"ALTER TABLE `{table.project}.{table.dataset_id}.{table.table_id}` "
+            f"ALTER COLUMN `{column}` SET DATA TYPE {new_type}").result()
+        print(f"widened {table.table_id}.{column} from {old_type} to {new_type}")
+    return table
 
 def dataset_exists(full_dataset_name):
+    if is_known_dataset(full_dataset_name):
+        return True
     try:
-        client = bigquery.Client() 
+        client = get_bigquery_client()
         dataset = client.get_dataset(full_dataset_name)
+        add_known_dataset(full_dataset_name)
         return True
     except:
         return False
         
 def create_dataset(full_dataset_name):
+    from google.cloud import bigquery
     try:
-        client = bigquery.Client() 
+        client = get_bigquery_client()
         dataset = bigquery.Dataset(full_dataset_name)
         dataset.location = bq_location
-        client.create_dataset(dataset)
+        client.create_dataset(dataset, exists_ok=True)
+        add_known_dataset(full_dataset_name)
     except:
         print('Could not create dataset ' + full_dataset_name)
         exit(1)
@@ -157,73 +181,625 @@ def list_source_tables():
 def get_metadata(entry_name):
     return get_replication_metadata(project_id, location, entry_name, tag_template_id)
 
-###################################################
+# Postgresql sources as (name, entry group) pairs. Without configured
+# sources there is one unnamed source read with the DB_* settings.
+def list_sources():
+    sources = get_sources()
+    if len(sources) == 0:
+        return [(None, system)]
+    return [(name, source['entry_group']) for name, source in sources.items()]
+
+def tag_sources():
+    for source, entry_group in list_sources():
+        tag_entry_group(project_id, location, tag_template_id, entry_group, metadata_template_id)
+
+# Source table entries of all sources as (source, entry) pairs
+def list_all_source_tables():
+    tables = []
+    for source, entry_group in list_sources():
+        for src_table in get_entrygroup_tables(project_id, location, entry_group):
+            tables.append((source, src_table))
+    return tables
+
+# Replication metadata of a table, with the name of its source
+def get_source_metadata(source, entry_name):
+    metadata = get_metadata(entry_name)
+    if metadata is not None:
+        metadata = dict(metadata, source=source)
+    return metadata
+
+# Table name for messages, prefixed with the source in multi-source runs
+def get_display_name(src_table, metadata):
+    if metadata.get('source') is None:
+        return src_table.display_name
+    return f"{metadata['source']}.{src_table.display_name}"
+
+def get_table_option(source_table, option, default):
+    table_config = get_table_config(source_table)
+    if table_config is not None and option in table_config:
+        return table_config[option]
+    return default
+
+def set_last_synced(entry_name, value):
+    tag_template_name = f"projects/{project_id}/locations/{location}/tagTemplates/{tag_template_id}"
+    return update_tag_string_field(entry_name, tag_template_name, 'last_synced', value)
+
+def get_chunk_size(source_table):
+    from data_transfer import db_chunk_size
+    return int(get_table_option(source_table, 'chunk_size', db_chunk_size))
+
+def get_parallel_workers(source_table):
+    return int(get_table_option(source_table, 'parallel_workers', 1))
+
+def get_extract_format(source_table):
+    from data_transfer import extract_format
+    return get_table_option(source_table, 'extract_format', extract_format)
+
+def get_extract_reader(source_table):
+    from data_transfer import extract_reader
+    return get_table_option(source_table, 'extract_reader', extract_reader)
+
+def is_checkpointed(source_table):
+    return bool(get_table_option(source_table, 'checkpoint', False))
+
+def get_incremental_column(source_table):
+    return get_table_option(source_table, 'incremental_column', None)
+
+def is_change_detection(source_table):
+    import change_detection
+    return bool(get_table_option(source_table, 'change_detection', change_detection.change_detection))
+
+def is_partition_overwrite(source_table):
+    return bool(get_table_option(source_table, 'partition_overwrite', False))
+
+# Split a CSV option value or list into column names
+def split_columns(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [column.strip() for column in value if len(column.strip()) > 0]
+
+# Source columns to transfer: include_columns when set, minus exclude_columns
+# and, when drop_pii is set, the pii_columns of the table tag and config
+def get_projected_fields(source_table, metadata, pg_columns):
+    include = split_columns(get_table_option(source_table, 'include_columns', None))
+    exclude = set(split_columns(get_table_option(source_table, 'exclude_columns', None)))
+    if get_table_option(source_table, 'drop_pii', False):
+        exclude.update(split_columns(metadata.get('pii_columns')))
+        exclude.update(split_columns(get_table_option(source_table, 'pii_columns', None)))
+
+    if len(include) > 0:
+        names = [col.column for col in pg_columns]
+        missing = [column for column in include if column not in names]
+        if len(missing) > 0:
+            raise ValueError(f"include_columns of {source_table} not in source table: {missing}")
+        by_name = {col.column: col for col in pg_columns}
+        pg_columns = [by_name[column] for column in include]
+    return [col for col in pg_columns if col.column not in exclude]
+
+# Select list for the projected fields, * when every column is transferred
+def get_select_list(pg_columns, projected_fields):
+    if len(projected_fields) == len(pg_columns):
+        return '*'
+    return ', '.join(f'"{col.column}"' for col in projected_fields)
+
+def get_row_filter(source_table):
+    return get_table_option(source_table, 'where', None)
 
-def main():
-    # Tag source tables with replication template
-    tag_entry_group(project_id, location, tag_template_id, system, metadata_template_id)
-
-    # Get postgresql table list
-    source_tables = list_source_tables()
+###################################################
 
-    # Sync schema
-    for src_table in source_tables:
+# Create destination table or bring its schema in line with the source.
+# Nothing is requested from bigquery when the source schema fingerprint is
+# the same as at the last successful sync. Tables shared by several
+# sources are changed by one source at a time.
+def sync_bq_schema(src_table, metadata, bq_table_name, bq_schema):
+    with get_table_lock(bq_table_name):
+        sync_bq_table_schema(src_table, metadata, bq_table_name, bq_schema)
 
-        #Process table
-        print(f'processing table {src_table.display_name}')
+def sync_bq_table_schema(src_table, metadata, bq_table_name, bq_schema):
+    fingerprint = get_schema_fingerprint(bq_schema)
+    if get_table_state(bq_table_name).get('schema_fingerprint') == fingerprint:
+        print(f'no schema changes detected for {src_table.display_name}')
+        return
 
-        metadata = get_metadata(src_table.name)
+    try:
+        dst_table = get_bigquery_client().get_table(bq_table_name)
+    except NotFound:
+        dst_table = None
+
+    if dst_table is None:
+        print('need to create ' + bq_table_name)
+        if dataset_exists(project_id + '.' + metadata['destination_dataset']) is False:
+            create_dataset(project_id + '.' + metadata['destination_dataset'])
+
+        if 'destination_partition_column' in metadata:
+            part_type = metadata['destination_partition_type']
+            part_col = metadata['destination_partition_column']
+            clust_cols = metadata['destination_clustering_columns'].split(',')
+            table = create_partitioned_bq_table(bq_table_name, bq_schema, part_type, part_col, clust_cols)
+            print('created partitioned table ' + bq_table_name)
+        
+        else:
+            table = create_bq_table(bq_table_name, bq_schema)
+            print('created table ' + bq_table_name)                
+        
+    else:
+        diff = diff_schema(bq_schema, dst_table.schema)
+        if not has_changes(diff):
+            print(f'no schema changes detected for {src_table.display_name}')
+            
+        else:
+            update_bq_schema(dst_table, diff)
+            print(f'schema updated for {src_table.display_name}: '
+                f'{len(diff["added"])} added, {len(diff["widened"])} widened')
+
+    update_table_state(bq_table_name, schema_fingerprint=fingerprint)
+
+# Metrics name of a table, the entry id is unique within the entry group.
+# With several sources the entry group is added.
+def get_metrics_name(src_table):
+    parts = src_table.name.split('/')
+    if len(get_sources()) > 0:
+        return f"{parts[-3]}.{parts[-1]}"
+    return parts[-1]
+
+# Sync schema and data of one source table and record its metrics
+def sync_table(src_table, metadata, plan):
+    metrics_name = get_metrics_name(src_table)
+    tm.start_table(metrics_name)
+    use_source(metadata.get('source'))
+    try:
+        sync_table_data(src_table, metadata, plan)
+    except BaseException:
+        tm.finish_table(metrics_name, 'failure')
+        raise
+    metrics = tm.finish_table(metrics_name)
+    print(f"{src_table.display_name}: {metrics['rows']} rows in {metrics['duration_seconds']}s "
+        f"({metrics['rows_per_second']} rows/s)")
+
+# Sync schema and data of one source table
+def sync_table_data(src_table, metadata, plan):
+    transfer = prepare_table_transfer(src_table, metadata)
+    if transfer is None:
+        return
+    rows, high_watermark = write_table_transfer(transfer, plan)
+    complete_table_transfer(src_table, transfer, rows, high_watermark)
+
+# Sync the destination schema and work out what to read from a source
+# table. Returns None when the table does not need to be transferred.
+def prepare_table_transfer(src_table, metadata):
+    from google.cloud import bigquery
+    import change_detection
+    from data_transfer import get_arrow_schema
+    from data_staging import staging_enabled
+    #Process table
+    print(f'processing table {get_display_name(src_table, metadata)}')
+
+    # Tables of a source go to the destination of their own tags, or with
+    # combined shards to one table with a shard column
+    shard = None
+    if metadata.get('source') is not None and get_shards()['mode'] == 'combined':
+        shard = (get_shards()['column'], metadata['source'])
+        metadata = dict(metadata, destination_dataset=get_shards()['dataset'])
+
+    bq_table_name = ".".join([project_id, \
+                            metadata['destination_dataset'], \
+                            metadata['destination_table']])
+    # Only projected columns are read from postgresql and sent to bigquery
+    source_table = metadata['source_table']
+    pg_columns = get_fields(src_table)
+    projected_fields = get_projected_fields(source_table, metadata, pg_columns)
+    select = get_select_list(pg_columns, projected_fields)
+    bq_schema = generate_bq_schema(projected_fields)
+    state_id = bq_table_name
+    if shard is not None:
+        if is_partition_overwrite(source_table) or is_checkpointed(source_table) or staging_enabled():
+            raise ValueError(f"partition_overwrite, checkpoint and staging are not supported "
+                f"with combined shards ({source_table})")
+        select = f"{select}, '{shard[1]}' AS \"{shard[0]}\""
+        bq_schema = bq_schema + [bigquery.SchemaField(shard[0], 'STRING')]
+        state_id = f"{bq_table_name}#{shard[1]}"
+    with tm.stage('schema_sync'):
+        sync_bq_schema(src_table, metadata, bq_table_name, bq_schema)
+
+    # Row filter from the table config is applied by postgresql
+    write_disposition = get_table_option(source_table, 'write_disposition', metadata['write_disposition'])
+    row_filter = get_row_filter(source_table)
+    where = row_filter
+    params = ()
+
+    # Incremental tables only read rows past the last synced high-water mark
+    incremental_column = get_incremental_column(source_table)
+    projected_types = {col.column: col.type for col in projected_fields}
+    if incremental_column is not None and incremental_column not in projected_types:
+        raise ValueError(f"incremental_column {incremental_column} of {source_table} is not projected")
+    incremental = incremental_column is not None and bool(metadata.get('last_synced'))
+    if incremental:
+        watermark = f'"{incremental_column}" > %s'
+        where = watermark if where is None else f"({where}) AND {watermark}"
+        params = (metadata['last_synced'],)
+        if write_disposition != 'WRITE_MERGE':
+            write_disposition = 'WRITE_APPEND'
+        print(f"incremental sync of {source_table} from {incremental_column} > {metadata['last_synced']}")
+
+    # Full reloads are skipped when the source fingerprint did not change
+    # since the last successful load
+    data_fingerprint = None
+    if write_disposition == 'WRITE_TRUNCATE' and is_change_detection(source_table):
+        data_fingerprint = change_detection.get_data_fingerprint(
+            source_table, select, where, params, get_schema_fingerprint(bq_schema),
+            get_table_option(source_table, 'change_column', None),
+            bool(get_table_option(source_table, 'change_checksum', False)))
+        if data_fingerprint is not None and get_table_state(state_id).get('data_fingerprint') == data_fingerprint:
+            print(f"no data changes detected for {source_table}, skipping load")
+            return None
+
+    # Arrow tables are decoded straight into arrow record batches
+    arrow_schema = None
+    if get_extract_format(source_table) == 'arrow':
+        arrow_schema = get_arrow_schema(bq_schema)
+
+    # A combined table is replaced one shard at a time
+    replace_shard = shard is not None and write_disposition == 'WRITE_TRUNCATE'
+
+    return {
+        "bq_table_name": bq_table_name,
+        "state_id": state_id,
+        "shard": shard,
+        "replace_shard": replace_shard,
+        "bq_schema": bq_schema,
+        "source_table": source_table,
+        "select": select,
+        "row_filter": row_filter,
+        "where": where,
+        "params": params,
+        "write_disposition": write_disposition,
+        "incremental": incremental,
+        "incremental_column": incremental_column,
+        "incremental_type": projected_types.get(incremental_column),
+        "data_fingerprint": data_fingerprint,
+        "arrow_schema": arrow_schema,
+        "chunk_size": get_chunk_size(source_table),
+    }
+
+# Whether a transfer is a plain chunked read and load, without merges,
+# partition rewrites, checkpoints, staging or parallel readers
+def is_chunked_transfer(transfer, plan):
+    from data_staging import staging_enabled
+    source_table = transfer['source_table']
+    return transfer['write_disposition'] != 'WRITE_MERGE' \
+        and not is_partition_overwrite(source_table) \
+        and not is_checkpointed(source_table) \
+        and not staging_enabled() \
+        and not transfer['replace_shard'] \
+        and get_extract_reader(source_table) == 'cursor' \
+        and plan['workers'] <= 1
+
+# Read a prepared transfer from postgresql and write it to bigquery.
+# Returns the number of rows loaded and the highest incremental value.
+def write_table_transfer(transfer, plan):
+    from data_transfer import read_psql_db_chunks, read_psql_db_parallel, write_chunks_to_bigquery
+    from data_staging import (staging_enabled, get_staging_extract, read_staging_manifest,
+        stage_chunks_to_parquet, load_staged_files, remove_staged_files)
+    from copy_extract import read_psql_db_copy_chunks
+    from merge_transfer import write_merge_to_bigquery, replace_shard_in_bigquery
+    from partition_transfer import write_partitions_to_bigquery
+    from checkpoint_transfer import write_checkpointed_to_bigquery
+    bq_table_name = transfer['bq_table_name']
+    bq_schema = transfer['bq_schema']
+    source_table = transfer['source_table']
+    select = transfer['select']
+    where = transfer['where']
+    params = transfer['params']
+    write_disposition = transfer['write_disposition']
+    incremental_column = transfer['incremental_column']
+    arrow_schema = transfer['arrow_schema']
+    chunk_size = transfer['chunk_size']
+
+    # Stream records data from source table in chunks
+    workers = plan['workers']
+    if workers > 1:
+        print(f"reading records from source table {source_table} with {workers} workers")
+        chunks = read_psql_db_parallel(source_table, workers, select=select, where=where, params=params,
+            chunk_size=chunk_size, arrow_schema=arrow_schema)
+    else:
+        sql = f"SELECT {select} FROM {source_table}"
+        if where is not None:
+            sql = f"{sql} WHERE {where}"
+        print(f"reading records from source table: {sql}")
+        if get_extract_reader(source_table) == 'copy':
+            chunks = read_psql_db_copy_chunks(sql, params, chunk_size=chunk_size, arrow_schema=arrow_schema)
+        else:
+            chunks = read_psql_db_chunks(sql, params, chunk_size=chunk_size, arrow_schema=arrow_schema)
+
+    # Write to bigquery with a merge on the primary key, as a replaced
+    # shard, partition by partition, range by range with checkpoints, or
+    # through local parquet files when staging is enabled. A complete
+    # staged extract left by a failed load is loaded again as is.
+    if write_disposition == 'WRITE_MERGE':
+        rows, high_watermark = write_merge_to_bigquery(
+            bq_table_name, source_table, chunks, bq_schema, not transfer['incremental'], incremental_column,
+            transfer['shard'])
+    elif transfer['replace_shard']:
+        rows, high_watermark = replace_shard_in_bigquery(
+            bq_table_name, chunks, bq_schema, transfer['shard'], incremental_column)
+    elif is_partition_overwrite(source_table):
+        rows, high_watermark = write_partitions_to_bigquery(
+            bq_table_name, source_table, bq_schema,
+            get_table_option(source_table, 'partition_type', 'DAY'),
+            get_table_option(source_table, 'partition_column', None),
+            select, transfer['row_filter'], where, params, chunk_size, arrow_schema, incremental_column)
+    elif is_checkpointed(source_table):
+        rows, high_watermark = write_checkpointed_to_bigquery(
+            bq_table_name, source_table, bq_schema, write_disposition, where, params,
+            chunk_size, arrow_schema, incremental_column, select)
+    elif staging_enabled():
+        extract = get_staging_extract(bq_schema, select, where, params)
+        manifest = read_staging_manifest(bq_table_name, extract)
+        if manifest is None:
+            manifest = stage_chunks_to_parquet(
+                bq_table_name, chunks, bq_schema, write_disposition, incremental_column, extract)
+        else:
+            print(f"reusing staged extract of {bq_table_name}")
+        rows, high_watermark = load_staged_files(bq_table_name, manifest, bq_schema)
+        remove_staged_files(bq_table_name)
+    else:
+        rows, high_watermark = write_chunks_to_bigquery(
+            bq_table_name, chunks, bq_schema, write_disposition, incremental_column)
+    return rows, high_watermark
+
+# Record a successful transfer. A high-water mark that cannot be saved
+# fails the table, the next run would load the same rows again.
+def complete_table_transfer(src_table, transfer, rows, high_watermark):
+    from data_transfer import format_watermark
+    bq_table_name = transfer['bq_table_name']
+    print(f"load job completed for {bq_table_name} ({rows} rows)")
+
+    # Advance the high-water mark only after the load succeeded
+    if high_watermark is not None:
+        set_last_synced(src_table.name, format_watermark(high_watermark))
+        print(f"last_synced for {transfer['source_table']} advanced to {format_watermark(high_watermark)}")
+    if transfer['data_fingerprint'] is not None:
+        update_table_state(transfer['state_id'], data_fingerprint=transfer['data_fingerprint'])
+
+def main(dry_run=False):
+    # Tag source tables with replication template
+    if not dry_run:
+        tag_sources()
+
+    # Get postgresql table list of every source
+    source_tables = list_all_source_tables()
+
+    # Collect replication metadata of tables enabled for sync
+    tables = []
+    for source, src_table in source_tables:
+        with tm.lookup(get_metrics_name(src_table)):
+            metadata = get_source_metadata(source, src_table.name)
+        if metadata is None:
+            print('not tagged for replication: ' + src_table.display_name)
+            tm.discard_table(get_metrics_name(src_table))
+            continue
         if metadata['sync_enabled'] is False:
             print('sync not enabled for ' + src_table.display_name)
+            tm.discard_table(get_metrics_name(src_table))
             continue
-
-        bq_table_name = ".".join([project_id, \
-                                metadata['destination_dataset'], \
-                                metadata['destination_table']])
-        src_fields = get_field_names(src_table)
-        dst_table = get_bigquery_table(
-            project_id, 
-            metadata['destination_dataset'], 
-            metadata['destination_table'])
-
-        if dst_table is None:
-            print('need to create ' + bq_table_name)
-            if dataset_exists(project_id + '.' + metadata['destination_dataset']) is False:
-                create_dataset(project_id + '.' + metadata['destination_dataset'])
-            new_schema = generate_bq_schema(get_fields(src_table))
-
-            if 'destination_partition_column' in metadata:
-                part_type = metadata['destination_partition_type']
-                part_col = metadata['destination_partition_column']
-                clust_cols = metadata['destination_clustering_columns'].split(',')
-                table = create_partitioned_bq_table(bq_table_name, new_schema, part_type, part_col, clust_cols)
-                print('created partitioned table ' + bq_table_name)
-            
-            else:
-                table = create_bq_table(bq_table_name, new_schema)
-                print('created table ' + bq_table_name)                
-            
-        else:
-            dst_fields = get_field_names(dst_table)
-            new_fields = get_additive_fields(src_fields, dst_fields)
-            if len(new_fields) == 0:
-                print(f'no schema changes detected for {src_table.display_name}')
-                
+        tables.append((src_table, metadata))
+
+    # Plan strategies and start the longest tables first so the run is
+    # bound by the slowest table
+    planned = plan_tables(tables)
+    if dry_run:
+        print_plan(planned, table_workers)
+        for src_table, metadata in tables:
+            tm.discard_table(get_metrics_name(src_table))
+        return {}
+
+    # Sync tables of all sources concurrently, TABLE_WORKERS at a time. One
+    # table failure does not stop the run.
+    failures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=table_workers) as executor:
+        futures = {}
+        for src_table, metadata, plan in planned:
+            print(f"planned {plan['source_table']}: {plan['strategy']} with {plan['workers']} workers, "
+                f"estimated {plan['estimated_seconds']}s")
+            future = executor.submit(sync_table, src_table, metadata, plan)
+            futures[future] = get_display_name(src_table, metadata)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except BaseException as e:
+                failures[futures[future]] = e
+                print(f"sync failed for {futures[future]}: {e}")
+
+    close_resources()
+    print(f"synced {len(tables) - len(failures)} of {len(tables)} tables")
+    for table_name, error in failures.items():
+        print(f"failed: {table_name}: {error}")
+    return failures
+
+# Sync one table, found by source table name (schema.table) or entry
+# display name, without tagging or listing metadata of the other tables
+def main_table(table_name):
+    for source, src_table in list_all_source_tables():
+        with tm.lookup(get_metrics_name(src_table)):
+            metadata = get_source_metadata(source, src_table.name)
+        if metadata is not None and table_name in (
+                metadata.get('source_table'), src_table.display_name, get_display_name(src_table, metadata)):
+            break
+        tm.discard_table(get_metrics_name(src_table))
+    else:
+        print(f"table {table_name} not found or not tagged for replication")
+        return {table_name: LookupError(table_name)}
+
+    failures = {}
+    try:
+        src_table, metadata, plan = plan_tables([(src_table, metadata)])[0]
+        sync_table(src_table, metadata, plan)
+    except Exception as e:
+        failures[get_display_name(src_table, metadata)] = e
+        print(f"sync failed for {get_display_name(src_table, metadata)}: {e}")
+    close_resources()
+    return failures
+
+# Sync one table on the event loop. Plain chunked transfers are read with
+# asyncpg, other write modes run their blocking path in the executor.
+async def sync_table_async(pools, poller, jobs, src_table, metadata, plan):
+    import async_transfer
+    metrics_name = get_metrics_name(src_table)
+    tm.start_table(metrics_name)
+    use_source(metadata.get('source'))
+    try:
+        transfer = await asyncio.to_thread(prepare_table_transfer, src_table, metadata)
+        if transfer is not None:
+            if is_chunked_transfer(transfer, plan):
+                pool = await pools.get(metadata.get('source'))
+                rows, high_watermark = await async_transfer.write_transfer(pool, poller, jobs, transfer)
             else:
-                new_schema = generate_bq_schema(get_fields(src_table))
-                updated = update_bq_schema(bq_table_name, new_schema)
-                print(f'schema updated for {src_table.display_name}')
-                
-        # Read records data from source table
-        sql = f"SELECT * FROM {metadata['source_table']}"
-        print(f"reading records from source table: {sql}")
-        df = read_psql_db(sql)
-
-        # Write to bigquery
-        bq_schema = generate_bq_schema(get_fields(src_table))
-        df = cast_dataframe_columns(df, bq_schema)
-        write_df_to_bigquery(bq_table_name, df, bq_schema, metadata['write_disposition'])
-        print(f"load job completed for {bq_table_name}")
-
-main()
+                rows, high_watermark = await asyncio.to_thread(write_table_transfer, transfer, plan)
+            await asyncio.to_thread(complete_table_transfer, src_table, transfer, rows, high_watermark)
+    except BaseException:
+        tm.finish_table(metrics_name, 'failure')
+        raise
+    metrics = tm.finish_table(metrics_name)
+    print(f"{src_table.display_name}: {metrics['rows']} rows in {metrics['duration_seconds']}s "
+        f"({metrics['rows_per_second']} rows/s)")
+
+# Look up replication metadata of one table, None when sync is disabled
+async def get_metadata_async(catalog_calls, source, src_table):
+    async with catalog_calls:
+        with tm.lookup(get_metrics_name(src_table)):
+            metadata = await asyncio.to_thread(get_source_metadata, source, src_table.name)
+    if metadata is None:
+        print('not tagged for replication: ' + src_table.display_name)
+        tm.discard_table(get_metrics_name(src_table))
+        return None
+    if metadata['sync_enabled'] is False:
+        print('sync not enabled for ' + src_table.display_name)
+        tm.discard_table(get_metrics_name(src_table))
+        return None
+    return metadata
+
+# Same as main(), on one event loop with up to ASYNC_TABLE_WORKERS tables in flight
+async def main_async():
+    import async_transfer
+    from data_transfer import bq_max_jobs
+    asyncio.get_running_loop().set_default_executor(async_transfer.create_executor())
+    await asyncio.to_thread(tag_sources)
+    source_tables = await asyncio.to_thread(list_all_source_tables)
+
+    # Catalog lookups run concurrently, capped like the tagging calls
+    catalog_calls = asyncio.Semaphore(tagging_workers)
+    lookups = await asyncio.gather(*(get_metadata_async(catalog_calls, source, src_table)
+        for source, src_table in source_tables))
+    tables = [(src_table, metadata) for (source, src_table), metadata in zip(source_tables, lookups)
+        if metadata is not None]
+    planned = await asyncio.to_thread(plan_tables, tables)
+
+    pools = async_transfer.SourcePools()
+    poller = async_transfer.JobPoller()
+    jobs = asyncio.Semaphore(bq_max_jobs)
+    table_slots = asyncio.Semaphore(async_transfer.async_table_workers)
+
+    async def run_table(src_table, metadata, plan):
+        async with table_slots:
+            await sync_table_async(pools, poller, jobs, src_table, metadata, plan)
 
+    try:
+        results = await asyncio.gather(*(run_table(src_table, metadata, plan)
+            for src_table, metadata, plan in planned), return_exceptions=True)
+    finally:
+        await pools.close()
+
+    failures = {}
+    for (src_table, metadata, plan), result in zip(planned, results):
+        if isinstance(result, BaseException):
+            failures[get_display_name(src_table, metadata)] = result
+            print(f"sync failed for {get_display_name(src_table, metadata)}: {result}")
+
+    close_resources()
+    print(f"synced {len(tables) - len(failures)} of {len(tables)} tables")
+    for table_name, error in failures.items():
+        print(f"failed: {table_name}: {error}")
+    return failures
+
+# Sync every table on its own sync_interval until interrupted. Clients,
+# pools and caches stay warm between runs, and the table list is refreshed
+# every DAEMON_REFRESH.
+def main_daemon():
+    def list_tables():
+        tag_sources()
+        tables = {}
+        for source, src_table in list_all_source_tables():
+            metadata = get_source_metadata(source, src_table.name)
+            if metadata is None:
+                print('not tagged for replication: ' + src_table.display_name)
+            elif metadata['sync_enabled'] is not False:
+                tables[src_table.name] = (src_table, metadata)
+        return tables
+
+    def get_interval(table):
+        src_table, metadata = table
+        return parse_interval(get_table_option(metadata['source_table'], 'sync_interval', daemon_interval))
+
+    # Metadata is read again for every run, last_synced moves between runs
+    def sync_scheduled_table(table):
+        src_table, metadata = table
+        with tm.lookup(get_metrics_name(src_table)):
+            metadata = get_source_metadata(metadata['source'], src_table.name)
+        if metadata is None or metadata['sync_enabled'] is False:
+            tm.discard_table(get_metrics_name(src_table))
+            return
+        src_table, metadata, plan = plan_tables([(src_table, metadata)])[0]
+        sync_table(src_table, metadata, plan)
+
+    scheduler = SyncScheduler(list_tables, sync_scheduled_table, get_interval, table_workers)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: scheduler.stop())
+    scheduler.run()
+    close_resources()
+
+# Stream changes of all sync enabled tables into <destination_table>_changelog tables
+def main_cdc():
+    import cdc_stream
+    targets = {}
+    for src_table in list_source_tables():
+        metadata = get_metadata(src_table.name)
+        if metadata is None:
+            print('not tagged for replication: ' + src_table.display_name)
+            continue
+        if metadata['sync_enabled'] is False:
+            continue
+        changelog_table_name = ".".join([project_id, \
+                                metadata['destination_dataset'], \
+                                metadata['destination_table'] + '_changelog'])
+        # Changelogs hold the same columns as the batch transfer
+        projected_fields = get_projected_fields(metadata['source_table'], metadata, get_fields(src_table))
+        changelog_schema = generate_bq_schema(projected_fields) + cdc_stream.change_fields
+        sync_bq_schema(src_table, metadata, changelog_table_name, changelog_schema)
+        targets[metadata['source_table']] = {
+            "table_id": changelog_table_name,
+            "schema": changelog_schema,
+        }
+    cdc_stream.stream_changes(targets)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync postgresql tables to bigquery')
+    parser.add_argument('--dry-run', action='store_true',
+        help='print the transfer plan without writing anything')
+    parser.add_argument('--cdc', action='store_true',
+        help='stream changes from a logical replication slot until interrupted')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+        help='sync tables on one event loop, reading with asyncpg')
+    parser.add_argument('--daemon', action='store_true',
+        help='keep running and sync every table on its sync_interval')
+    args = parser.parse_args()
+    if args.cdc:
+        main_cdc()
+    elif args.daemon:
+        main_daemon()
+    elif args.use_async:
+        if len(asyncio.run(main_async())) > 0:
+            sys.exit(1)
+    elif len(main(dry_run=args.dry_run)) > 0:
+        sys.exit(1)
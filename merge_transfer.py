@@ -0,0 +1,98 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# WRITE_MERGE: rows are loaded to a temporary staging table and upserted
+# into the destination with a single MERGE on the postgresql primary key.
+# Shards of a combined table are replaced the same way, with one
+# transaction deleting the rows of the shard and inserting the staged rows.
+import data_transfer as dt
+from resource_manager import get_bigquery_client, get_psql_engine
+
+# Get primary key column names of a source table
+def get_primary_key_columns(source_table):
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        columns = [name for name, type_ in dt.get_primary_key(cursor, source_table)]
+        cursor.close()
+        conn.commit()
+        return columns
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+
+# Build the MERGE statement. When the staging table holds a full snapshot
+# of the source, destination rows missing from it were deleted in postgresql.
+# shard is a (column, value) pair limiting those deletes to one shard of a
+# combined table.
+def build_merge_sql(table_id, staging_table_id, schema, key_columns, full_snapshot, shard=None):
+    columns = [field.name for field in schema]
+    on = ' AND '.join(f"T.`{column}` = S.`{column}`" for column in key_columns)
+    updates = ', '.join(f"`{column}` = S.`{column}`" for column in columns if column not in key_columns)
+    insert_columns = ', '.join(f"`{column}`" for column in columns)
+    insert_values = ', '.join(f"S.`{column}`" for column in columns)
+
+    sql = f"MERGE `{table_id}` T\nUSING `{staging_table_id}` S\nON {on}\n"
+    if len(updates) > 0:
+        sql += f"WHEN MATCHED THEN UPDATE SET {updates}\n"
+    sql += f"WHEN NOT MATCHED THEN INSERT ({insert_columns}) VALUES ({insert_values})\n"
+    if full_snapshot and shard is not None:
+        sql += f"WHEN NOT MATCHED BY SOURCE AND T.`{shard[0]}` = '{shard[1]}' THEN DELETE\n"
+    elif full_snapshot:
+        sql += "WHEN NOT MATCHED BY SOURCE THEN DELETE\n"
+    return sql
+
+# Load chunks to a staging table and merge them into the destination.
+# Returns the number of rows staged and the highest watermark_column value.
+def write_merge_to_bigquery(table_id, source_table, chunks, schema, full_snapshot, watermark_column=None, shard=None):
+    key_columns = get_primary_key_columns(source_table)
+    if len(key_columns) == 0:
+        raise ValueError(f"WRITE_MERGE needs a primary key on {source_table}")
+    if shard is not None:
+        key_columns.append(shard[0])
+    missing = [column for column in key_columns if column not in [field.name for field in schema]]
+    if len(missing) > 0:
+        raise ValueError(f"WRITE_MERGE needs primary key columns {missing} of {source_table} in the projection")
+
+    client = get_bigquery_client()
+    staging_table_id = dt.create_staging_table(table_id, schema)
+    try:
+        rows, high_watermark = dt.write_chunks_to_bigquery(
+            staging_table_id, chunks, schema, 'WRITE_APPEND', watermark_column)
+
+        sql = build_merge_sql(table_id, staging_table_id, schema, key_columns, full_snapshot, shard)
+        job = dt.run_table_dml(table_id, sql)
+        print(f"merged {rows} rows into {table_id} on {', '.join(key_columns)}: "
+            f"{job.num_dml_affected_rows} rows affected")
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+    return rows, high_watermark
+
+# Replace the rows of one shard of a combined table. A failed load leaves
+# the shard as it was, the swap happens in a single transaction. Returns
+# the number of rows loaded and the highest watermark_column value.
+def replace_shard_in_bigquery(table_id, chunks, schema, shard, watermark_column=None):
+    client = get_bigquery_client()
+    staging_table_id = dt.create_staging_table(table_id, schema)
+    try:
+        rows, high_watermark = dt.write_chunks_to_bigquery(
+            staging_table_id, chunks, schema, 'WRITE_APPEND', watermark_column)
+
+        dt.replace_rows_from_staging(table_id, staging_table_id, schema, f"`{shard[0]}` = '{shard[1]}'")
+        print(f"replaced shard {shard[1]} of {table_id} with {rows} rows")
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+    return rows, high_watermark
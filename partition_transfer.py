@@ -0,0 +1,154 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Partition scoped loads. The partitions that hold changed rows are found
+# in postgresql, then every one of them is read in full and replaces its
+# destination partition through a partition decorator (table$YYYYMMDD).
+# Changed partitions are the partitions of rows past the incremental
+# watermark, or without an incremental column the partitions whose row
+# count and checksum differ from the last run.
+import concurrent.futures
+import os
+import data_transfer as dt
+import transfer_metrics as tm
+from resource_manager import get_psql_engine, get_source, use_source
+from sync_state import get_table_state, update_table_state
+
+partition_workers = int(os.getenv('PARTITION_WORKERS', '4'))
+
+# postgresql date_trunc unit, interval and bigquery decorator format per
+# partitioning type
+partition_units = {
+    'HOUR': ('hour', '1 hour', '%Y%m%d%H'),
+    'DAY': ('day', '1 day', '%Y%m%d'),
+    'MONTH': ('month', '1 month', '%Y%m'),
+    'YEAR': ('year', '1 year', '%Y'),
+}
+
+# Get the start of every partition with rows matching where. None stands
+# for the partition of rows without a partition column value.
+def get_changed_partitions(source_table, part_type, part_column, where=None, params=()):
+    unit = partition_units[part_type][0]
+    sql = f'SELECT DISTINCT date_trunc(\'{unit}\', "{part_column}") FROM {source_table}'
+    if where is not None:
+        sql = f"{sql} WHERE {where}"
+
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        partitions = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        conn.commit()
+        return partitions
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+
+# Row count and order independent checksum of the selected rows of every
+# partition, as (start, [count, checksum]) pairs. Like change_checksum this
+# reads the whole table, but nothing leaves postgresql.
+def get_partition_checksums(source_table, part_type, part_column, select='*', row_filter=None):
+    unit = partition_units[part_type][0]
+    sql = f'SELECT {select}, "{part_column}" AS "_pg2bq_partition" FROM {source_table}'
+    if row_filter is not None:
+        sql = f"{sql} WHERE {row_filter}"
+    sql = (f'SELECT date_trunc(\'{unit}\', t."_pg2bq_partition"), count(*), '
+        f'coalesce(sum(hashtext(t::text)::bigint), 0) FROM ({sql}) t GROUP BY 1')
+
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, ())
+        checksums = [(start, [int(count), int(checksum)]) for start, count, checksum in cursor.fetchall()]
+        cursor.close()
+        conn.commit()
+        return checksums
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+
+# Destination table id with the partition decorator of a partition start
+def get_partition_table_id(table_id, part_type, start):
+    if start is None:
+        return f"{table_id}$__NULL__"
+    return f"{table_id}${start.strftime(partition_units[part_type][2])}"
+
+# Predicate and parameters selecting the rows of one partition
+def get_partition_predicate(part_type, part_column, start):
+    if start is None:
+        return f'"{part_column}" IS NULL', ()
+    interval = partition_units[part_type][1]
+    return f'"{part_column}" >= %s AND "{part_column}" < %s::timestamp + interval \'{interval}\'', (start, start)
+
+# Read one partition and replace the destination partition with it
+def write_partition(table_id, source_table, schema, select, row_filter, part_type, part_column,
+        start, chunk_size, arrow_schema, watermark_column, metrics_table, source):
+    tm.bind_table(metrics_table)
+    use_source(source)
+    predicate, params = get_partition_predicate(part_type, part_column, start)
+    if row_filter is not None:
+        predicate = f"({row_filter}) AND {predicate}"
+    sql = f"SELECT {select} FROM {source_table} WHERE {predicate}"
+    chunks = dt.read_psql_db_chunks(sql, params, chunk_size=chunk_size, arrow_schema=arrow_schema)
+    partition_id = get_partition_table_id(table_id, part_type, start)
+    return dt.write_chunks_to_bigquery(partition_id, chunks, schema, 'WRITE_TRUNCATE', watermark_column)
+
+# Rewrite the partitions holding rows that match where. Without a
+# watermark_column the partitions whose checksum changed since the last
+# run are rewritten instead. row_filter limits the rows that are
+# transferred at all. Returns the number of rows loaded and the highest
+# watermark_column value.
+def write_partitions_to_bigquery(table_id, source_table, schema, part_type, part_column,
+        select='*', row_filter=None, where=None, params=(), chunk_size=dt.db_chunk_size,
+        arrow_schema=None, watermark_column=None):
+    if part_type not in partition_units:
+        raise ValueError(f"unsupported partition type {part_type} for {table_id}")
+    if part_column is None:
+        raise ValueError(f"partition_overwrite of {table_id} needs a partition_column")
+
+    checksums = None
+    if watermark_column is None:
+        checksums = {get_partition_table_id(table_id, part_type, start): (start, checksum)
+            for start, checksum in get_partition_checksums(source_table, part_type, part_column, select, row_filter)}
+        saved = get_table_state(table_id).get('partition_checksums', {})
+        partitions = [start for partition_id, (start, checksum) in checksums.items()
+            if saved.get(partition_id) != checksum]
+        print(f"{len(checksums) - len(partitions)} partitions of {table_id} are unchanged")
+    else:
+        partitions = get_changed_partitions(source_table, part_type, part_column, where, params)
+    print(f"rewriting {len(partitions)} partitions of {table_id}")
+
+    rows = 0
+    high_watermark = None
+    metrics_table = tm.get_bound_table()
+    source = get_source()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=partition_workers) as executor:
+        futures = [executor.submit(write_partition, table_id, source_table, schema, select, row_filter,
+                part_type, part_column, start, chunk_size, arrow_schema, watermark_column, metrics_table, source)
+            for start in partitions]
+        for future in concurrent.futures.as_completed(futures):
+            partition_rows, partition_watermark = future.result()
+            rows += partition_rows
+            if partition_watermark is not None and (high_watermark is None or partition_watermark > high_watermark):
+                high_watermark = partition_watermark
+
+    # Checksums are saved once every changed partition was rewritten
+    if checksums is not None:
+        update_table_state(table_id, partition_checksums={partition_id: checksum
+            for partition_id, (start, checksum) in checksums.items()})
+    return rows, high_watermark
@@ -0,0 +1,177 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared clients and connection pools, created on first use and reused by
+# all modules and threads for the lifetime of the process.
+# Client libraries are imported by the factories, so importing this
+# module stays cheap.
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+import config_engine
+
+db_user = os.getenv('DB_USER')
+db_pass = os.getenv('DB_PASS')
+db_host = os.getenv('DB_HOST')
+db_port = os.getenv('DB_PORT')
+db_name = os.getenv('DB_NAME')
+
+# Postgresql pool size and seconds after which pooled connections are renewed
+pg_pool_size = int(os.getenv('PG_POOL_SIZE', os.getenv('PG_MAX_CONNECTIONS', '8')))
+pg_pool_recycle = int(os.getenv('PG_POOL_RECYCLE', '1800'))
+
+resources = {}
+resources_lock = threading.Lock()
+
+# Datasets known to exist, so existence is checked once per run
+known_datasets = set()
+
+# Locks serializing schema changes and mutating DML per bigquery table
+table_locks = {}
+
+# Postgresql source used by the current thread or asyncio task, None for
+# the DB_* environment settings
+current_source = contextvars.ContextVar('current_source', default=None)
+
+# Get shared resource by name, creating it with factory on first use
+def get_resource(name, factory):
+    resource = resources.get(name)
+    if resource is None:
+        with resources_lock:
+            resource = resources.get(name)
+            if resource is None:
+                resource = factory()
+                resources[name] = resource
+    return resource
+
+# Replace a shared resource, for example with a local stand-in
+def set_resource(name, resource):
+    with resources_lock:
+        resources[name] = resource
+
+def create_bigquery_client():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+def create_datacatalog_client():
+    from google.cloud import datacatalog_v1
+    return datacatalog_v1.DataCatalogClient()
+
+def create_storage_client():
+    from google.cloud import storage
+    return storage.Client()
+
+def get_bigquery_client():
+    return get_resource('bigquery', create_bigquery_client)
+
+def get_datacatalog_client():
+    return get_resource('datacatalog', create_datacatalog_client)
+
+def get_storage_client():
+    return get_resource('storage', create_storage_client)
+
+# Read postgresql from a configured source in the current thread or task
+def use_source(name):
+    current_source.set(name)
+
+def get_source():
+    return current_source.get()
+
+# Use a source for the with block only
+@contextmanager
+def source_context(name):
+    token = current_source.set(name)
+    try:
+        yield
+    finally:
+        current_source.reset(token)
+
+# Connection settings of a source, from the environment for None
+def get_psql_settings(source=None):
+    if source is None:
+        return {
+            "user": db_user,
+            "password": db_pass,
+            "host": db_host,
+            "port": db_port,
+            "dbname": db_name,
+        }
+    settings = config_engine.get_config().sources[source]
+    return {
+        "user": settings.get('user', db_user),
+        "password": os.getenv(settings['password_env']) if 'password_env' in settings else db_pass,
+        "host": settings.get('host', db_host),
+        "port": settings.get('port', db_port),
+        "dbname": settings.get('database', db_name),
+    }
+
+# Build postgresql connection url of a source
+def get_psql_url(source=None):
+    import sqlalchemy
+    settings = get_psql_settings(source)
+    return sqlalchemy.engine.url.URL.create(
+            drivername="postgresql",
+            username=settings['user'],
+            password=settings['password'],
+            host=settings['host'],
+            port=settings['port'],
+            database=settings['dbname'])
+
+# Connection pool size of a source
+def get_psql_pool_size(source=None):
+    if source is None:
+        return pg_pool_size
+    return config_engine.get_config().sources[source].get('pool_size', pg_pool_size)
+
+# Pooled postgresql engine. Connections are checked with a ping before
+# they are handed out and renewed after pg_pool_recycle seconds.
+def create_psql_engine(source=None):
+    import sqlalchemy
+    return sqlalchemy.create_engine(
+        get_psql_url(source),
+        pool_size=get_psql_pool_size(source),
+        max_overflow=0,
+        pool_pre_ping=True,
+        pool_recycle=pg_pool_recycle)
+
+# Engine of the current source, every source has its own pool
+def get_psql_engine():
+    source = get_source()
+    if source is None:
+        return get_resource('psql_engine', create_psql_engine)
+    return get_resource(f'psql_engine:{source}', lambda: create_psql_engine(source))
+
+def is_known_dataset(full_dataset_name):
+    return full_dataset_name in known_datasets
+
+def add_known_dataset(full_dataset_name):
+    known_datasets.add(full_dataset_name)
+
+# Lock of a bigquery table. Tables written by several sources, like
+# combined shards, change their schema and rows under it one at a time.
+def get_table_lock(table_id):
+    with resources_lock:
+        return table_locks.setdefault(table_id, threading.Lock())
+
+# Close pools and clients
+def close_resources():
+    with resources_lock:
+        for name in list(resources):
+            resource = resources.pop(name)
+            if name.startswith('psql_engine'):
+                resource.dispose()
+            elif hasattr(resource, 'close'):
+                resource.close()
@@ -0,0 +1,76 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare source and destination bigquery schemas.
+import hashlib
+import json
+
+# Standard name of bigquery type aliases
+type_aliases = {}
+type_aliases['INTEGER'] = 'INT64'
+type_aliases['INT64'] = 'INT64'
+type_aliases['FLOAT'] = 'FLOAT64'
+type_aliases['FLOAT64'] = 'FLOAT64'
+type_aliases['DECIMAL'] = 'NUMERIC'
+type_aliases['NUMERIC'] = 'NUMERIC'
+type_aliases['BIGDECIMAL'] = 'BIGNUMERIC'
+type_aliases['BIGNUMERIC'] = 'BIGNUMERIC'
+type_aliases['BOOLEAN'] = 'BOOL'
+type_aliases['BOOL'] = 'BOOL'
+
+# Type changes bigquery can apply in place with ALTER COLUMN SET DATA TYPE
+type_widenings = {}
+type_widenings['INT64'] = ('NUMERIC', 'BIGNUMERIC', 'FLOAT64')
+type_widenings['NUMERIC'] = ('BIGNUMERIC', 'FLOAT64')
+
+def normalize_type(field_type):
+    return type_aliases.get(field_type.upper(), field_type.upper())
+
+# Fingerprint of a schema, changes whenever a column name or type changes.
+# Columns are compared by name like in diff_schema, so their order and
+# other field attributes do not change it.
+def get_schema_fingerprint(schema):
+    columns = sorted([field.name, normalize_type(field.field_type)] for field in schema)
+    return hashlib.sha256(json.dumps(columns).encode()).hexdigest()
+
+# Diff source schema against destination schema. Columns are indexed by
+# name so the diff is linear in the number of columns.
+def diff_schema(source_schema, dest_schema):
+    dest_fields = {field.name: field for field in dest_schema}
+    source_names = set()
+    diff = {"added": [], "widened": [], "conflicts": [], "removed": []}
+
+    for field in source_schema:
+        source_names.add(field.name)
+        dest_field = dest_fields.get(field.name)
+        if dest_field is None:
+            diff["added"].append(field)
+            continue
+        source_type = normalize_type(field.field_type)
+        dest_type = normalize_type(dest_field.field_type)
+        if source_type == dest_type:
+            continue
+        if source_type in type_widenings.get(dest_type, ()):
+            diff["widened"].append((field.name, dest_type, source_type))
+        else:
+            diff["conflicts"].append((field.name, dest_type, source_type))
+
+    for field in dest_schema:
+        if field.name not in source_names:
+            diff["removed"].append(field)
+    return diff
+
+def has_changes(diff):
+    return len(diff["added"]) > 0 or len(diff["widened"]) > 0 or len(diff["conflicts"]) > 0
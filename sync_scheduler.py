@@ -0,0 +1,134 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Scheduler for daemon mode. Tables wait in a heap ordered by their next
+# due time and are handed to a fixed worker pool. A table is never synced
+# twice at the same time, and nothing is submitted while all workers are
+# busy, so a slow run delays the queue instead of piling up work.
+import concurrent.futures
+import heapq
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+daemon_interval = os.getenv('DAEMON_INTERVAL', '1h')
+daemon_jitter = float(os.getenv('DAEMON_JITTER', '0.1'))
+daemon_refresh = os.getenv('DAEMON_REFRESH', '10m')
+
+interval_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Parse an interval in seconds, or with an s, m, h or d suffix
+def parse_interval(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', str(value))
+    if match is None:
+        raise ValueError(f"invalid interval {value}")
+    return float(match.group(1)) * interval_units.get(match.group(2) or 's')
+
+class SyncScheduler:
+    # list_tables returns {name: table} for all tables to keep in sync,
+    # sync_table(table) syncs one table and get_interval(table) returns
+    # its interval in seconds
+    def __init__(self, list_tables, sync_table, get_interval, workers,
+            jitter=daemon_jitter, refresh=parse_interval(daemon_refresh)):
+        self.list_tables = list_tables
+        self.sync_table = sync_table
+        self.get_interval = get_interval
+        self.workers = workers
+        self.jitter = jitter
+        self.refresh = refresh
+        self.tables = {}
+        self.queue = []
+        self.sequence = itertools.count()
+        self.running = {}
+        self.stopping = threading.Event()
+
+    def schedule(self, name, due):
+        heapq.heappush(self.queue, (due, next(self.sequence), name))
+
+    # Spread runs of tables with the same interval over part of it
+    def get_jitter(self, interval):
+        return random.uniform(0, interval * self.jitter)
+
+    # Pick up added and removed tables. New tables start within their jitter.
+    def refresh_tables(self):
+        tables = self.list_tables()
+        for name, table in tables.items():
+            if name not in self.tables:
+                self.schedule(name, time.time() + self.get_jitter(self.get_interval(table)))
+        self.tables = tables
+        print(f"scheduling {len(self.tables)} tables")
+
+    # Schedule the next run of a finished table one interval after the
+    # previous run started, or right away when the run took longer
+    def finish(self, future):
+        name, started = self.running.pop(future)
+        try:
+            future.result()
+        except Exception as e:
+            print(f"sync failed for {name}: {e}")
+        table = self.tables.get(name)
+        if table is None:
+            return
+        interval = self.get_interval(table)
+        self.schedule(name, max(started + interval, time.time()) + self.get_jitter(interval))
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        next_refresh = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopping.is_set():
+                now = time.time()
+                if now >= next_refresh:
+                    try:
+                        self.refresh_tables()
+                    except Exception as e:
+                        print(f"could not refresh tables: {e}")
+                    next_refresh = now + self.refresh
+
+                # Submit due tables while workers are free
+                running_names = {name for name, started in self.running.values()}
+                while len(self.running) < self.workers and len(self.queue) > 0 and self.queue[0][0] <= now:
+                    due, sequence, name = heapq.heappop(self.queue)
+                    if name not in self.tables or name in running_names:
+                        continue
+                    future = executor.submit(self.sync_table, self.tables[name])
+                    self.running[future] = (name, time.time())
+                    running_names.add(name)
+
+                # Sleep until a run finishes, a table is due or the next refresh
+                timeout = next_refresh - now
+                if len(self.queue) > 0 and len(self.running) < self.workers:
+                    timeout = min(timeout, self.queue[0][0] - now)
+                timeout = min(max(timeout, 0.1), 1.0)
+                if len(self.running) > 0:
+                    done, not_done = concurrent.futures.wait(
+                        list(self.running), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self.finish(future)
+                else:
+                    self.stopping.wait(timeout)
+
+            # Let running tables finish before returning
+            print(f"stopping, waiting for {len(self.running)} running tables")
+            for future in list(self.running):
+                concurrent.futures.wait([future])
+                self.finish(future)
@@ -0,0 +1,58 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Local state kept between runs, one json object per destination table.
+import json
+import os
+import threading
+
+state_file = os.getenv('SYNC_STATE_FILE', 'sync_state.json')
+
+state = None
+state_lock = threading.Lock()
+
+def load_state():
+    global state
+    if state is None:
+        state = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+    return state
+
+def save_state():
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+# Get a copy of the state of a table
+def get_table_state(table_id):
+    with state_lock:
+        return dict(load_state().get(table_id, {}))
+
+# Set values in the state of a table and write the state file
+def update_table_state(table_id, **values):
+    with state_lock:
+        load_state().setdefault(table_id, {}).update(values)
+        save_state()
+
+# Remove values from the state of a table
+def clear_table_state(table_id, *keys):
+    with state_lock:
+        table_state = load_state().get(table_id, {})
+        for key in keys:
+            table_state.pop(key, None)
+        save_state()
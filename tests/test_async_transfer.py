@@ -0,0 +1,41 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+import pytest
+
+pytest.importorskip('pandas')
+dt = pytest.importorskip('data_transfer')
+async_transfer = pytest.importorskip('async_transfer')
+
+# asyncpg pool stand-in handing out a dummy connection
+class FakePool:
+    @asynccontextmanager
+    async def acquire(self):
+        yield object()
+
+# One table holds the only permit and needs executor threads for its loads,
+# while every other table blocks an executor thread waiting for a permit
+def test_permit_holder_gets_a_thread(monkeypatch):
+    monkeypatch.setattr(async_transfer, 'async_table_workers', 4)
+    monkeypatch.setattr(dt, 'bq_max_jobs', 1)
+    monkeypatch.setattr(dt, 'pg_connections', threading.BoundedSemaphore(1))
+
+    async def holder(started):
+        async with async_transfer.acquire_connection(FakePool()):
+            started.set()
+            for i in range(3):
+                await asyncio.to_thread(lambda: None)
+
+    def threaded_table():
+        reserved = dt.acquire_pg_connections()
+        dt.release_pg_connections(reserved)
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(async_transfer.create_executor())
+        started = asyncio.Event()
+        task = asyncio.create_task(holder(started))
+        await started.wait()
+        waiting = [asyncio.to_thread(threaded_table) for i in range(async_transfer.async_table_workers - 1)]
+        await asyncio.wait_for(asyncio.gather(task, *waiting), 5)
+
+    asyncio.run(run())
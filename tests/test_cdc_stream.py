@@ -0,0 +1,138 @@
+import json
+import os
+from decimal import Decimal
+import pytest
+
+cdc_stream = pytest.importorskip('cdc_stream')
+from google.cloud import bigquery
+
+fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures', 'wal2json_v2.jsonl')
+
+# Payloads captured from wal2json with format-version 2, include-timestamp
+# and include-lsn
+def read_payloads():
+    with open(fixture_path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def parse_lsn(lsn):
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+class Message:
+    def __init__(self, payload):
+        self.payload = payload
+        self.data_start = parse_lsn(json.loads(payload)['lsn'])
+
+# Replication cursor replaying the fixture, then stopping the stream
+class ReplayCursor:
+    def __init__(self, payloads):
+        self.messages = [Message(payload) for payload in payloads]
+        self.feedback = []
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return (1,)
+
+    def start_replication(self, **kwargs):
+        self.options = kwargs['options']
+
+    def read_message(self):
+        if len(self.messages) == 0:
+            raise KeyboardInterrupt
+        return self.messages.pop(0)
+
+    def send_feedback(self, flush_lsn):
+        self.feedback.append(flush_lsn)
+
+class ReplayConnection:
+    def __init__(self, cursor):
+        self.replay_cursor = cursor
+
+    def cursor(self):
+        return self.replay_cursor
+
+    def close(self):
+        pass
+
+def test_decode_row_changes():
+    payloads = read_payloads()
+    action, table, row = cdc_stream.decode_change(payloads[1])
+    assert (action, table) == ('I', 'reporting.fills')
+    assert row == {'id': 1001, 'market': 'BTC-PERP', 'price': Decimal('42000.125'), 'email': 'trader@example.com'}
+
+    action, table, row = cdc_stream.decode_change(payloads[8])
+    assert (action, table, row) == ('D', 'reporting.fills', {'id': 1000})
+
+def test_decode_truncate_and_messages():
+    payloads = read_payloads()
+    assert cdc_stream.decode_change(payloads[11]) == ('T', 'reporting.fills', {})
+    for payload in (payloads[4], payloads[6]):
+        action, table, row = cdc_stream.decode_change(payload)
+        assert action == 'M'
+        assert table is None
+    action, table, row = cdc_stream.decode_change(payloads[0])
+    assert (action, table) == ('B', None)
+    assert row['timestamp'] == '2022-06-01 12:00:00.123456+00'
+
+def test_stream_replay(monkeypatch):
+    cursor = ReplayCursor(read_payloads())
+    loads = []
+    state = {}
+    monkeypatch.setattr(cdc_stream, 'connect_replication', lambda: ReplayConnection(cursor))
+    monkeypatch.setattr(cdc_stream, 'get_table_state', lambda key: state.get(key, {}))
+    monkeypatch.setattr(cdc_stream, 'update_table_state', lambda key, **values: state.setdefault(key, {}).update(values))
+    monkeypatch.setattr(cdc_stream, 'cdc_batch_size', 1)
+    monkeypatch.setattr(cdc_stream.dt, 'write_df_to_bigquery',
+        lambda table_id, df, schema, write_disposition: loads.append((table_id, df.copy())))
+
+    # email is not projected, so it is never loaded
+    schema = [
+        bigquery.SchemaField('id', 'INT64'),
+        bigquery.SchemaField('market', 'STRING'),
+        bigquery.SchemaField('price', 'BIGDECIMAL'),
+    ] + cdc_stream.change_fields
+    targets = {'reporting.fills': {'table_id': 'project.dataset.fills_changelog', 'schema': schema}}
+    with pytest.raises(KeyboardInterrupt):
+        cdc_stream.stream_changes(targets)
+
+    assert cursor.options['add-tables'] == 'reporting.fills'
+    assert [table_id for table_id, df in loads] == ['project.dataset.fills_changelog'] * 3
+    frame = [df for table_id, df in loads]
+    assert list(frame[0]['_change_type']) == ['INSERT']
+    assert list(frame[1]['_change_type']) == ['UPDATE', 'DELETE']
+    assert list(frame[2]['_change_type']) == ['TRUNCATE']
+    assert all('email' not in df.columns for df in frame)
+    assert list(frame[1]['id']) == [1001, 1000]
+    assert frame[2]['id'].isna().all()
+
+    # The slot is confirmed at the commit of every loaded transaction
+    commits = [parse_lsn(json.loads(payload)['lsn']) for payload in read_payloads()
+        if json.loads(payload)['action'] == 'C']
+    assert cursor.feedback == commits
+    assert state[cdc_stream.state_key]['confirmed_lsn'] == commits[-1]
+
+def test_large_transaction_is_loaded_before_commit(monkeypatch):
+    cursor = ReplayCursor(read_payloads())
+    loads = []
+    state = {}
+    monkeypatch.setattr(cdc_stream, 'connect_replication', lambda: ReplayConnection(cursor))
+    monkeypatch.setattr(cdc_stream, 'get_table_state', lambda key: state.get(key, {}))
+    monkeypatch.setattr(cdc_stream, 'update_table_state', lambda key, **values: state.setdefault(key, {}).update(values))
+    monkeypatch.setattr(cdc_stream, 'cdc_batch_size', 1)
+    monkeypatch.setattr(cdc_stream, 'cdc_max_buffered', 1)
+    monkeypatch.setattr(cdc_stream.dt, 'write_df_to_bigquery',
+        lambda table_id, df, schema, write_disposition: loads.append(list(df['_change_type'])))
+
+    schema = [bigquery.SchemaField('id', 'INT64')] + cdc_stream.change_fields
+    targets = {'reporting.fills': {'table_id': 'project.dataset.fills_changelog', 'schema': schema}}
+    with pytest.raises(KeyboardInterrupt):
+        cdc_stream.stream_changes(targets)
+
+    # The update and delete of one transaction are loaded apart, the slot
+    # is still only confirmed at commits
+    assert loads == [['INSERT'], ['UPDATE'], ['DELETE'], ['TRUNCATE']]
+    commits = [parse_lsn(json.loads(payload)['lsn']) for payload in read_payloads()
+        if json.loads(payload)['action'] == 'C']
+    assert cursor.feedback == commits
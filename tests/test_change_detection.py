@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip('pandas')
+change_detection = pytest.importorskip('change_detection')
+
+# Postgresql stand-in answering the queries of change detection
+class FakeCursor:
+    def __init__(self, in_recovery, max_value):
+        self.in_recovery = in_recovery
+        self.max_value = max_value
+        self.sql = None
+
+    def execute(self, sql, params=None):
+        self.sql = sql
+
+    def fetchone(self):
+        if 'pg_is_in_recovery' in self.sql:
+            return (self.in_recovery,)
+        if 'relfilenode' in self.sql:
+            return (16384, 10, 0, 0)
+        return (self.max_value,)
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.cursor_ = cursor
+
+    def cursor(self):
+        return self.cursor_
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def source(monkeypatch):
+    cursor = FakeCursor(False, 1)
+    class FakeEngine:
+        def raw_connection(self):
+            return FakeConnection(cursor)
+    monkeypatch.setattr(change_detection, 'get_psql_engine', FakeEngine)
+    return cursor
+
+def fingerprint(change_column=None):
+    return change_detection.get_data_fingerprint('public.fills', '*', None, (), 'schema', change_column)
+
+def test_primary_uses_counters(source):
+    assert fingerprint() is not None
+    assert fingerprint() == fingerprint()
+
+def test_standby_without_change_column_is_not_skipped(source):
+    source.in_recovery = True
+    assert fingerprint() is None
+
+def test_standby_with_change_column(source):
+    source.in_recovery = True
+    before = fingerprint('updated_at')
+    assert before is not None
+    source.max_value = 2
+    assert fingerprint('updated_at') != before
@@ -0,0 +1,103 @@
+import re
+import pytest
+
+pd = pytest.importorskip('pandas')
+bigquery = pytest.importorskip('google.cloud.bigquery')
+checkpoint_transfer = pytest.importorskip('checkpoint_transfer')
+import sync_state
+from google.cloud.exceptions import NotFound
+
+table_id = 'project.dataset.fills'
+schema = [bigquery.SchemaField('id', 'INTEGER'), bigquery.SchemaField('market', 'STRING')]
+
+# Postgresql stand-in serving keyset pages of a table with ids 1 to 25
+class FakeCursor:
+    def __init__(self, key):
+        self.key = key
+        self.description = None
+
+    def execute(self, sql, params=()):
+        if 'pg_index' in sql:
+            self.result = [(name, 'bigint') for name in self.key]
+            return
+        last = params[-1] if '> (' in sql else 0
+        limit = int(re.search(r'LIMIT (\d+)', sql).group(1))
+        self.description = [('id',), ('id',), ('market',)]
+        self.result = [(i, i, 'BTC-PERP') for i in range(last + 1, 26)][:limit]
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, key):
+        self.key = key
+
+    def cursor(self):
+        return FakeCursor(self.key)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+# Bigquery stand-in, loads are recorded by the test so no job exists
+class FakeBigQueryClient:
+    def get_job(self, job_id, location=None):
+        raise NotFound(job_id)
+
+@pytest.fixture
+def source(monkeypatch, tmp_path):
+    monkeypatch.setattr(sync_state, 'state_file', str(tmp_path / 'sync_state.json'))
+    monkeypatch.setattr(sync_state, 'state', None)
+    key = ['id']
+    class FakeEngine:
+        def raw_connection(self):
+            return FakeConnection(key)
+    monkeypatch.setattr(checkpoint_transfer, 'get_psql_engine', FakeEngine)
+    monkeypatch.setattr(checkpoint_transfer, 'get_bigquery_client', FakeBigQueryClient)
+    loads = []
+    monkeypatch.setattr(checkpoint_transfer.dt, 'write_df_to_bigquery',
+        lambda table_id, df, schema, disposition, job_id: loads.append((list(df['id']), disposition, job_id)))
+    return key, loads
+
+def transfer():
+    return checkpoint_transfer.write_checkpointed_to_bigquery(
+        table_id, 'public.fills', schema, 'WRITE_TRUNCATE', chunk_size=10, watermark_column='id')
+
+def test_pages_follow_the_primary_key(source):
+    key, loads = source
+    assert transfer() == (25, '25')
+    assert [ids for ids, disposition, job_id in loads] == [
+        list(range(1, 11)), list(range(11, 21)), list(range(21, 26))]
+    assert [disposition for ids, disposition, job_id in loads] == ['WRITE_TRUNCATE', 'WRITE_APPEND', 'WRITE_APPEND']
+    assert 'checkpoint' not in sync_state.get_table_state(table_id)
+
+def test_resume_after_last_loaded_key(source, monkeypatch):
+    key, loads = source
+    def fail_second_page(table_id, df, schema, disposition, job_id):
+        if len(loads) == 1:
+            raise RuntimeError('connection lost')
+        loads.append((list(df['id']), disposition, job_id))
+    monkeypatch.setattr(checkpoint_transfer.dt, 'write_df_to_bigquery', fail_second_page)
+    with pytest.raises(RuntimeError):
+        transfer()
+    loads.clear()
+
+    # Next run reads the state file again
+    monkeypatch.setattr(sync_state, 'state', None)
+    monkeypatch.setattr(checkpoint_transfer.dt, 'write_df_to_bigquery',
+        lambda table_id, df, schema, disposition, job_id: loads.append((list(df['id']), disposition, job_id)))
+    assert sync_state.get_table_state(table_id)['checkpoint']['last_key'] == [10]
+    assert transfer() == (15, '25')
+    assert [ids for ids, disposition, job_id in loads] == [list(range(11, 21)), list(range(21, 26))]
+    assert loads[0][2].endswith('_00001_0')
+
+def test_table_without_primary_key_is_refused(source):
+    key, loads = source
+    key.clear()
+    with pytest.raises(ValueError, match='primary key'):
+        transfer()
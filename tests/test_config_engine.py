@@ -0,0 +1,94 @@
+import json
+import pytest
+import config_engine
+
+def config(*entries, **data):
+    return config_engine.TableConfig(list(entries), data.get('sources', ()), data.get('shards'))
+
+def test_precedence_default_glob_regex_table():
+    table_config = config(
+        {'table': 'reporting.fills', 'chunk_size': 10},
+        {'regex': r'reporting\..*', 'chunk_size': 20, 'checkpoint': True},
+        {'pattern': 'reporting.*', 'chunk_size': 30, 'checkpoint': False, 'drop_pii': True},
+    )
+    assert table_config.get('reporting.fills') == {
+        'table': 'reporting.fills', 'chunk_size': 10, 'checkpoint': True, 'drop_pii': True}
+    assert table_config.get('reporting.orders') == {
+        'table': 'reporting.orders', 'chunk_size': 20, 'checkpoint': True, 'drop_pii': True}
+    assert table_config.get('public.users') is None
+
+def test_rules_of_one_kind_merge_in_file_order():
+    table_config = config(
+        {'pattern': 'reporting.*', 'chunk_size': 30, 'drop_pii': True},
+        {'pattern': 'reporting.f*', 'chunk_size': 20},
+    )
+    assert table_config.get('reporting.fills') == {'table': 'reporting.fills', 'chunk_size': 20, 'drop_pii': True}
+
+def test_patterns_match_the_whole_name():
+    table_config = config({'pattern': 'reporting.fill?', 'chunk_size': 10}, {'regex': 'fills', 'chunk_size': 20})
+    assert table_config.get('reporting.fills')['chunk_size'] == 10
+    assert table_config.get('reporting.fills_2022') is None
+
+def test_table_entries_are_merged():
+    table_config = config(
+        {'table': 'reporting.fills', 'chunk_size': 10},
+        {'table': 'reporting.fills', 'drop_pii': True},
+    )
+    assert table_config.get('reporting.fills') == {'table': 'reporting.fills', 'chunk_size': 10, 'drop_pii': True}
+
+def test_bad_regex():
+    with pytest.raises(ValueError, match='entry 0: invalid regex'):
+        config({'regex': 'reporting.(fills', 'chunk_size': 10})
+
+def test_unknown_setting():
+    with pytest.raises(ValueError, match='entry 1: unknown setting chunksize'):
+        config({'table': 'reporting.fills'}, {'table': 'reporting.fills', 'chunksize': 10})
+
+@pytest.mark.parametrize('entry, message', [
+    ({'chunk_size': 10}, 'needs exactly one of'),
+    ({'table': 'a', 'pattern': 'b'}, 'needs exactly one of'),
+    ({'table': 'a', 'chunk_size': '10'}, 'chunk_size has the wrong type'),
+    ({'table': 'a', 'chunk_size': True}, 'chunk_size has the wrong type'),
+    ({'table': 'a', 'chunk_size': 0}, 'chunk_size must be positive'),
+    ({'table': 'a', 'parallel_workers': -1}, 'parallel_workers must be positive'),
+    ({'table': 'a', 'checkpoint': 'yes'}, 'checkpoint has the wrong type'),
+    ({'table': 'a', 'write_disposition': 'WRITE_EMPTY'}, 'write_disposition must be one of'),
+    ({'table': 'a', 'partition_type': 'WEEK'}, 'partition_type must be one of'),
+    ({'table': 'a', 'where': "market LIKE 'BTC%'"}, 'write a literal %'),
+])
+def test_invalid_values(entry, message):
+    with pytest.raises(ValueError, match=message):
+        config(entry)
+
+def test_literal_percent_in_where():
+    table_config = config({'table': 'a', 'where': "market LIKE 'BTC%%'"})
+    assert table_config.get('a')['where'] == "market LIKE 'BTC%%'"
+
+def test_partition_overwrite_needs_partition_column():
+    table_config = config(
+        {'pattern': 'reporting.*', 'partition_overwrite': True},
+        {'table': 'reporting.fills', 'partition_column': 'created_at'},
+    )
+    assert table_config.get('reporting.fills')['partition_column'] == 'created_at'
+    with pytest.raises(ValueError, match='partition_overwrite needs partition_column'):
+        table_config.get('reporting.orders')
+
+def test_sources_and_shards():
+    sources = [{'name': 'eu', 'entry_group': 'eu_group', 'port': 5432}]
+    table_config = config(sources=sources, shards={'mode': 'combined', 'dataset': 'all_regions'})
+    assert table_config.sources['eu']['entry_group'] == 'eu_group'
+    assert table_config.shards == {'mode': 'combined', 'column': 'shard_id', 'dataset': 'all_regions'}
+    with pytest.raises(ValueError, match='duplicate name eu'):
+        config(sources=sources * 2)
+    with pytest.raises(ValueError, match='name may only hold'):
+        config(sources=[{'name': 'eu-west', 'entry_group': 'g'}])
+    with pytest.raises(ValueError, match='combined shards need a dataset'):
+        config(shards={'mode': 'combined'})
+    with pytest.raises(ValueError, match='column may only hold'):
+        config(shards={'column': 'shard id'})
+
+def test_load_config(tmp_path):
+    assert config_engine.load_config(None).get('reporting.fills') is None
+    filename = tmp_path / 'config.json'
+    filename.write_text(json.dumps({'table_config': [{'table': 'reporting.fills', 'chunk_size': 10}]}))
+    assert config_engine.load_config(str(filename)).get('reporting.fills')['chunk_size'] == 10
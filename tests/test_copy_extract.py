@@ -0,0 +1,102 @@
+import datetime
+import struct
+from decimal import Decimal
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+copy_extract = pytest.importorskip('copy_extract')
+from benchmark import encode_copy_value, encode_numeric
+
+header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+trailer = struct.pack('>h', -1)
+
+def field(data):
+    return struct.pack('>i', len(data)) + data
+
+def null():
+    return struct.pack('>i', -1)
+
+def copy_tuple(*fields):
+    return struct.pack('>h', len(fields)) + b''.join(fields)
+
+def decode(names, type_oids, stream, chunk_size=100, split=None):
+    decoder = copy_extract.CopyDecoder(names, type_oids, chunk_size)
+    chunks = []
+    step = split or len(stream)
+    for start in range(0, len(stream), step):
+        chunks += decoder.feed(stream[start:start + step])
+    assert decoder.done
+    if decoder.rows > 0:
+        chunks.append(decoder.flush())
+    return chunks
+
+def test_values_and_nulls():
+    created_at = datetime.datetime(2022, 3, 4, 5, 6, 7, 89)
+    stream = header + copy_tuple(
+        encode_copy_value('bigint', 1),
+        encode_copy_value('character_varying', 'BTC-PERP'),
+        encode_copy_value('numeric', Decimal('123.450')),
+        encode_copy_value('boolean', True),
+        encode_copy_value('timestamp_without_time_zone', created_at),
+    ) + copy_tuple(null(), null(), null(), null(), null()) + trailer
+
+    [chunk] = decode(['id', 'market', 'price', 'liquidation', 'created_at'], [20, 1043, 1700, 16, 1114], stream)
+    assert len(chunk) == 2
+    first = chunk.iloc[0]
+    assert first['id'] == 1
+    assert first['market'] == 'BTC-PERP'
+    assert first['price'] == Decimal('123.450')
+    assert bool(first['liquidation']) is True
+    assert first['created_at'] == pd.Timestamp(created_at)
+    assert chunk.iloc[1].isna().all()
+
+def test_chunks_across_split_reads():
+    stream = header + b''.join(
+        copy_tuple(encode_copy_value('integer', i), encode_copy_value('character_varying', str(i)))
+        for i in range(257)) + trailer
+
+    chunks = decode(['id', 'name'], [23, 1043], stream, chunk_size=100, split=37)
+    assert [len(chunk) for chunk in chunks] == [100, 100, 57]
+    frame = pd.concat(chunks, ignore_index=True)
+    assert list(frame['id']) == list(range(257))
+    assert list(frame['name']) == [str(i) for i in range(257)]
+
+@pytest.mark.parametrize('sign, expected', [
+    (0xC000, 'NaN'),
+    (0xD000, 'Infinity'),
+    (0xF000, '-Infinity'),
+])
+def test_special_numerics(sign, expected):
+    stream = header + copy_tuple(field(struct.pack('>hhHh', 0, 0, sign, 0))) + trailer
+    [chunk] = decode(['value'], [1700], stream)
+    value = chunk.iloc[0]['value']
+    assert str(value) == expected
+
+def test_numeric_scale():
+    values = [Decimal('0'), Decimal('0.001'), Decimal('-12345.6789'), Decimal('100000000'), Decimal('1.10')]
+    stream = header + b''.join(copy_tuple(field(encode_numeric(value))) for value in values) + trailer
+    [chunk] = decode(['value'], [1700], stream)
+    assert list(chunk['value']) == values
+    assert [str(value) for value in chunk['value']] == [str(value) for value in values]
+
+def test_infinite_timestamps_and_dates():
+    stream = header + copy_tuple(
+        field(struct.pack('>q', 0x7FFFFFFFFFFFFFFF)),
+        field(struct.pack('>i', 0x7FFFFFFF)),
+    ) + copy_tuple(
+        field(struct.pack('>q', -0x8000000000000000)),
+        field(struct.pack('>i', -0x80000000)),
+    ) + trailer
+
+    [chunk] = decode(['created_at', 'created_on'], [1114, 1082], stream)
+    assert chunk.iloc[0]['created_at'] == pd.Timestamp('9999-12-31 23:59:59.999999')
+    assert chunk.iloc[0]['created_on'] == pd.Timestamp('9999-12-31')
+    assert chunk.iloc[1]['created_at'] == pd.Timestamp('0001-01-01')
+    assert chunk.iloc[1]['created_on'] == pd.Timestamp('0001-01-01')
+    assert not chunk.isna().any().any()
+
+def test_rejects_unexpected_field_count():
+    stream = header + copy_tuple(encode_copy_value('integer', 1)) + trailer
+    with pytest.raises(ValueError):
+        decode(['id', 'name'], [23, 1043], stream)
@@ -0,0 +1,52 @@
+import pytest
+
+datacatalog_v1 = pytest.importorskip('google.cloud.datacatalog_v1')
+dc = pytest.importorskip('data_catalog_tagging')
+cache = dc.cache
+
+entry_name = 'projects/p/locations/l/entryGroups/g/entries/fills'
+template = 'projects/p/locations/l/tagTemplates/t'
+
+# Data catalog stand-in that fails updates when asked to
+class FakeDataCatalogClient:
+    def __init__(self, fail):
+        self.fail = fail
+        self.updates = []
+
+    def update_tag(self, request):
+        if self.fail:
+            raise RuntimeError('permission denied')
+        self.updates.append(request.tag)
+        return request.tag
+
+@pytest.fixture
+def catalog(monkeypatch):
+    tag = datacatalog_v1.Tag(template=template)
+    tag.fields['last_synced'] = datacatalog_v1.types.TagField(string_value='100')
+    monkeypatch.setattr(cache, 'cache_file', None)
+    cache.clear_cache()
+    cache.put_cached('tags', {entry_name: [tag]})
+    monkeypatch.setattr(dc, 'tagging_rate', 1000000.0)
+    yield
+    cache.clear_cache()
+
+def last_synced():
+    return cache.get_cached('tags', entry_name)[0].fields['last_synced'].string_value
+
+def test_update_refreshes_cached_tag(catalog, monkeypatch):
+    client = FakeDataCatalogClient(fail=False)
+    monkeypatch.setattr(dc, 'get_datacatalog_client', lambda: client)
+    dc.update_tag_string_field(entry_name, template, 'last_synced', '200')
+    assert client.updates[0].fields['last_synced'].string_value == '200'
+    assert last_synced() == '200'
+
+def test_failed_update_raises_and_keeps_cached_tag(catalog, monkeypatch):
+    monkeypatch.setattr(dc, 'get_datacatalog_client', lambda: FakeDataCatalogClient(fail=True))
+    with pytest.raises(RuntimeError, match='last_synced'):
+        dc.update_tag_string_field(entry_name, template, 'last_synced', '200')
+    assert last_synced() == '100'
+
+def test_untagged_entry_raises(catalog, monkeypatch):
+    monkeypatch.setattr(dc, 'get_datacatalog_client', lambda: FakeDataCatalogClient(fail=False))
+    with pytest.raises(RuntimeError, match='not tagged'):
+        dc.update_tag_string_field(entry_name, template + '_other', 'last_synced', '200')
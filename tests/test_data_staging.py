@@ -0,0 +1,69 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+bigquery = pytest.importorskip('google.cloud.bigquery')
+data_staging = pytest.importorskip('data_staging')
+dt = data_staging.dt
+from google.cloud.exceptions import NotFound
+from benchmark import FakeBigQueryClient, FakeJob
+
+table_id = 'project.dataset.fills'
+schema = [bigquery.SchemaField('id', 'INTEGER'), bigquery.SchemaField('market', 'STRING')]
+
+# Bigquery stand-in recording loads, failing the load of one file when asked
+class RecordingClient(FakeBigQueryClient):
+    def __init__(self):
+        super().__init__()
+        self.loads = []
+        self.queries = []
+        self.fail_job = None
+
+    def get_job(self, job_id, location=None):
+        raise NotFound(job_id)
+
+    def load_table_from_file(self, file_obj, table_id, job_config=None, job_id=None):
+        if job_id == self.fail_job:
+            raise RuntimeError('load failed')
+        self.loads.append((table_id, job_config.write_disposition, job_id))
+        return FakeJob()
+
+    def query(self, sql):
+        self.queries.append(sql)
+        return FakeJob()
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    client = RecordingClient()
+    monkeypatch.setattr(data_staging, 'staging_dir', str(tmp_path))
+    monkeypatch.setattr(data_staging, 'staging_bucket', None)
+    monkeypatch.setattr(data_staging, 'staging_file_size', 1)
+    for module in (data_staging, dt):
+        monkeypatch.setattr(module, 'get_bigquery_client', lambda: client)
+    monkeypatch.setattr('checkpoint_transfer.get_bigquery_client', lambda: client)
+    return client
+
+def stage(sizes):
+    chunks = (pd.DataFrame({'id': range(size), 'market': ['BTC-PERP'] * size}) for size in sizes)
+    return data_staging.stage_chunks_to_parquet(table_id, chunks, schema, 'WRITE_TRUNCATE')
+
+def test_single_file_replaces_table_directly(client):
+    data_staging.load_staged_files(table_id, stage([3]), schema)
+    assert [load[:2] for load in client.loads] == [(table_id, 'WRITE_TRUNCATE')]
+    assert client.queries == []
+
+def test_files_are_swapped_in_from_staging(client):
+    manifest = stage([3, 3, 3])
+    client.fail_job = data_staging.get_staged_job_id(table_id, manifest, '00001', 0)
+    with pytest.raises(RuntimeError):
+        data_staging.load_staged_files(table_id, manifest, schema)
+    staging_table_id = manifest['staging_table']
+    assert [load[:2] for load in client.loads] == [(staging_table_id, 'WRITE_APPEND')]
+    assert client.queries == []
+
+    # The retry appends the remaining files to the same staging table
+    client.fail_job = None
+    client.loads.clear()
+    data_staging.load_staged_files(table_id, data_staging.read_staging_manifest(table_id), schema)
+    assert [load[:2] for load in client.loads] == [(staging_table_id, 'WRITE_APPEND')] * 2
+    assert f"DELETE FROM `{table_id}` WHERE TRUE;" in client.queries[0]
+    assert staging_table_id not in client.tables
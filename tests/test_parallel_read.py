@@ -0,0 +1,71 @@
+import queue
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('psycopg2')
+dt = pytest.importorskip('data_transfer')
+
+# Postgresql stand-in with 25 rows behind a named cursor
+class FakeCursor:
+    def __init__(self, name=None):
+        self.name = name
+        self.description = [('id',), ('market',)]
+        self.rows = [(i, 'BTC-PERP') for i in range(25)]
+
+    def execute(self, sql, params=None):
+        if 'pg_export_snapshot' in sql:
+            self.rows = [('00000003-00000002-1',)]
+        elif 'reltuples' in sql or 'pg_relation_size' in sql:
+            self.rows = [(0,)]
+        elif 'pg_index' in sql:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def set_session(self, **kwargs):
+        pass
+
+    def cursor(self, name=None):
+        return FakeCursor(name)
+
+    def close(self):
+        pass
+
+def test_range_is_streamed_in_chunks(monkeypatch):
+    monkeypatch.setattr(dt, 'connect_psql', lambda settings: FakeConnection())
+    chunks = queue.Queue()
+    dt.init_range_worker(chunks)
+    dt.read_psql_range(('snapshot', 'SELECT * FROM fills WHERE TRUE', (), None, {}, 10))
+    items = [chunks.get() for i in range(chunks.qsize())]
+    assert [len(value) for kind, value in items[:-1]] == [10, 10, 5]
+    assert items[-1] == ('done', None)
+
+def test_failed_range_is_reported(monkeypatch):
+    def connect(settings):
+        raise RuntimeError('connection refused')
+    monkeypatch.setattr(dt, 'connect_psql', connect)
+    chunks = queue.Queue()
+    dt.init_range_worker(chunks)
+    dt.read_psql_range(('snapshot', 'SELECT 1', (), None, {}, 10))
+    assert chunks.get() == ('done', 'RuntimeError: connection refused')
+
+# Spawned workers connect for real and fail, the coordinator raises
+def test_spawned_worker_failure_raises(monkeypatch):
+    monkeypatch.setattr(dt, 'connect_psql', lambda settings: FakeConnection())
+    monkeypatch.setattr(dt, 'get_psql_settings', lambda source: {
+        'host': '127.0.0.1', 'port': 1, 'dbname': 'db', 'user': 'user', 'password': 'password'})
+    monkeypatch.setattr(dt, 'get_source', lambda: None)
+    with pytest.raises(RuntimeError, match='reading a range of public.fills failed'):
+        list(dt.read_psql_db_parallel('public.fills', 1))
@@ -0,0 +1,77 @@
+import datetime
+import pytest
+
+pytest.importorskip('pandas')
+partition_transfer = pytest.importorskip('partition_transfer')
+import sync_state
+
+table_id = 'project.dataset.fills'
+day = datetime.datetime(2022, 6, 1)
+next_day = datetime.datetime(2022, 6, 2)
+
+# Postgresql stand-in answering the partition checksum query
+class FakeCursor:
+    def __init__(self, checksums):
+        self.checksums = checksums
+
+    def execute(self, sql, params=None):
+        self.sql = sql
+
+    def fetchall(self):
+        return self.checksums
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, checksums):
+        self.checksums = checksums
+
+    def cursor(self):
+        return FakeCursor(self.checksums)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def source(monkeypatch, tmp_path):
+    monkeypatch.setattr(sync_state, 'state_file', str(tmp_path / 'sync_state.json'))
+    monkeypatch.setattr(sync_state, 'state', None)
+    checksums = [(day, 10, 123), (next_day, 5, 456)]
+    class FakeEngine:
+        def raw_connection(self):
+            return FakeConnection(checksums)
+    monkeypatch.setattr(partition_transfer, 'get_psql_engine', FakeEngine)
+    written = []
+    def write_partition(table_id, source_table, schema, select, row_filter, part_type, part_column,
+            start, *args):
+        written.append(start)
+        return 1, None
+    monkeypatch.setattr(partition_transfer, 'write_partition', write_partition)
+    return checksums, written
+
+def rewrite():
+    return partition_transfer.write_partitions_to_bigquery(
+        table_id, 'public.fills', [], 'DAY', 'created_at')
+
+def test_only_changed_partitions_are_rewritten(source):
+    checksums, written = source
+    rewrite()
+    assert sorted(written) == [day, next_day]
+    assert sync_state.get_table_state(table_id)['partition_checksums'] == {
+        f"{table_id}$20220601": [10, 123], f"{table_id}$20220602": [5, 456]}
+
+    written.clear()
+    rewrite()
+    assert written == []
+
+    checksums[1] = (next_day, 6, 789)
+    rewrite()
+    assert written == [next_day]
+
+def test_partition_column_is_required(source):
+    with pytest.raises(ValueError, match='partition_column'):
+        partition_transfer.write_partitions_to_bigquery(table_id, 'public.fills', [], 'DAY', None)
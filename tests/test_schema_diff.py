@@ -0,0 +1,47 @@
+import pytest
+
+bigquery = pytest.importorskip('google.cloud.bigquery')
+from schema_diff import diff_schema, get_schema_fingerprint, has_changes
+
+def field(name, field_type, **kwargs):
+    return bigquery.SchemaField(name, field_type, **kwargs)
+
+dest_schema = [field('id', 'INTEGER'), field('price', 'NUMERIC'), field('market', 'STRING')]
+
+def test_same_schema_has_no_changes():
+    diff = diff_schema([field('id', 'INT64'), field('price', 'DECIMAL'), field('market', 'STRING')], dest_schema)
+    assert diff == {"added": [], "widened": [], "conflicts": [], "removed": []}
+    assert not has_changes(diff)
+
+def test_added_column():
+    diff = diff_schema(dest_schema + [field('fee', 'FLOAT')], dest_schema)
+    assert [added.name for added in diff["added"]] == ['fee']
+    assert has_changes(diff)
+
+def test_removed_column_is_not_a_change():
+    diff = diff_schema(dest_schema[:2], dest_schema)
+    assert [removed.name for removed in diff["removed"]] == ['market']
+    assert not has_changes(diff)
+
+def test_widened_and_conflicting_types():
+    source_schema = [field('id', 'NUMERIC'), field('price', 'BIGNUMERIC'), field('market', 'INTEGER')]
+    diff = diff_schema(source_schema, dest_schema)
+    assert diff["widened"] == [('id', 'INT64', 'NUMERIC'), ('price', 'NUMERIC', 'BIGNUMERIC')]
+    assert diff["conflicts"] == [('market', 'STRING', 'INT64')]
+    assert has_changes(diff)
+
+def test_narrowing_is_a_conflict():
+    diff = diff_schema([field('price', 'INTEGER')], [field('price', 'NUMERIC')])
+    assert diff["conflicts"] == [('price', 'NUMERIC', 'INT64')]
+
+def test_fingerprint_ignores_column_order_and_metadata():
+    fingerprint = get_schema_fingerprint(dest_schema)
+    assert get_schema_fingerprint(list(reversed(dest_schema))) == fingerprint
+    assert get_schema_fingerprint([field('id', 'INT64', mode='REQUIRED', description='key'),
+        field('price', 'DECIMAL'), field('market', 'STRING')]) == fingerprint
+
+def test_fingerprint_changes_with_names_and_types():
+    fingerprint = get_schema_fingerprint(dest_schema)
+    assert get_schema_fingerprint(dest_schema[:2]) != fingerprint
+    assert get_schema_fingerprint(dest_schema[:2] + [field('symbol', 'STRING')]) != fingerprint
+    assert get_schema_fingerprint(dest_schema[:2] + [field('market', 'BYTES')]) != fingerprint
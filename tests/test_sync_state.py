@@ -0,0 +1,27 @@
+import sync_state
+
+def test_state_survives_a_restart(monkeypatch, tmp_path):
+    monkeypatch.setattr(sync_state, 'state_file', str(tmp_path / 'sync_state.json'))
+    monkeypatch.setattr(sync_state, 'state', None)
+    sync_state.update_table_state('project.dataset.fills', schema_fingerprint='abc', data_fingerprint='def')
+    sync_state.update_table_state('project.dataset.fills', data_fingerprint='ghi')
+
+    monkeypatch.setattr(sync_state, 'state', None)
+    assert sync_state.get_table_state('project.dataset.fills') == {
+        'schema_fingerprint': 'abc', 'data_fingerprint': 'ghi'}
+    assert sync_state.get_table_state('project.dataset.orders') == {}
+
+def test_cleared_values_are_gone(monkeypatch, tmp_path):
+    monkeypatch.setattr(sync_state, 'state_file', str(tmp_path / 'sync_state.json'))
+    monkeypatch.setattr(sync_state, 'state', None)
+    sync_state.update_table_state('project.dataset.fills', schema_fingerprint='abc', checkpoint={'page': 1})
+    sync_state.clear_table_state('project.dataset.fills', 'checkpoint')
+    monkeypatch.setattr(sync_state, 'state', None)
+    assert sync_state.get_table_state('project.dataset.fills') == {'schema_fingerprint': 'abc'}
+
+def test_table_state_is_a_copy(monkeypatch, tmp_path):
+    monkeypatch.setattr(sync_state, 'state_file', str(tmp_path / 'sync_state.json'))
+    monkeypatch.setattr(sync_state, 'state', None)
+    sync_state.update_table_state('project.dataset.fills', schema_fingerprint='abc')
+    sync_state.get_table_state('project.dataset.fills')['schema_fingerprint'] = 'changed'
+    assert sync_state.get_table_state('project.dataset.fills')['schema_fingerprint'] == 'abc'
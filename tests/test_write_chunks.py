@@ -0,0 +1,67 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+bigquery = pytest.importorskip('google.cloud.bigquery')
+dt = pytest.importorskip('data_transfer')
+from benchmark import FakeBigQueryClient
+
+table_id = 'project.dataset.fills'
+schema = [bigquery.SchemaField('id', 'INTEGER'), bigquery.SchemaField('market', 'STRING')]
+
+class RecordingClient(FakeBigQueryClient):
+    def __init__(self):
+        super().__init__()
+        self.loads = []
+        self.queries = []
+
+    def load_table_from_dataframe(self, df, table_id, job_config=None, job_id=None):
+        self.loads.append((table_id, job_config.write_disposition, len(df)))
+        return super().load_table_from_dataframe(df, table_id, job_config, job_id)
+
+    def query(self, sql):
+        self.queries.append(sql)
+        return super().query(sql)
+
+@pytest.fixture
+def client(monkeypatch):
+    client = RecordingClient()
+    monkeypatch.setattr(dt, 'get_bigquery_client', lambda: client)
+    return client
+
+def chunks(*sizes):
+    start = 0
+    for size in sizes:
+        yield pd.DataFrame({'id': range(start, start + size), 'market': ['BTC-PERP'] * size})
+        start += size
+
+def test_single_chunk_truncates_directly(client):
+    rows, high_watermark = dt.write_chunks_to_bigquery(table_id, chunks(3), schema, 'WRITE_TRUNCATE', 'id')
+    assert (rows, high_watermark) == (3, 2)
+    assert client.loads == [(table_id, 'WRITE_TRUNCATE', 3)]
+    assert client.queries == []
+
+def test_chunks_are_swapped_in_from_staging(client):
+    rows, high_watermark = dt.write_chunks_to_bigquery(table_id, chunks(3, 3, 1), schema, 'WRITE_TRUNCATE', 'id')
+    assert (rows, high_watermark) == (7, 6)
+    staging_table_id = client.loads[0][0]
+    assert staging_table_id.startswith('project.dataset._staging_fills_')
+    assert client.loads == [(staging_table_id, 'WRITE_APPEND', size) for size in (3, 3, 1)]
+    assert len(client.queries) == 1
+    assert f"DELETE FROM `{table_id}` WHERE TRUE;" in client.queries[0]
+    assert f"SELECT `id`, `market` FROM `{staging_table_id}`" in client.queries[0]
+    assert client.tables == {}
+
+def test_failed_chunk_leaves_table_alone(client):
+    def failing():
+        yield from chunks(3, 3)
+        raise RuntimeError('connection lost')
+    with pytest.raises(RuntimeError):
+        dt.write_chunks_to_bigquery(table_id, failing(), schema, 'WRITE_TRUNCATE')
+    assert all(load[0] != table_id for load in client.loads)
+    assert client.queries == []
+    assert client.tables == {}
+
+def test_partition_is_written_directly(client):
+    dt.write_chunks_to_bigquery(f"{table_id}$20220101", chunks(3, 3), schema, 'WRITE_TRUNCATE')
+    assert [load[1] for load in client.loads] == ['WRITE_TRUNCATE', 'WRITE_APPEND']
+    assert client.queries == []
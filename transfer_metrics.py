@@ -0,0 +1,185 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per table transfer metrics: wall time per stage, rows, bytes and memory.
+# Finished tables are appended to a json lines file and the latest value of
+# every table is written to a prometheus textfile.
+import contextvars
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+metrics_file = os.getenv('METRICS_FILE')
+metrics_prom_file = os.getenv('METRICS_PROM_FILE')
+
+stages = ('catalog_lookup', 'schema_sync', 'extract', 'cast', 'serialize', 'upload', 'job_wait')
+
+# Metrics of running tables and latest metrics of finished tables by table name
+running = {}
+finished = {}
+metrics_lock = threading.Lock()
+
+# Catalog lookup seconds of tables that did not start yet
+lookups = {}
+
+# Table whose metrics are recorded by the current thread or asyncio task
+current_table = contextvars.ContextVar('current_table', default=None)
+
+# Add wall time of the with block to the catalog lookup of a table that
+# has not started yet. Time spent queued between the lookup and the
+# transfer is not part of any stage or of the table duration.
+@contextmanager
+def lookup(table):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with metrics_lock:
+            lookups[table] = lookups.get(table, 0.0) + time.perf_counter() - start
+
+# Start recording metrics for a table when its transfer starts and bind it
+# to the current thread
+def start_table(table):
+    with metrics_lock:
+        running[table] = {
+            "table": table,
+            "start": time.time(),
+            "stages": {stage: 0.0 for stage in stages},
+            "rows": 0,
+            "bytes": 0,
+        }
+        running[table]["stages"]["catalog_lookup"] = lookups.pop(table, 0.0)
+    bind_table(table)
+
+# Record metrics of the current thread or task for table
+def bind_table(table):
+    current_table.set(table)
+
+def get_bound_table():
+    return current_table.get()
+
+def get_current():
+    table = current_table.get()
+    if table is None:
+        return None
+    return running.get(table)
+
+# Add wall time of the with block to a stage of the current table
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = get_current()
+        if metrics is not None:
+            with metrics_lock:
+                metrics["stages"][name] += time.perf_counter() - start
+
+# Iterate, adding time spent waiting for the next item to a stage
+def timed_iter(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def add_rows(rows):
+    metrics = get_current()
+    if metrics is not None:
+        with metrics_lock:
+            metrics["rows"] += rows
+
+def add_bytes(count):
+    metrics = get_current()
+    if metrics is not None:
+        with metrics_lock:
+            metrics["bytes"] += count
+
+# Stop recording a table without writing metrics
+def discard_table(table):
+    with metrics_lock:
+        running.pop(table, None)
+        lookups.pop(table, None)
+    current_table.set(None)
+
+# Finish a table and write its metrics. Peak memory is the peak rss of the
+# process so far, shared by tables that run at the same time.
+def finish_table(table, status='success'):
+    with metrics_lock:
+        metrics = running.pop(table, None)
+    current_table.set(None)
+    if metrics is None:
+        return None
+
+    duration = time.time() - metrics.pop("start")
+    metrics["status"] = status
+    metrics["finished_at"] = time.time()
+    metrics["duration_seconds"] = round(duration, 3)
+    metrics["rows_per_second"] = round(metrics["rows"] / duration, 1) if duration > 0 else 0.0
+    metrics["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    metrics["stages"] = {name: round(seconds, 3) for name, seconds in metrics["stages"].items()}
+
+    with metrics_lock:
+        finished[table] = metrics
+        if metrics_file is not None:
+            with open(metrics_file, 'a') as f:
+                f.write(json.dumps(metrics) + '\n')
+        if metrics_prom_file is not None:
+            write_prom_file()
+    return metrics
+
+def prom_line(name, labels, value):
+    label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    return f"{name}{{{label_text}}} {value}"
+
+# Write latest metrics of all finished tables in prometheus text format
+def write_prom_file():
+    lines = [
+        "# HELP pg2bq_stage_seconds Wall time of a transfer stage.",
+        "# TYPE pg2bq_stage_seconds gauge",
+    ]
+    for table, metrics in sorted(finished.items()):
+        for name, seconds in metrics["stages"].items():
+            lines.append(prom_line("pg2bq_stage_seconds", {"table": table, "stage": name}, seconds))
+    gauges = (
+        ("pg2bq_duration_seconds", "duration_seconds", "Wall time of the last transfer."),
+        ("pg2bq_rows", "rows", "Rows moved by the last transfer."),
+        ("pg2bq_bytes", "bytes", "Bytes moved by the last transfer."),
+        ("pg2bq_rows_per_second", "rows_per_second", "Throughput of the last transfer."),
+        ("pg2bq_peak_rss_bytes", "peak_rss_bytes", "Peak process memory at the end of the last transfer."),
+        ("pg2bq_last_finished_timestamp_seconds", "finished_at", "Time the last transfer finished."),
+    )
+    for name, key, description in gauges:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for table, metrics in sorted(finished.items()):
+            lines.append(prom_line(name, {"table": table}, metrics[key]))
+    lines.append("# HELP pg2bq_success Whether the last transfer succeeded.")
+    lines.append("# TYPE pg2bq_success gauge")
+    for table, metrics in sorted(finished.items()):
+        lines.append(prom_line("pg2bq_success", {"table": table}, int(metrics["status"] == 'success')))
+
+    # Write to a temporary file first so collectors never read a partial file
+    tmp_file = f"{metrics_prom_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_file, metrics_prom_file)
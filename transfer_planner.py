@@ -0,0 +1,143 @@
+#
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Transfer planner: picks a strategy per table from postgresql statistics
+# and orders tables so the longest transfers start first.
+import math
+import os
+from data_catalog_tagging import get_table_config
+from resource_manager import get_psql_engine, source_context
+
+# Expected transfer throughput of one reader, used for time estimates
+planner_bytes_per_second = float(os.getenv('PLANNER_BYTES_PER_SECOND', str(20 * 1024 * 1024)))
+
+# With PLANNER_AUTO_PARALLEL, tables with an integer primary key larger
+# than the threshold are read in parallel, one worker per threshold size.
+# Without a key the ranges are ctid page ranges, which postgresql before 14
+# can only read with a full scan per worker, so those tables are never
+# split unless parallel_workers is set.
+planner_auto_parallel = os.getenv('PLANNER_AUTO_PARALLEL', 'false').lower() == 'true'
+planner_parallel_threshold = int(os.getenv('PLANNER_PARALLEL_THRESHOLD', str(1024 * 1024 * 1024)))
+planner_max_workers = int(os.getenv('PLANNER_MAX_WORKERS', '8'))
+
+# Fixed cost per table: catalog lookup, schema sync and load job
+planner_table_overhead = float(os.getenv('PLANNER_TABLE_OVERHEAD', '5'))
+
+# Get size and activity statistics for a list of source tables
+def get_table_stats(source_tables):
+    import data_transfer as dt
+    reserved = dt.acquire_pg_connections()
+    conn = get_psql_engine().raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT t,
+                coalesce(c.reltuples, 0)::bigint,
+                coalesce(pg_total_relation_size(c.oid), 0),
+                coalesce(s.n_live_tup, 0),
+                coalesce(s.n_mod_since_analyze, 0),
+                EXISTS (
+                    SELECT 1 FROM pg_index i
+                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = c.oid AND i.indisprimary AND i.indnatts = 1
+                        AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype))
+            FROM unnest(%s::text[]) AS t
+            LEFT JOIN pg_class c ON c.oid = to_regclass(t)
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid""", (list(source_tables),))
+        stats = {}
+        for table, reltuples, size, live_rows, modified_rows, integer_key in cursor.fetchall():
+            stats[table] = {
+                "rows": max(reltuples, live_rows),
+                "size_bytes": size,
+                "modified_rows": modified_rows,
+                "integer_key": integer_key,
+            }
+        cursor.close()
+        return stats
+    finally:
+        conn.close()
+        dt.release_pg_connections(reserved)
+
+# Plan the transfer of one table
+def plan_table(source_table, metadata, stats):
+    table_config = get_table_config(source_table) or {}
+    rows = stats.get("rows", 0)
+    size = stats.get("size_bytes", 0)
+
+    plan = {
+        "source_table": source_table,
+        "rows": rows,
+        "size_bytes": size,
+        "strategy": "full",
+        "workers": 1,
+    }
+
+    # Incremental tables only move rows changed since the last sync. Rows
+    # modified since the last analyze are the best cheap estimate we have.
+    if 'incremental_column' in table_config and metadata.get('last_synced'):
+        plan["strategy"] = "incremental"
+        changed = min(max(stats.get("modified_rows", 0) / max(rows, 1), 0.01), 1.0)
+        size = size * changed
+
+    # Configured workers always apply, automatic splits are opt-in
+    if 'parallel_workers' in table_config:
+        plan["workers"] = int(table_config['parallel_workers'])
+    elif planner_auto_parallel and stats.get("integer_key") and size > planner_parallel_threshold:
+        plan["workers"] = min(planner_max_workers, math.ceil(size / planner_parallel_threshold))
+
+    if plan["workers"] > 1 and plan["strategy"] == "full":
+        plan["strategy"] = "parallel"
+    plan["estimated_seconds"] = round(
+        planner_table_overhead + size / (planner_bytes_per_second * plan["workers"]), 1)
+    return plan
+
+# Plan all tables, longest estimated transfer first. tables is a list of
+# (source table entry, replication metadata) pairs. Statistics are read
+# from the postgresql source of each table.
+def plan_tables(tables):
+    by_source = {}
+    for src_table, metadata in tables:
+        by_source.setdefault(metadata.get('source'), []).append(metadata['source_table'])
+    stats = {}
+    for source, source_tables in by_source.items():
+        with source_context(source):
+            for table, table_stats in get_table_stats(source_tables).items():
+                stats[(source, table)] = table_stats
+
+    planned = []
+    for src_table, metadata in tables:
+        table_stats = stats.get((metadata.get('source'), metadata['source_table']), {})
+        plan = plan_table(metadata['source_table'], metadata, table_stats)
+        planned.append((src_table, metadata, plan))
+    planned.sort(key=lambda table: table[2]["estimated_seconds"], reverse=True)
+    return planned
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024 or unit == 'TB':
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+def print_plan(planned, table_workers):
+    print(f"{'table':<48} {'strategy':<12} {'workers':>7} {'rows':>14} {'size':>10} {'est. time':>10}")
+    for src_table, metadata, plan in planned:
+        print(f"{plan['source_table']:<48} {plan['strategy']:<12} {plan['workers']:>7} "
+            f"{plan['rows']:>14} {format_size(plan['size_bytes']):>10} {plan['estimated_seconds']:>9}s")
+
+    # Longest-first list scheduling on table_workers slots
+    slots = [0.0] * max(table_workers, 1)
+    for src_table, metadata, plan in planned:
+        slots[slots.index(min(slots))] += plan['estimated_seconds']
+    print(f"{len(planned)} tables, estimated run time {max(slots):.0f}s with {table_workers} table workers")